@@ -46,12 +46,38 @@ class Gecko2ImageServiceMaker(object):
 
         web_path = config["web_path"]
         port = config["port"]
-        selenium_remote = config["selenium_remote"]
+        selenium_remote = config.get("selenium_remote")
         dashboards = config["dashboards"]
         update_interval = config["update_interval"]
-
-        gecko_imager = GeckoImageServer(web_path, port, selenium_remote,
-                                        dashboards, update_interval)
+        browser_pool_size = config.get("browser_pool_size", 1)
+        browser_max_renders = config.get("browser_max_renders", 100)
+        image_dir = config.get("image_dir")
+        idle_timeout = config.get("idle_timeout")
+        idle_interval = config.get("idle_interval")
+        diff_threshold = config.get("diff_threshold")
+        max_backoff = config.get("max_backoff", 1)
+        image_variants = config.get("image_variants", False)
+        widget_images = config.get("widget_images", False)
+        metrics_source = None
+        if config.get("dummy_metrics"):
+            from vumidash.dummy_client import DummyClient
+            metrics_source = DummyClient()
+        elif config.get("graphite_url"):
+            from vumidash.graphite_client import GraphiteClient
+            metrics_source = GraphiteClient(config["graphite_url"])
+
+        gecko_imager = GeckoImageServer(
+            web_path, port, selenium_remote, dashboards, update_interval,
+            browser_pool_size=browser_pool_size,
+            browser_max_renders=browser_max_renders,
+            image_dir=image_dir,
+            idle_timeout=idle_timeout,
+            idle_interval=idle_interval,
+            diff_threshold=diff_threshold,
+            max_backoff=max_backoff,
+            metrics_source=metrics_source,
+            image_variants=image_variants,
+            widget_images=widget_images)
         return gecko_imager
 
 
@@ -6,7 +6,9 @@ from twisted.application.service import IServiceMaker
 
 from vumidash.graphite_client import GraphiteClient
 from vumidash.dummy_client import DummyClient
-from vumidash.gecko_server import GeckoServer
+from vumidash.gecko_server import GeckoServer, AdmissionController
+from vumidash.gecko_workers import GeckoWorkerPool
+from vumidash.rollup_store import RollupStore, RollupMetricSource
 
 
 class Options(usage.Options):
@@ -18,8 +20,33 @@ class Options(usage.Options):
     optParameters = [
         ["graphite-url", "g", None, "The URL of the Graphite web service."],
         ["port", "p", 1235, "The port number to serve JSON to Geckoboard on."],
+        ["timeout", "t", 30.0, "Number of seconds a request may take before"
+                               " it is finished with partial, stale or"
+                               " error data.", float],
+        ["timeout-policy", None, "error", "What to return when a request"
+                                          " times out (error, partial or"
+                                          " stale)."],
+        ["max-outstanding", None, 0, "Maximum number of upstream fetches in"
+                                     " progress before requests are shed."
+                                     " 0 admits every request.", int],
+        ["max-lag", None, 0.5, "Maximum reactor lag in seconds before"
+                               " requests are shed (only used with"
+                               " --max-outstanding).", float],
+        ["workers", "w", 0, "Number of worker processes to serve requests"
+                            " from. 0 serves requests from this process.",
+         int],
+        ["rollup-dir", None, None, "Directory to keep hourly and daily"
+                                   " rollups of metrics in. Long-range"
+                                   " queries are answered from these."],
+        ["cache-ttl", None, 30.0, "Number of seconds worker processes share"
+                                  " cached metrics for.", float],
         ]
 
+    def postOptions(self):
+        if self["dummy"] and self["rollup-dir"]:
+            raise usage.UsageError("--rollup-dir can't be combined with"
+                                   " --dummy.")
+
 
 class Graphite2GeckoServiceMaker(object):
     implements(IServiceMaker, IPlugin)
@@ -34,7 +61,24 @@ class Graphite2GeckoServiceMaker(object):
             metrics_source = DummyClient()
         else:
             metrics_source = GraphiteClient(graphite_url)
-        gecko_server = GeckoServer(metrics_source, port)
+            if options["rollup-dir"]:
+                metrics_source = RollupMetricSource(
+                    metrics_source, RollupStore(options["rollup-dir"]))
+        if options["workers"] > 0:
+            return GeckoWorkerPool(metrics_source, port, options["workers"],
+                                   timeout=options["timeout"],
+                                   timeout_policy=options["timeout-policy"],
+                                   cache_ttl=options["cache-ttl"],
+                                   max_outstanding=options["max-outstanding"],
+                                   max_lag=options["max-lag"])
+        admission = None
+        if options["max-outstanding"] > 0:
+            admission = AdmissionController(options["max-outstanding"],
+                                            options["max-lag"])
+        gecko_server = GeckoServer(metrics_source, port,
+                                   timeout=options["timeout"],
+                                   timeout_policy=options["timeout-policy"],
+                                   admission=admission)
         return gecko_server
 
 
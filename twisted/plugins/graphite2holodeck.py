@@ -1,7 +1,5 @@
 from zope.interface import implements
 
-import yaml
-
 from twisted.python import usage
 from twisted.plugin import IPlugin
 from twisted.application.service import IServiceMaker
@@ -23,8 +21,69 @@ class Options(usage.Options):
         ["graphite-url", "g", None, "The URL of the Graphite web service."],
         ["config", "c", None, "The YAML config file describing which metrics"
          " to push."],
+        ["max-sends", None, None, "Maximum number of pushes in progress to"
+         " each Holodeck server.", int],
+        ["spool-dir", None, None, "Directory to keep failed pushes in until"
+         " they can be retried. Failed pushes are dropped if not given."
+         " Each shard uses <spool-dir>.shard-<index>."],
+        ["spool-max-bytes", None, 10 * 1024 * 1024, "Maximum size of the"
+         " spool for each Holodeck server and API key.", int],
+        ["max-outstanding", None, None, "Maximum number of pushes in"
+         " progress across all sample sets.", int],
+        ["jitter", None, 0.0, "Fraction of each sample set's period to"
+         " spread pushes over, unless the set configures its own.", float],
+        ["scheduler", None, "heap", "Scheduler to time pushes with: 'heap'"
+         " or 'wheel' (for very large configurations)."],
+        ["watch-interval", None, None, "Check the config file for changes"
+         " every this many seconds and reload it when it changes. The"
+         " config is also reloaded on SIGHUP.", float],
+        ["shard-index", None, 0, "Index of this process's shard. Only"
+         " sample sets whose server and API key hash to it are pushed.",
+         int],
+        ["shard-count", None, 1, "Number of shards sample sets are split"
+         " over.", int],
+        ["shards", None, 0, "Run this many shard processes on this machine"
+         " and restart them if they exit.", int],
+        ["state-file", None, None, "File to record the last successful push"
+         " of each sample set in. Pushes missed while the service wasn't"
+         " running are backfilled on start. Each shard uses"
+         " <state-file>.shard-<index>."],
+        ["backfill-rate", None, 10.0, "Maximum number of backfill pushes per"
+         " second.", float],
+        ["max-backfill", None, 24 * 60 * 60, "Only backfill pushes missed"
+         " in this many seconds before start.", float],
+        ["stats-interval", None, None, "Log a summary of push and spool"
+         " statistics every this many seconds.", float],
     ]
 
+    SHARD_OPTIONS = ("shard-index", "shard-count", "shards")
+
+    def postOptions(self):
+        if not 0 <= self["shard-index"] < self["shard-count"]:
+            raise usage.UsageError("--shard-index must be at least 0 and"
+                                   " less than --shard-count")
+        if self["shards"] and self["shard-count"] > 1:
+            raise usage.UsageError("--shards can't be combined with"
+                                   " --shard-count")
+        if self["shard-count"] > 1:
+            from vumidash.holodeck_shards import shard_path
+            for name in ("spool-dir", "state-file"):
+                if self[name] is not None:
+                    self[name] = shard_path(self[name], self["shard-index"])
+
+    def shard_args(self):
+        """Return the options to pass on to each shard process."""
+        args = []
+        for flag in self.optFlags:
+            if self[flag[0]]:
+                args.append("--%s" % (flag[0],))
+        for param in self.optParameters:
+            name, default = param[0], param[2]
+            if name in self.SHARD_OPTIONS or self[name] == default:
+                continue
+            args.extend(["--%s" % (name,), str(self[name])])
+        return args
+
 
 class Graphite2HolodeckServiceMaker(object):
     implements(IServiceMaker, IPlugin)
@@ -33,16 +92,33 @@ class Graphite2HolodeckServiceMaker(object):
     options = Options
 
     def makeService(self, options):
-        from vumidash.holodeck_pusher import HolodeckPusherService
+        from vumidash.holodeck_pusher import (
+            HolodeckPusherService, load_config)
+        from vumidash.holodeck_shards import HolodeckShardSupervisor
 
+        if options["shards"] > 0:
+            return HolodeckShardSupervisor(options["shards"],
+                                           options.shard_args())
         graphite_url = options["graphite-url"]
-        with open(options["config"]) as f:
-            config = yaml.safe_load(f.read())
+        config = load_config(options["config"])
         if options["dummy"]:
             metrics_source = DummyClient()
         else:
             metrics_source = GraphiteClient(graphite_url)
-        holodeck_pusher = HolodeckPusherService(metrics_source, config)
+        holodeck_pusher = HolodeckPusherService(
+            metrics_source, config, max_sends=options["max-sends"],
+            spool_dir=options["spool-dir"],
+            spool_max_bytes=options["spool-max-bytes"],
+            max_outstanding=options["max-outstanding"],
+            jitter=options["jitter"], scheduler=options["scheduler"],
+            config_file=options["config"],
+            watch_interval=options["watch-interval"],
+            shard_index=options["shard-index"],
+            shard_count=options["shard-count"],
+            state_file=options["state-file"],
+            backfill_rate=options["backfill-rate"],
+            max_backfill=options["max-backfill"],
+            stats_interval=options["stats-interval"])
         return holodeck_pusher
 
 
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+"""Benchmark the Holodeck pusher's schedulers with a fake clock.
+
+   Schedules N items that each recur every `--frequency` seconds at a
+   random offset into their period (as sample sets with jitter do) and
+   simulates `--minutes` minutes, one second at a time. For each
+   scheduler and number of items it reports the reactor calls made per
+   simulated second, the wall-clock time spent per simulated second and
+   the memory used by the scheduler.
+
+   Each run happens in a child process so that memory use is measured
+   from a clean start. Usage:
+
+       python utils/bench_scheduler.py [--sets 10000,100000]
+   """
+
+import os
+import sys
+import json
+import time
+import random
+import resource
+import subprocess
+from optparse import OptionParser
+
+from twisted.internet.task import Clock
+
+from vumidash.scheduler import HeapScheduler, TimingWheel
+
+
+SCHEDULERS = {
+    'heap': HeapScheduler,
+    'wheel': TimingWheel,
+    }
+
+
+class CountingClock(Clock):
+    """Clock that counts the calls scheduled on it."""
+
+    def __init__(self):
+        Clock.__init__(self)
+        self.call_count = 0
+
+    def callLater(self, *args, **kw):
+        self.call_count += 1
+        return Clock.callLater(self, *args, **kw)
+
+
+def max_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run(scheduler_name, sets, frequency, minutes, jitter):
+    clock = CountingClock()
+    rng = random.Random(0)
+    processed = [0]
+
+    def process(due):
+        processed[0] += len(due)
+        for t, item in due:
+            scheduler.schedule(t + frequency, item)
+
+    rss_before = max_rss_kb()
+    scheduler = SCHEDULERS[scheduler_name](clock, process)
+    for item in xrange(sets):
+        scheduler.schedule(frequency + rng.random() * jitter * frequency,
+                           item)
+    scheduler.start()
+    rss_after = max_rss_kb()
+
+    seconds = minutes * 60
+    clock.call_count = 0
+    started = time.time()
+    for _ in xrange(seconds):
+        clock.advance(1)
+    elapsed = time.time() - started
+    scheduler.stop()
+    return {
+        'scheduler': scheduler_name,
+        'sets': sets,
+        'processed': processed[0],
+        'calls_per_second': clock.call_count / float(seconds),
+        'ms_per_second': elapsed * 1000 / seconds,
+        'us_per_set': elapsed * 1e6 / max(processed[0], 1),
+        'memory_kb': rss_after - rss_before,
+        }
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--sets", default="10000,100000",
+                      help="Comma-separated numbers of sets to schedule.")
+    parser.add_option("--schedulers", default="heap,wheel",
+                      help="Comma-separated schedulers to benchmark.")
+    parser.add_option("--frequency", type="float", default=60.0,
+                      help="Seconds between pushes of each set.")
+    parser.add_option("--minutes", type="int", default=3,
+                      help="Number of simulated minutes.")
+    parser.add_option("--jitter", type="float", default=1.0,
+                      help="Fraction of the period to spread sets over.")
+    parser.add_option("--child", action="store_true",
+                      help="Run a single benchmark and print its results.")
+    options, _args = parser.parse_args()
+
+    if options.child:
+        result = run(options.schedulers, int(options.sets),
+                     options.frequency, options.minutes, options.jitter)
+        print json.dumps(result)
+        return
+
+    env = os.environ.copy()
+    env["PYTHONPATH"] = os.pathsep.join(os.path.abspath(p) for p in sys.path)
+    print "%-8s %8s %12s %12s %10s %10s" % (
+        "sched", "sets", "calls/s", "ms/s", "us/set", "mem KiB")
+    for sets in options.sets.split(","):
+        for name in options.schedulers.split(","):
+            output = subprocess.check_output([
+                sys.executable, __file__, "--child",
+                "--sets", sets, "--schedulers", name,
+                "--frequency", str(options.frequency),
+                "--minutes", str(options.minutes),
+                "--jitter", str(options.jitter)], env=env)
+            result = json.loads(output)
+            print "%-8s %8d %12.2f %12.3f %10.2f %10d" % (
+                result['scheduler'], result['sets'],
+                result['calls_per_second'], result['ms_per_second'],
+                result['us_per_set'], result['memory_kb'])
+
+
+if __name__ == "__main__":
+    main()
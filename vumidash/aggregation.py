@@ -0,0 +1,164 @@
+# -*- test-case-name: vumidash.tests.test_aggregation -*-
+
+"""Server-side aggregation of sets of metric series.
+
+   Series fetched together (e.g. all series matching a Graphite wildcard)
+   share one time grid. They are aligned into rows of equal length and
+   each operator then works column by column over the aligned rows, so
+   summarising hundreds of series costs one pass over the data.
+
+   Supported operators:
+
+   * `sum` -- sum of all series.
+   * `mean` -- mean of all series.
+   * `pNN` -- NNth percentile across series (e.g. `p95`).
+   * `topN` -- the N series with the highest latest values (e.g. `top5`).
+   * `rate` -- per-second rate of change of the sum of all series.
+
+   Null values are ignored. A column with no values aggregates to null.
+   """
+
+import re
+
+
+OPERATOR_RE = re.compile(r"^(sum|mean|rate|p(\d+(?:\.\d+)?)|top(\d+))$")
+
+
+def parse_operator(spec):
+    """Return `(name, argument)` for an operator specification.
+
+    Raises :class:`ValueError` for unknown operators.
+    """
+    match = OPERATOR_RE.match(spec)
+    if match is None:
+        raise ValueError("Unknown aggregation operator %r" % (spec,))
+    name, percentile, top = match.groups()
+    if percentile is not None:
+        value = float(percentile)
+        if not 0 <= value <= 100:
+            raise ValueError("Percentile must be between 0 and 100")
+        return 'percentile', value
+    if top is not None:
+        return 'top', int(top)
+    return name, None
+
+
+def split_points(points):
+    """Split a series into timestamps and values.
+
+    Series may either be lists of `(timestamp, value)` pairs or lists of
+    bare values, in which case the returned timestamps are `None`.
+    """
+    if points and isinstance(points[0], (list, tuple)):
+        times, values = zip(*points)
+        return list(times), list(values)
+    return None, list(points)
+
+
+def align(series):
+    """Align a list of `(name, points)` series.
+
+    Returns `(names, times, rows)` where rows holds one list of values per
+    series. Shorter series are padded with nulls at the start so that the
+    newest values line up.
+    """
+    names, times, rows = [], None, []
+    for name, points in series:
+        series_times, values = split_points(points)
+        if series_times is not None and (
+                times is None or len(series_times) > len(times)):
+            times = series_times
+        names.append(name)
+        rows.append(values)
+    width = max([len(row) for row in rows] or [0])
+    rows = [[None] * (width - len(row)) + row for row in rows]
+    return names, times, rows
+
+
+def _values(column):
+    return [v for v in column if v is not None]
+
+
+def _sum(column):
+    values = _values(column)
+    return sum(values) if values else None
+
+
+def _mean(column):
+    values = _values(column)
+    return sum(values) / float(len(values)) if values else None
+
+
+def _percentile(column, q):
+    values = sorted(_values(column))
+    if not values:
+        return None
+    # nearest-rank percentile
+    rank = max(int(-(-q * len(values) // 100)), 1)
+    return values[rank - 1]
+
+
+def _latest(row):
+    for value in reversed(row):
+        if value is not None:
+            return value
+    return None
+
+
+def aggregate_rows(operator, argument, rows, step_seconds):
+    """Apply an operator to aligned rows.
+
+    Returns a list of `(index, values)` pairs, one per output series, where
+    index is the input row the output came from or `None` if it combines
+    several rows.
+    """
+    if operator == 'top':
+        ranked = sorted(range(len(rows)), reverse=True,
+                        key=lambda i: _latest(rows[i]))
+        return [(i, rows[i]) for i in ranked[:argument]]
+    columns = zip(*rows)
+    if operator == 'sum':
+        values = [_sum(column) for column in columns]
+    elif operator == 'mean':
+        values = [_mean(column) for column in columns]
+    elif operator == 'percentile':
+        values = [_percentile(column, argument) for column in columns]
+    elif operator == 'rate':
+        sums = [_sum(column) for column in columns]
+        values = [None] if sums else []
+        for prev, value in zip(sums, sums[1:]):
+            if prev is None or value is None:
+                values.append(None)
+            else:
+                values.append((value - prev) / float(step_seconds))
+    else:
+        raise ValueError("Unknown aggregation operator %r" % (operator,))
+    return [(None, values)]
+
+
+def aggregate_series(spec, series, step_seconds, name=None):
+    """Aggregate a list of `(name, points)` series with the operator spec.
+
+    Returns a list of `(name, points)` series. Series that combine several
+    inputs are named name. Points keep the timestamps of the input series
+    if they had any.
+    """
+    operator, argument = parse_operator(spec)
+    names, times, rows = align(series)
+    result = []
+    for index, values in aggregate_rows(operator, argument, rows,
+                                        step_seconds):
+        series_name = names[index] if index is not None else name
+        if times is not None:
+            values = zip(times, values)
+        result.append((series_name, list(values)))
+    return result
+
+
+def latest_values(points):
+    """Return the oldest and newest non-null values of a series."""
+    _times, values = split_points(points)
+    values = _values(values)
+    if not values:
+        return None, None
+    return values[0], values[-1]
@@ -1,5 +1,7 @@
 """Base classes for vumidash."""
 
+from twisted.internet.defer import maybeDeferred
+
 
 class MetricSource(object):
 
@@ -14,6 +16,22 @@ class MetricSource(object):
                     skip_nulls=True):
         raise NotImplementedError("Sub-class should implement get_history")
 
+    def get_series(self, target, from_dt, until_dt, step_dt):
+        """Return a Deferred that fires with a list of `(name, history)`
+        pairs, one for each series matching target, with nulls preserved.
+
+        Sources that support wildcard targets should override this to
+        fetch every matching series at once. By default target is read
+        as a single series with :meth:`get_history`.
+        """
+        d = maybeDeferred(self.get_history, target, from_dt, until_dt,
+                          step_dt, False)
+        return d.addCallback(lambda history: [(target, history)])
+
+    def close(self):
+        """Release any resources held by the source. Called when the
+        service using it stops."""
+
 
 class UnknownMetricError(Exception):
     """Raised when a metric source encounters an unknown metric name."""
@@ -8,20 +8,138 @@
    The images are generated by using Selenium to script Firefox.
    """
 
+import os
+import heapq
+import Queue
 import base64
+import hashlib
+import itertools
 import pkg_resources
+from cStringIO import StringIO
+
+try:
+    from PIL import Image, ImageChops
+except ImportError:
+    Image = ImageChops = None
 
 from selenium import webdriver
 from selenium.webdriver.support.ui import WebDriverWait
 
 from twisted.application.service import Service
 from twisted.web import http
-from twisted.web.server import Site
+from twisted.web.server import Site, NOT_DONE_YET
+from twisted.web.static import NoRangeStaticProducer
 from twisted.web.resource import Resource
 from twisted.internet import reactor, threads
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import (
+    inlineCallbacks, gatherResults, Deferred)
 from twisted.internet.task import LoopingCall
 from twisted.python import log
+from twisted.python.threadpool import ThreadPool
+
+from vumidash.native_imager import NativeDashboardImager
+
+
+class WebDriverSession(object):
+    """A browser session and the number of renders done with it."""
+
+    def __init__(self, driver):
+        self.driver = driver
+        self.renders = 0
+
+
+class WebDriverPool(object):
+    """Thread-safe pool of long-lived Selenium browser sessions.
+
+    Sessions are started when first needed, checked before they're handed
+    out and replaced if they don't respond, fail a render or have done
+    max_renders renders.
+
+    :type remote: str
+    :param remote:
+        URL of the selenium server.
+    :type size: int
+    :param size:
+        Maximum number of browser sessions.
+    :type max_renders: int
+    :param max_renders:
+        Number of renders after which a session is replaced.
+    """
+
+    def __init__(self, remote, size=1, max_renders=100):
+        self.remote = remote
+        self.size = size
+        self.max_renders = max_renders
+        self.closed = False
+        self.stats = {"created": 0, "recycled": 0, "unhealthy": 0}
+        # None marks a slot without a session; LIFO so that warm sessions
+        # are reused before new ones are started
+        self.slots = Queue.LifoQueue()
+        for _ in range(size):
+            self.slots.put(None)
+
+    def new_driver(self):
+        return webdriver.Remote(self.remote,
+                                webdriver.DesiredCapabilities.FIREFOX)
+
+    def healthy(self, driver):
+        """Check that driver's browser session still responds."""
+        try:
+            driver.current_url
+        except Exception:
+            return False
+        return True
+
+    def quit(self, session):
+        try:
+            session.driver.quit()
+        except Exception:
+            log.err(None, "Error quitting browser session.")
+
+    def acquire(self):
+        """Return a :class:`WebDriverSession`, waiting for one to be
+        released if all of them are in use. Must be paired with a call to
+        :meth:`release`."""
+        session = self.slots.get()
+        if session is not None and not self.healthy(session.driver):
+            log.msg("Replacing unresponsive browser session.")
+            self.stats["unhealthy"] += 1
+            self.quit(session)
+            session = None
+        if session is None:
+            try:
+                session = WebDriverSession(self.new_driver())
+            except Exception:
+                self.slots.put(None)
+                raise
+            self.stats["created"] += 1
+        return session
+
+    def release(self, session, failed=False):
+        """Return session to the pool, replacing it if the render failed
+        or it's done enough renders."""
+        session.renders += 1
+        if self.closed or failed or session.renders >= self.max_renders:
+            if not self.closed:
+                self.stats["recycled"] += 1
+            self.quit(session)
+            session = None
+        self.slots.put(session)
+
+    def close(self):
+        """Quit all idle sessions. Sessions in use are quit when they're
+        released."""
+        self.closed = True
+        sessions = []
+        while True:
+            try:
+                sessions.append(self.slots.get_nowait())
+            except Queue.Empty:
+                break
+        for session in sessions:
+            if session is not None:
+                self.quit(session)
+            self.slots.put(None)
 
 
 class DashboardImager(object):
@@ -36,101 +154,745 @@ class DashboardImager(object):
     :type title: str
     :param title:
         A human readable name for the dashboard
+    :type driver_pool: :class:`WebDriverPool`
+    :param driver_pool:
+        Pool to take browser sessions from. If None, a new session is
+        started for every image.
+    :type timeout: float
+    :param timeout:
+        Number of seconds to wait for the dashboard's widgets to load.
+
+    After each render, `widget_boxes` holds the `(left, top, right,
+    bottom)` box of each widget in the screenshot.
     """
 
-    def __init__(self, remote, url, title=None):
+    POLL_INTERVAL = 0.5
+
+    # returns [loaded, total] widget counts and the bounding box of each
+    # widget in screenshot pixels, or null if the dashboard hasn't been
+    # laid out yet
+    READY_SCRIPT = """
+        var wrapper = document.getElementById("dashboard-wrapper");
+        if (!wrapper) {
+            return null;
+        }
+        var widgets = wrapper.getElementsByClassName("b-widget");
+        var ratio = window.devicePixelRatio || 1;
+        var loaded = 0;
+        var boxes = [];
+        for (var i = 0; i < widgets.length; i++) {
+            if ((" " + widgets[i].className + " ").indexOf(" loaded ") >= 0) {
+                loaded++;
+            }
+            var rect = widgets[i].getBoundingClientRect();
+            var box = [rect.left + window.pageXOffset,
+                       rect.top + window.pageYOffset,
+                       rect.right + window.pageXOffset,
+                       rect.bottom + window.pageYOffset];
+            for (var j = 0; j < box.length; j++) {
+                box[j] = Math.round(box[j] * ratio);
+            }
+            boxes.push(box);
+        }
+        return [loaded, widgets.length, boxes];
+        """
+
+    def __init__(self, remote, url, title=None, driver_pool=None,
+                 timeout=10):
         self.remote = remote
         self.url = url
         self.title = title
+        self.driver_pool = driver_pool
+        self.timeout = timeout
+        self.widget_boxes = None
 
     def _page_ready(self, driver):
-        """Check that all the widgets are loaded."""
-        wrapper = driver.find_element_by_id("dashboard-wrapper")
-        loaded = True
-        for widget in wrapper.find_elements_by_class_name("b-widget"):
-            if "loaded" not in widget.get_attribute("class").split():
-                loaded = False
-                break
-        return loaded
+        """Check that all the widgets are loaded, in a single WebDriver
+        round trip. Returns the script's result if they are and False
+        otherwise."""
+        result = driver.execute_script(self.READY_SCRIPT)
+        if result is None:
+            return False
+        loaded, total, _boxes = result
+        return result if loaded == total else False
+
+    def render_png(self, driver):
+        """Load the page in driver and return a PNG of it."""
+        driver.get(self.url)
+        _loaded, _total, boxes = WebDriverWait(
+            driver, self.timeout, self.POLL_INTERVAL).until(self._page_ready)
+        encoded_png = driver.get_screenshot_as_base64()
+        self.widget_boxes = [tuple(box) for box in boxes]
+        return base64.decodestring(encoded_png)
 
     def generate_png(self):
         """Return a binary string containing a PNG of the page."""
-        driver = webdriver.Remote(self.remote,
-                                  webdriver.DesiredCapabilities.FIREFOX)
-        try:
-            driver.get(self.url)
-            WebDriverWait(driver, 10).until(self._page_ready)
-            encoded_png = driver.get_screenshot_as_base64()
-            png = base64.decodestring(encoded_png)
-        finally:
-            driver.quit()
+        if self.driver_pool is None:
+            driver = webdriver.Remote(self.remote,
+                                      webdriver.DesiredCapabilities.FIREFOX)
+            try:
+                return self.render_png(driver)
+            finally:
+                driver.quit()
 
+        session = self.driver_pool.acquire()
+        try:
+            png = self.render_png(session.driver)
+        except Exception:
+            self.driver_pool.release(session, failed=True)
+            raise
+        self.driver_pool.release(session)
         return png
 
 
+def png_etag(digest):
+    """Return the ETag for an image from its SHA-1 digest object."""
+    return '"%s"' % (digest.hexdigest(),)
+
+
+def image_difference(png1, png2):
+    """Return the fraction of pixels that differ between two PNGs.
+
+    Images of different sizes differ completely. Requires PIL.
+    """
+    image1 = Image.open(StringIO(png1)).convert("RGB")
+    image2 = Image.open(StringIO(png2)).convert("RGB")
+    if image1.size != image2.size:
+        return 1.0
+    diff = ImageChops.difference(image1, image2).convert("L")
+    histogram = diff.histogram()
+    width, height = image1.size
+    return float(sum(histogram[1:])) / (width * height)
+
+
+# widths of the size variants of images, None for the rendered size
+IMAGE_SIZES = {
+    "thumbnail": 320,
+    "medium": 800,
+    "full": None,
+    }
+
+# content types and lossless PIL encoder settings of the image formats
+IMAGE_FORMATS = {
+    "png": ("image/png", "PNG", {"optimize": True}),
+    "webp": ("image/webp", "WEBP", {"lossless": True, "method": 6}),
+    }
+
+
+def image_formats():
+    """Return the image formats PIL can encode."""
+    if Image is None:
+        return []
+    Image.init()
+    return sorted(name for name, (_, pil_format, _) in IMAGE_FORMATS.items()
+                  if pil_format in Image.SAVE)
+
+
+def image_variants(png, formats):
+    """Return a dict mapping `(size, format)` to each size variant of a
+    PNG losslessly encoded in each of formats. Requires PIL."""
+    image = Image.open(StringIO(png))
+    image.load()
+    width, height = image.size
+    variants = {}
+    for size, size_width in IMAGE_SIZES.items():
+        resized = image
+        if size_width is not None and size_width < width:
+            size_height = max(int(round(height * size_width / float(width))),
+                              1)
+            resized = image.resize((size_width, size_height),
+                                   Image.ANTIALIAS)
+        for name in formats:
+            _, pil_format, options = IMAGE_FORMATS[name]
+            f = StringIO()
+            resized.save(f, pil_format, **options)
+            variants[(size, name)] = f.getvalue()
+    return variants
+
+
+def widget_variant(number):
+    """Return the `(size, format)` key of the image of the numbered
+    widget of a dashboard, counting from 1."""
+    return ("widget-%d" % (number,), "png")
+
+
+def crop_widgets(png, boxes):
+    """Return a PNG cropped from png to each `(left, top, right, bottom)`
+    box, or None for boxes outside of it. Requires PIL."""
+    image = Image.open(StringIO(png))
+    image.load()
+    width, height = image.size
+    _, pil_format, options = IMAGE_FORMATS["png"]
+    crops = []
+    for left, top, right, bottom in boxes:
+        box = (max(left, 0), max(top, 0), min(right, width),
+               min(bottom, height))
+        if box[0] >= box[2] or box[1] >= box[3]:
+            crops.append(None)
+            continue
+        f = StringIO()
+        image.crop(box).save(f, pil_format, **options)
+        crops.append(f.getvalue())
+    return crops
+
+
+class ImageStore(object):
+    """Directory holding the last rendered image of each dashboard.
+
+    :type directory: str
+    :param directory:
+        Directory to keep images in. Created if it doesn't exist.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, name, variant=None):
+        if variant is None:
+            return os.path.join(self.directory, "%s.png" % (name,))
+        return os.path.join(self.directory, "%s.%s.%s" % ((name,) + variant))
+
+    def write(self, name, png, variant=None):
+        """Atomically replace the stored image for name, or its
+        `(size, format)` variant."""
+        path = self.path(name, variant)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(png)
+        os.rename(tmp_path, path)
+        return path
+
+    def remove(self, name, variant=None):
+        try:
+            os.remove(self.path(name, variant))
+        except OSError:
+            pass
+
+    def variants(self, name):
+        """Return the `(size, format)` of every stored variant of the
+        image for name."""
+        prefix = name + "."
+        variants = []
+        for filename in os.listdir(self.directory):
+            if not filename.startswith(prefix):
+                continue
+            parts = filename[len(prefix):].split(".")
+            # skip the images of dashboards with dots in their names
+            if (len(parts) == 2 and parts[1] in IMAGE_FORMATS and
+                    (parts[0] in IMAGE_SIZES or
+                     parts[0].startswith("widget-"))):
+                variants.append(tuple(parts))
+        return variants
+
+    def load(self, name, variant=None):
+        """Return `(path, etag, last_modified)` for the stored image for
+        name, or its `(size, format)` variant, or None if there isn't
+        one."""
+        path = self.path(name, variant)
+        digest = hashlib.sha1()
+        try:
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(65536), ""):
+                    digest.update(chunk)
+                last_modified = os.fstat(f.fileno()).st_mtime
+        except (IOError, OSError):
+            return None
+        return path, png_etag(digest), last_modified
+
+
 class DashboardCache(object):
-    """Caches and updates a set of dashboards."""
+    """Caches and updates a set of dashboards.
+
+    All dashboards are rendered with browser sessions from a shared
+    :class:`WebDriverPool` of pool_size sessions, each of which is
+    replaced after max_renders renders. Renders run in parallel on a
+    thread pool with one thread per browser session.
+
+    Each image has an ETag derived from its contents and a Last-Modified
+    time of when its contents last changed.
+
+    If image_dir is given, images are written to an :class:`ImageStore`
+    there and `pngs` holds the paths of their files rather than the
+    images themselves. Stored images are loaded on start so that they
+    can be served before the first render finishes.
+
+    Each dashboard is re-rendered every update_interval seconds, or every
+    `update_interval` seconds from its own config if it has one. If
+    idle_timeout is given, dashboards that haven't been viewed for that
+    many seconds are only re-rendered every idle_interval seconds, or not
+    at all if idle_interval is None. Viewing a dashboard whose image is
+    older than its update interval queues a render of it ahead of the
+    scheduled ones.
+
+    A render identical to the current image, or with at most
+    diff_threshold of its pixels different from it if diff_threshold is
+    given (which requires PIL), leaves the current image and its
+    validators in place. Each unchanged render doubles the interval of
+    a dashboard, up to max_backoff times its update interval, and a
+    changed one resets it.
+
+    Dashboards configured with `widgets` rather than a `url` are drawn
+    by a :class:`vumidash.native_imager.NativeDashboardImager` from
+    metrics_source, without a browser.
+
+    If image_variants is true (which requires PIL), each changed render
+    is also encoded once, in the render thread, as every size in
+    :data:`IMAGE_SIZES` in every format of :data:`IMAGE_FORMATS` that PIL
+    can write. Variants are losslessly optimised and have their own
+    ETags.
 
-    def __init__(self, remote, dashboards, update_interval):
+    If widget_images is true (which requires PIL), each changed render
+    of a browser dashboard is also cropped to each of its widgets, which
+    are kept as variants keyed by :func:`widget_variant`.
+    """
+
+    clock = reactor  # testing hook
+
+    PRIORITY_VIEWED = 0
+    PRIORITY_SCHEDULED = 1
+
+    def __init__(self, remote, dashboards, update_interval, pool_size=1,
+                 max_renders=100, image_dir=None, idle_timeout=None,
+                 idle_interval=None, diff_threshold=None, max_backoff=1,
+                 metrics_source=None, image_variants=False,
+                 widget_images=False):
+        if diff_threshold is not None and Image is None:
+            raise ValueError("diff_threshold requires PIL")
+        if image_variants and Image is None:
+            raise ValueError("image_variants requires PIL")
+        if widget_images and Image is None:
+            raise ValueError("widget_images requires PIL")
+        self.image_variants = image_variants
+        self.widget_images = widget_images
+        self.widget_boxes = {}
+        self.image_formats = image_formats() if image_variants else []
         self.update_interval = update_interval
+        self.idle_timeout = idle_timeout
+        self.idle_interval = idle_interval
+        self.diff_threshold = diff_threshold
+        self.max_backoff = max_backoff
+        self.backoff = {}
+        self.store = ImageStore(image_dir) if image_dir is not None else None
+        self.driver_pool = WebDriverPool(remote, pool_size, max_renders)
+        self.pool_size = pool_size
+        self.thread_pool = None
         self.dashboards = {}
+        self.intervals = {}
         self.pngs = {}
+        self.validators = {}
+        self.variants = {}
         for name, config in dashboards.items():
+            config = dict(config)
             config.setdefault('title', name.title())
-            self.dashboards[name] = DashboardImager(remote, **config)
+            self.intervals[name] = config.pop('update_interval',
+                                              update_interval)
+            if 'widgets' in config:
+                if metrics_source is None:
+                    raise ValueError("Dashboard %r has widgets but there is"
+                                     " no metrics source" % (name,))
+                self.dashboards[name] = NativeDashboardImager(
+                    metrics_source, **config)
+            else:
+                self.dashboards[name] = DashboardImager(
+                    remote, driver_pool=self.driver_pool, **config)
             self.pngs[name] = None
+        self.created = self.clock.seconds()
+        self.last_viewed = {}
+        self.last_rendered = {}
+        self.render_queue = []
+        self.queued = {}
+        self.rendering = set()
+        self.waiters = {}
+        self._sequence = itertools.count()
         self.update_task = LoopingCall(self._refresh_images)
         self.update_task_done = None
 
-    @inlineCallbacks
+    def refresh_interval(self, name, now):
+        """Return the number of seconds between renders of a dashboard,
+        or None if it shouldn't be rendered."""
+        if self.idle_timeout is not None:
+            last_viewed = self.last_viewed.get(name, self.created)
+            if now - last_viewed >= self.idle_timeout:
+                return self.idle_interval
+        return self.intervals[name] * self.backoff.get(name, 1)
+
+    def is_due(self, name, now):
+        if self.pngs[name] is None:
+            return True
+        interval = self.refresh_interval(name, now)
+        if interval is None:
+            return False
+        return now - self.last_rendered.get(name, now - interval) >= interval
+
+    def is_stale(self, name, now):
+        """Check whether a dashboard's image is older than its update
+        interval."""
+        last_rendered = self.last_rendered.get(name)
+        return (last_rendered is None or
+                now - last_rendered >= self.intervals[name])
+
+    def max_age(self, name):
+        """Return the number of seconds clients may cache a dashboard's
+        image for."""
+        interval = self.refresh_interval(name, self.clock.seconds())
+        if interval is None:
+            interval = self.intervals[name]
+        return interval
+
+    def refresh_images(self):
+        """Queue renders of the dashboards that are due. Returns a Deferred
+        that fires once they have been rendered."""
+        now = self.clock.seconds()
+        renders = []
+        for name in self.dashboards:
+            if self.is_due(name, now):
+                renders.append(self.queue_render(name))
+        return gatherResults(renders)
+
     def _refresh_images(self):
-        for name, imager in self.dashboards.items():
-            d = threads.deferToThread(imager.generate_png)
-            d.addErrback(lambda failure: log.err(failure))
-            log.msg("Generating image for %s (%s)" % (name, imager.url))
-            png = yield d
-            if png is not None:
-                self.pngs[name] = png
+        # only queue renders so that a slow render doesn't delay the next
+        # tick for every other dashboard
+        self.refresh_images()
+
+    def record_view(self, name):
+        """Record a view of a dashboard, queueing a priority render if its
+        image is stale or moving its queued render ahead of scheduled
+        ones."""
+        now = self.clock.seconds()
+        self.last_viewed[name] = now
+        if name in self.queued or self.is_stale(name, now):
+            self.queue_render(name, self.PRIORITY_VIEWED)
+
+    def queue_render(self, name, priority=PRIORITY_SCHEDULED):
+        """Queue a render of a dashboard unless one is already queued
+        with at least the same priority or in progress. Returns a Deferred
+        that fires once the dashboard has been rendered."""
+        d = Deferred()
+        self.waiters.setdefault(name, []).append(d)
+        if (name not in self.rendering and
+                priority < self.queued.get(name, priority + 1)):
+            self.queued[name] = priority
+            self.last_rendered[name] = self.clock.seconds()
+            heapq.heappush(self.render_queue,
+                           (priority, next(self._sequence), name))
+            self._dispatch()
+        return d
+
+    def _dispatch(self):
+        while self.render_queue and len(self.rendering) < self.pool_size:
+            priority, _, name = heapq.heappop(self.render_queue)
+            if self.queued.get(name) != priority:
+                # superseded by a higher priority entry
+                continue
+            del self.queued[name]
+            self.rendering.add(name)
+            if self.thread_pool is None:
+                # thread pools can't be restarted once stopped
+                self.thread_pool = ThreadPool(0, self.pool_size,
+                                              "DashboardCache")
+                self.thread_pool.start()
+            imager = self.dashboards[name]
+            log.msg("Generating image for %s (%s)"
+                    % (name, imager.url or "native"))
+            d = threads.deferToThreadPool(reactor, self.thread_pool,
+                                          self._render, name, imager)
+            d.addCallback(self._store_png, name)
+            d.addErrback(log.err)
+            d.addBoth(self._render_done, name)
+
+    def _render_done(self, _result, name):
+        self.rendering.discard(name)
+        for d in self.waiters.pop(name, []):
+            d.callback(None)
+        self._dispatch()
+
+    def variant_keys(self):
+        """Return the `(size, format)` of every image variant."""
+        return [(size, name) for size in sorted(IMAGE_SIZES)
+                for name in self.image_formats]
+
+    def is_variant(self, variant):
+        """Check whether images are kept in the `(size, format)`
+        variant."""
+        if variant[0].startswith("widget-"):
+            return self.widget_images and variant[1] == "png"
+        return variant in self.variant_keys()
+
+    def _render(self, name, imager):
+        """Render an image in a worker thread, encoding its variants and
+        writing them to the store if there is one and it changed.
+
+        Returns `(png, etag, changed, variants, widget_boxes)`, where
+        variants maps `(size, format)` to `(image, etag)`, or None if
+        there's no image.
+        """
+        png = imager.generate_png()
+        if png is None:
+            return None
+        # no other render of this dashboard runs until this one is done
+        boxes = imager.widget_boxes
+        etag = png_etag(hashlib.sha1(png))
+        changed = not self.is_unchanged(name, png, etag)
+        if not changed:
+            return png, etag, changed, {}, boxes
+        encoded = {}
+        if self.image_variants:
+            encoded.update(image_variants(png, self.image_formats))
+        if self.widget_images and boxes:
+            for number, crop in enumerate(crop_widgets(png, boxes), 1):
+                if crop is not None:
+                    encoded[widget_variant(number)] = crop
+        variants = {}
+        for variant, image in encoded.iteritems():
+            variants[variant] = (image, png_etag(hashlib.sha1(image)))
+        if self.store is not None:
+            for variant, image in encoded.iteritems():
+                self.store.write(name, image, variant)
+            self.store.write(name, png)
+            for variant in self.store.variants(name):
+                if variant not in encoded:
+                    self.store.remove(name, variant)
+        return png, etag, changed, variants, boxes
+
+    def is_unchanged(self, name, png, etag):
+        """Check whether png looks the same as the current image of a
+        dashboard."""
+        validators = self.validators.get(name)
+        if validators is None:
+            return False
+        if (not set(self.variant_keys()).issubset(
+                self.variants.get(name, {})) or
+                (self.widget_images and name not in self.widget_boxes)):
+            # e.g. stored before variants or widget images were enabled
+            return False
+        if validators[0] == etag:
+            return True
+        if self.diff_threshold is None:
+            return False
+        current = self.open_png(name)
+        if current is None:
+            return False
+        try:
+            difference = image_difference(current.read(), png)
+        finally:
+            current.close()
+        return difference <= self.diff_threshold
+
+    def _store_png(self, result, name):
+        if result is None:
+            return
+        png, etag, changed, variants, boxes = result
+        if not changed:
+            self.backoff[name] = min(self.backoff.get(name, 1) * 2,
+                                     self.max_backoff)
+            return
+        self.backoff[name] = 1
+        self.validators[name] = (etag, self.clock.seconds())
+        if self.store is not None:
+            png = self.store.path(name)
+            for variant, (_image, variant_etag) in variants.items():
+                variants[variant] = (self.store.path(name, variant),
+                                     variant_etag)
+        self.pngs[name] = png
+        self.variants[name] = variants
+        self.widget_boxes[name] = boxes
+
+    def load_images(self):
+        """Load the images in the store, if there is one."""
+        if self.store is None:
+            return
+        for name in self.dashboards:
+            stored = self.store.load(name)
+            if stored is not None:
+                path, etag, last_modified = stored
+                self.pngs[name] = path
+                self.validators[name] = (etag, last_modified)
+                variants = self.variants[name] = {}
+                for variant in self.store.variants(name):
+                    if not self.is_variant(variant):
+                        continue
+                    stored = self.store.load(name, variant)
+                    if stored is not None:
+                        variants[variant] = stored[:2]
 
     def clear(self):
         for name in self.dashboards:
             self.pngs[name] = None
+        self.validators.clear()
+        self.variants.clear()
+        self.widget_boxes.clear()
 
     def get_png(self, name):
         return self.pngs.get(name)
 
+    def open_png(self, name, variant=None):
+        """Return a file object to read the current image of a dashboard,
+        or its `(size, format)` variant, from, or None if there is no
+        such image."""
+        if variant is None:
+            png = self.pngs.get(name)
+        else:
+            png = self.variants.get(name, {}).get(variant, (None, None))[0]
+        if png is None:
+            return None
+        if self.store is None:
+            return StringIO(png)
+        try:
+            return open(png, "rb")
+        except IOError:
+            log.err(None, "Stored image for %s is unreadable." % (name,))
+            return None
+
+    def get_validators(self, name, variant=None):
+        """Return `(etag, last_modified)` for the current image of a
+        dashboard, or its `(size, format)` variant, or None if there is no
+        such image."""
+        validators = self.validators.get(name)
+        if validators is None or variant is None:
+            return validators
+        if variant not in self.variants.get(name, {}):
+            return None
+        return self.variants[name][variant][1], validators[1]
+
     def start(self):
-        self.update_task_done = self.update_task.start(self.update_interval)
+        self.load_images()
+        tick = min([self.update_interval] + self.intervals.values())
+        self.update_task_done = self.update_task.start(tick)
 
     def stop(self):
+        # drop queued renders, letting the ones in progress finish
+        for name in self.queued:
+            for waiter in self.waiters.pop(name, []):
+                waiter.callback(None)
+        self.queued.clear()
+        del self.render_queue[:]
+        waiting = []
+        for name in self.rendering:
+            waiting.append(Deferred())
+            self.waiters.setdefault(name, []).append(waiting[-1])
         if self.update_task.running:
             self.update_task.stop()
-            return self.update_task_done
+            waiting.append(self.update_task_done)
+        d = gatherResults(waiting)
+        return d.addCallback(lambda _: self._stop_thread_pool())
+
+    def _stop_thread_pool(self):
+        if self.thread_pool is not None:
+            self.thread_pool.stop()
+            self.thread_pool = None
 
 
 class DashboardPngResource(Resource):
+    """Serves dashboard images.
+
+    If the cache has image variants, the `size` query parameter selects
+    one of :data:`IMAGE_SIZES` and the `format` parameter one of
+    :data:`IMAGE_FORMATS`. Without a `format`, WebP is served to clients
+    that accept it.
+
+    If the cache has widget images, `<dashboard>/<n>` serves the n-th
+    widget of a dashboard, counting from 1.
+    """
+
     isLeaf = True
 
     def __init__(self, dashboard_cache):
         Resource.__init__(self)
         self.dashboard_cache = dashboard_cache
 
+    def get_variant(self, request):
+        """Return the `(size, format)` variant requested, or None for the
+        rendered image."""
+        size = request.args.get("size", ["full"])[0]
+        image_format = request.args.get("format", [None])[0]
+        if size not in IMAGE_SIZES:
+            raise ValueError("Unknown image size %r" % (size,))
+        if image_format is not None and image_format not in IMAGE_FORMATS:
+            raise ValueError("Unknown image format %r" % (image_format,))
+        if not self.dashboard_cache.image_variants:
+            if (size, image_format or "png") != ("full", "png"):
+                raise ValueError("Image variants are not enabled")
+            return None
+        request.setHeader("Vary", "Accept")
+        if image_format is None:
+            accept = request.getHeader("Accept") or ""
+            if ("image/webp" in accept and
+                    "webp" in self.dashboard_cache.image_formats):
+                image_format = "webp"
+            else:
+                image_format = "png"
+        elif image_format not in self.dashboard_cache.image_formats:
+            raise ValueError("Image format %r is not supported"
+                             % (image_format,))
+        return size, image_format
+
+    def get_dashboard(self, postpath):
+        """Return the dashboard and widget, or None, named by a path."""
+        dashboard = ".".join(postpath)
+        if dashboard in self.dashboard_cache.pngs or len(postpath) < 2:
+            return dashboard, None
+        return ".".join(postpath[:-1]), postpath[-1]
+
     def render_GET(self, request):
-        dashboard = ".".join(request.postpath)
+        dashboard, widget = self.get_dashboard(request.postpath)
         if dashboard not in self.dashboard_cache.pngs:
             request.setResponseCode(http.NOT_FOUND, "Dashboard not found.")
             request.setHeader("Content-Type", "text/plain")
             return "Dashboard %r not found" % (dashboard,)
-        png = self.dashboard_cache.get_png(dashboard)
+        if widget is not None:
+            if not (self.dashboard_cache.widget_images and widget.isdigit()):
+                return self.widget_not_found(request, dashboard, widget)
+            variant = widget_variant(int(widget))
+        else:
+            try:
+                variant = self.get_variant(request)
+            except ValueError, e:
+                request.setResponseCode(http.BAD_REQUEST,
+                                        "Bad image variant.")
+                request.setHeader("Content-Type", "text/plain")
+                return str(e)
+        self.dashboard_cache.record_view(dashboard)
+        png = self.dashboard_cache.open_png(dashboard, variant)
+        if (png is None and widget is not None and
+                dashboard in self.dashboard_cache.widget_boxes):
+            return self.widget_not_found(request, dashboard, widget)
         if png is None:
             request.setResponseCode(http.SERVICE_UNAVAILABLE, "Dashboard not"
                                     " loaded.")
             request.setHeader("Content-Type", "text/plain")
             return ("Dashboard %r not loaded. Please try again shortly."
                     % (dashboard,))
+        content_type = "image/png"
+        if variant is not None:
+            content_type = IMAGE_FORMATS[variant[1]][0]
         request.setResponseCode(http.OK)
-        request.setHeader("Content-Type", "image/png")
-        return png
+        request.setHeader("Content-Type", content_type)
+        request.setHeader("Cache-Control", "public, max-age=%d"
+                          % (self.dashboard_cache.max_age(dashboard),))
+        etag, last_modified = self.dashboard_cache.get_validators(dashboard,
+                                                                  variant)
+        cached = request.setLastModified(last_modified)
+        if request.getHeader("If-None-Match") is not None:
+            # If-None-Match takes precedence over If-Modified-Since
+            request.setResponseCode(http.OK)
+            cached = request.setETag(etag)
+        else:
+            request.setETag(etag)
+        if cached == http.CACHED:
+            png.close()
+            return ""
+        png.seek(0, os.SEEK_END)
+        request.setHeader("Content-Length", str(png.tell()))
+        png.seek(0)
+        NoRangeStaticProducer(request, png).start()
+        return NOT_DONE_YET
+
+    def widget_not_found(self, request, dashboard, widget):
+        request.setResponseCode(http.NOT_FOUND, "Widget not found.")
+        request.setHeader("Content-Type", "text/plain")
+        return "Widget %r of dashboard %r not found" % (widget, dashboard)
 
 
 class DashboardHtmlResource(Resource):
@@ -228,25 +990,99 @@ class GeckoImageServer(Service):
         Port for the HTTP server to listen on.
     :type selenium_remote: str
     :param selenium_remote:
-        URL of the Selenium server to use.
+        URL of the Selenium server to use. Optional if every dashboard
+        has widgets.
     :type dashboard: dict
     :param dashboard:
         Mapping from dashboard keys (short tags, no spaces or
         characters that need URL escaping) to dashboard configuration
-        dictionaries (should contain keys: url and title).
+        dictionaries (should contain keys: url and title, and may
+        contain update_interval to override the global one and timeout,
+        the number of seconds to wait for the dashboard to load, which
+        defaults to 10). Dashboards of graphite2gecko widgets may give
+        widgets (a list of widget URLs such as `/latest?metric=foo`, or
+        of dictionaries with widget and title keys) and optionally
+        columns instead of url, to be drawn without a browser. See
+        :mod:`vumidash.native_imager`.
     :type update_interval: float
     :param update_interval:
         Number of seconds between dashboard image updates.
         Rendering dashboards takes on the order of tens of seconds
-        so 30s * number of dashboards is a sensible minimum.
+        and up to browser_pool_size dashboards are rendered at once,
+        so 30s * number of dashboards / browser_pool_size is a
+        sensible minimum.
+    :type browser_pool_size: int
+    :param browser_pool_size:
+        Number of browser sessions kept open for rendering dashboards.
+        Optional, defaults to 1.
+    :type browser_max_renders: int
+    :param browser_max_renders:
+        Number of renders after which a browser session is restarted.
+        Optional, defaults to 100.
+    :type image_dir: str
+    :param image_dir:
+        Directory to keep rendered images in. Images found there on
+        start are served until they're rendered again. Optional,
+        images are only kept in memory by default.
+    :type idle_timeout: float
+    :param idle_timeout:
+        Number of seconds without a view after which a dashboard is
+        considered idle. Optional, by default dashboards are never idle.
+    :type idle_interval: float
+    :param idle_interval:
+        Number of seconds between updates of idle dashboards. Optional,
+        by default idle dashboards are only updated when they're viewed
+        again.
+    :type diff_threshold: float
+    :param diff_threshold:
+        Largest fraction of pixels that may differ between renders of a
+        dashboard for it to count as unchanged, e.g. 0.001 to ignore
+        clock widgets. Requires PIL. Optional, by default only identical
+        renders count as unchanged.
+    :type max_backoff: int
+    :param max_backoff:
+        Largest multiple of its update interval that a dashboard which
+        keeps rendering unchanged is slowed down to. Optional, defaults
+        to 1 (no backoff).
+    :type metrics_source: :class:`vumidash.base.MetricSource`
+    :param metrics_source:
+        Source to read the data of dashboards with widgets from. In the
+        YAML configuration file, set graphite_url to the URL of the
+        Graphite web service to read from, or dummy_metrics to true to
+        use dummy data.
+    :type image_variants: bool
+    :param image_variants:
+        Whether to also serve thumbnail and medium sized images and
+        losslessly optimised PNG and WebP encodings, selected with the
+        size and format query parameters or the Accept header. Requires
+        PIL. Optional, defaults to false.
+    :type widget_images: bool
+    :param widget_images:
+        Whether to also serve the image of each widget of a dashboard,
+        cropped from the dashboard's image, at png/<dashboard>/<n> for
+        the n-th widget. Requires PIL. Optional, defaults to false.
     """
 
     def __init__(self, web_path, port, selenium_remote, dashboards,
-                 update_interval):
+                 update_interval, browser_pool_size=1,
+                 browser_max_renders=100, image_dir=None, idle_timeout=None,
+                 idle_interval=None, diff_threshold=None, max_backoff=1,
+                 metrics_source=None, image_variants=False,
+                 widget_images=False):
         self.webserver = None
         self.port = port
-        self.dashboard_cache = DashboardCache(selenium_remote, dashboards,
-                                              update_interval)
+        self.dashboard_cache = DashboardCache(
+            selenium_remote, dashboards, update_interval,
+            pool_size=browser_pool_size,
+            max_renders=browser_max_renders,
+            image_dir=image_dir,
+            idle_timeout=idle_timeout,
+            idle_interval=idle_interval,
+            diff_threshold=diff_threshold,
+            max_backoff=max_backoff,
+            metrics_source=metrics_source,
+            image_variants=image_variants,
+            widget_images=widget_images)
         self.site_factory = Site(ImageServerResource(web_path,
                                                      self.dashboard_cache))
 
@@ -259,5 +1095,6 @@ class GeckoImageServer(Service):
     @inlineCallbacks
     def stopService(self):
         yield self.dashboard_cache.stop()
+        yield threads.deferToThread(self.dashboard_cache.driver_pool.close)
         if self.webserver is not None:
             yield self.webserver.loseConnection()
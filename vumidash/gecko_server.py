@@ -4,6 +4,7 @@
 
 import json
 import copy
+import socket
 from datetime import timedelta
 
 from twisted.application.service import Service
@@ -11,7 +12,15 @@ from twisted.web.server import Site, NOT_DONE_YET
 from twisted.web.resource import Resource
 from twisted.web import http
 from twisted.internet import reactor
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import (
+    inlineCallbacks, maybeDeferred, gatherResults, FirstError, Deferred,
+    CancelledError)
+from twisted.internet.task import LoopingCall
+from twisted.python import log
+from twisted.python.failure import Failure
+
+from vumidash.aggregation import (
+    aggregate_series, latest_values, parse_operator, split_points)
 
 
 def get_value(name, args, default):
@@ -42,83 +51,493 @@ def parse_boolean(name, args, default):
     return True
 
 
+def get_aggregation(name, args):
+    agg = get_value(name, args, None)
+    if agg is not None:
+        parse_operator(agg)
+    return agg
+
+
+def filter_nulls(points, skip_nulls):
+    """Drop null values from points or, if skip_nulls is false, replace
+    them with zeroes."""
+    times, values = split_points(points)
+    if skip_nulls:
+        return [p for p, v in zip(points, values) if v is not None]
+    if times is None:
+        return [v if v is not None else 0.0 for v in values]
+    return [(t, v if v is not None else 0.0) for t, v in zip(times, values)]
+
+
+class RenderJob(object):
+    """Tracks the metric fetches made while rendering a single request.
+
+    :param request: The :class:`twisted.web.server.Request` being rendered.
+    :param queries: List of `(key, fetch, args)` tuples. Each fetch is
+        called with the given args and its result is stored in
+        :attr:`results` under key.
+    """
+
+    def __init__(self, request, queries):
+        self.request = request
+        self.results = {}
+        self.finished = False
+        self.fetches = []
+        for key, fetch, args in queries:
+            d = maybeDeferred(fetch, *args)
+            d.addCallback(self._store_result, key)
+            self.fetches.append(d)
+
+    def _store_result(self, result, key):
+        self.results[key] = result
+        return result
+
+    def outstanding(self):
+        """Return the number of fetches that have not completed yet."""
+        return len(self.fetches) - len(self.results)
+
+    def wait(self):
+        """Return a Deferred that fires once all fetches have completed or
+        errbacks with the first fetch failure."""
+        d = gatherResults(self.fetches, consumeErrors=True)
+        d.addErrback(lambda f: f.value.subFailure if f.check(FirstError)
+                     else f)
+        return d
+
+    def abandon(self):
+        """Cancel all outstanding fetches and return how many there were."""
+        abandoned = self.outstanding()
+        for d in self.fetches:
+            if not d.called:
+                d.cancel()
+        return abandoned
+
+
+class AdmissionController(object):
+    """Decides whether requests may start fetching metrics.
+
+    A request is admitted while fewer than `max_outstanding` upstream
+    fetches are in progress, the reactor is lagging by less than
+    `max_lag` seconds and its client has fewer than its fair share of the
+    outstanding fetches. Otherwise low priority requests wait in a queue
+    for up to `queue_timeout` seconds and other requests are shed.
+
+    :type max_outstanding: int
+    :param max_outstanding: Maximum number of upstream fetches in
+        progress.
+    :type max_lag: float
+    :param max_lag: Maximum reactor lag in seconds. `None` to ignore lag.
+    :type max_client_share: float
+    :param max_client_share: Fraction of max_outstanding a single client
+        IP may use.
+    :type queue_timeout: float
+    :param queue_timeout: Number of seconds low priority requests may
+        wait to be admitted.
+    :type max_queued: int
+    :param max_queued: Maximum number of requests waiting to be
+        admitted.
+    :type retry_after: int
+    :param retry_after: Number of seconds shed clients are asked to wait
+        before retrying.
+    """
+
+    clock = reactor  # testing hook
+
+    ADMIT, QUEUE, SHED = 'admit', 'queue', 'shed'
+
+    LAG_INTERVAL = 0.1
+
+    def __init__(self, max_outstanding=200, max_lag=0.5,
+                 max_client_share=0.5, queue_timeout=5.0, max_queued=100,
+                 retry_after=5):
+        self.max_outstanding = max_outstanding
+        self.max_lag = max_lag
+        self.client_limit = max(1, int(max_outstanding * max_client_share))
+        self.queue_timeout = queue_timeout
+        self.max_queued = max_queued
+        self.retry_after = retry_after
+        self.outstanding = 0
+        self.client_outstanding = {}
+        self.queue = []
+        self.lag = 0.0
+        self.shed = 0
+        self._lag_task = LoopingCall(self._measure_lag)
+        self._lag_task.clock = self.clock
+        self._last_tick = None
+
+    def start(self):
+        if self.max_lag is not None:
+            self._last_tick = self.clock.seconds()
+            self._lag_task.start(self.LAG_INTERVAL, now=False)
+
+    def stop(self):
+        if self._lag_task.running:
+            self._lag_task.stop()
+        for _client, _n, d, timer in self.queue:
+            timer.cancel()
+            d.errback(Failure(OverloadedError("Server stopping.")))
+        del self.queue[:]
+
+    def _measure_lag(self):
+        now = self.clock.seconds()
+        self.lag = max(0.0, now - self._last_tick - self.LAG_INTERVAL)
+        self._last_tick = now
+        if self.queue and not self.overloaded():
+            # the lag may have been all that kept queued requests out
+            self._admit_queued()
+
+    def overloaded(self):
+        if self.outstanding >= self.max_outstanding:
+            return True
+        return self.max_lag is not None and self.lag > self.max_lag
+
+    def can_admit(self, client):
+        return (not self.overloaded() and
+                self.client_outstanding.get(client, 0) < self.client_limit)
+
+    def check(self, client, priority):
+        """Return whether a request from client with the given priority
+        should be admitted, queued or shed."""
+        if self.can_admit(client):
+            return self.ADMIT
+        if priority == 'low' and len(self.queue) < self.max_queued:
+            return self.QUEUE
+        self.shed += 1
+        return self.SHED
+
+    def acquire(self, client, fetches):
+        self.outstanding += fetches
+        self.client_outstanding[client] = (
+            self.client_outstanding.get(client, 0) + fetches)
+
+    def release(self, client, fetches=1):
+        self.outstanding -= fetches
+        remaining = self.client_outstanding[client] - fetches
+        if remaining > 0:
+            self.client_outstanding[client] = remaining
+        else:
+            del self.client_outstanding[client]
+        self._admit_queued()
+
+    def enqueue(self, client, fetches):
+        """Return a Deferred that fires once the request is admitted or
+        errbacks with :class:`OverloadedError` if it waits too long."""
+        entry = [client, fetches, None, None]
+        d = entry[2] = Deferred(lambda _: self._unqueue(entry))
+        entry[3] = self.clock.callLater(self.queue_timeout,
+                                        self._queue_timed_out, entry)
+        self.queue.append(entry)
+        return d
+
+    def _unqueue(self, entry):
+        if entry in self.queue:
+            self.queue.remove(entry)
+            entry[3].cancel()
+
+    def _queue_timed_out(self, entry):
+        self.queue.remove(entry)
+        self.shed += 1
+        entry[2].errback(Failure(OverloadedError("Timed out in queue.")))
+
+    def _admit_queued(self):
+        # admit the oldest request from each client that is under its
+        # share so one busy client can't starve the others
+        for entry in self.queue[:]:
+            client, fetches, d, timer = entry
+            if not self.can_admit(client):
+                continue
+            self.queue.remove(entry)
+            timer.cancel()
+            self.acquire(client, fetches)
+            d.callback(None)
+
+
+class OverloadedError(Exception):
+    """Raised when a request is shed by an :class:`AdmissionController`."""
+
+
 class GeckoboardResourceBase(Resource):
+    """Base class for resources that serve Geckoboard widget data.
+
+    Every request is finished within `timeout` seconds. Sub-classes
+    describe the metric fetches a request needs via :meth:`get_queries`
+    and build the JSON response from the fetched results via
+    :meth:`format_data`.
+
+    :param metrics_source: The :class:`vumidash.base.MetricSource` to read
+        metrics from.
+    :type timeout: float
+    :param timeout: Number of seconds a request may take before it is
+        finished according to the timeout policy. `None` disables the
+        deadline.
+    :type timeout_policy: str
+    :param timeout_policy: Default action for requests that miss their
+        deadline. One of `error` (respond with a 504), `partial`
+        (respond with the results that arrived in time) or `stale`
+        (respond with the last successful response for the same URL or
+        a 504 if there isn't one). Widgets may override this with the
+        `on_timeout` query parameter.
+    :type admission: :class:`AdmissionController`
+    :param admission: Controller deciding whether requests may start
+        fetching metrics. Shed requests are answered with stale data if
+        their timeout policy is `stale` or a 503 otherwise. Widgets may
+        pass `priority=low` to wait for capacity instead of being shed.
+        `None` admits every request.
+    """
+
     isLeaf = True
 
-    def __init__(self, metrics_source):
+    clock = reactor  # testing hook
+
+    TIMEOUT_POLICIES = ('error', 'partial', 'stale')
+    STALE_CACHE_SIZE = 1000
+
+    def __init__(self, metrics_source, timeout=None, timeout_policy='error',
+                 admission=None):
         Resource.__init__(self)
+        if timeout_policy not in self.TIMEOUT_POLICIES:
+            raise ValueError("Unknown timeout policy %r" % (timeout_policy,))
         self.metrics_source = metrics_source
+        self.timeout = timeout
+        self.timeout_policy = timeout_policy
+        self.admission = admission
+        self.stale_data = {}
+        self.abandoned = 0
 
-    @inlineCallbacks
     def do_render_GET(self, request):
-        json_data = yield self.get_data(request)
-        request.setResponseCode(http.OK)
-        request.setHeader("content-type", "application/json")
-        request.write(json.dumps(json_data))
-        request.finish()
+        try:
+            queries = self.get_queries(request)
+            policy = get_value('on_timeout', request.args,
+                               self.timeout_policy)
+            if policy not in self.TIMEOUT_POLICIES:
+                raise ValueError("Unknown timeout policy %r" % (policy,))
+        except (KeyError, ValueError), e:
+            self.finish_error(request, http.BAD_REQUEST, "Bad request.",
+                              "Bad request: %s" % (e,))
+            return
+
+        if self.admission is None:
+            return self.start_job(request, queries, policy)
+        client = request.getClientIP()
+        priority = get_value('priority', request.args, 'normal')
+        decision = self.admission.check(client, priority)
+        if decision == AdmissionController.ADMIT:
+            self.admission.acquire(client, len(queries))
+            return self.start_job(request, queries, policy, client)
+        elif decision == AdmissionController.QUEUE:
+            d = self.admission.enqueue(client, len(queries))
+            request.notifyFinish().addErrback(lambda _: d.cancel())
+            d.addCallbacks(
+                lambda _: self.start_job(request, queries, policy, client),
+                self._queue_failed, errbackArgs=(request, policy))
+            return d
+        self.shed_request(request, policy)
+
+    def start_job(self, request, queries, policy, client=None):
+        job = RenderJob(request, queries)
+        if client is not None:
+            for fetch_d in job.fetches:
+                fetch_d.addBoth(self._fetch_settled, client)
+        timer = None
+        if self.timeout is not None:
+            timer = self.clock.callLater(self.timeout, self.timed_out,
+                                         job, policy)
+        request.notifyFinish().addErrback(self.connection_lost, job, timer)
+        d = job.wait()
+        d.addCallback(lambda _: self.format_data(request, job.results))
+        d.addCallbacks(self.fetched, self.fetch_failed,
+                       callbackArgs=(job, timer), errbackArgs=(job, timer))
+        return d
+
+    def get_aggregate(self, target, from_dt, until_dt, step_dt, agg):
+        """Fetch every series matching target at once and aggregate them
+        with the operator agg."""
+        d = maybeDeferred(self.metrics_source.get_series, target, from_dt,
+                          until_dt, step_dt)
+        step_seconds = self.metrics_source.total_seconds(step_dt)
+        return d.addCallback(
+            lambda series: aggregate_series(agg, series, step_seconds))
+
+    def _fetch_settled(self, result, client):
+        self.admission.release(client)
+        return result
+
+    def _queue_failed(self, failure, request, policy):
+        if not failure.check(CancelledError):
+            self.shed_request(request, policy)
+
+    def shed_request(self, request, policy):
+        if policy == 'stale' and request.uri in self.stale_data:
+            request.setHeader("x-vumidash-stale", "true")
+            request.setResponseCode(http.OK)
+            request.setHeader("content-type", "application/json")
+            request.write(json.dumps(self.stale_data[request.uri]))
+            request.finish()
+            return
+        request.setHeader("retry-after", str(self.admission.retry_after))
+        self.finish_error(request, http.SERVICE_UNAVAILABLE,
+                          "Server overloaded.",
+                          "Server overloaded. Please retry later.")
 
     def render_GET(self, request):
         self.do_render_GET(request)
         return NOT_DONE_YET
 
-    def get_data(self, request):
-        raise NotImplementedError("Sub-classes should implement get_data")
+    def get_queries(self, request):
+        """Return the list of `(key, fetch, args)` metric fetches needed
+        to render request."""
+        raise NotImplementedError("Sub-classes should implement get_queries")
+
+    def format_data(self, request, results):
+        """Return the JSON data for request built from results, a dict
+        mapping query keys to fetched values. Keys of fetches that did not
+        complete in time are missing from results."""
+        raise NotImplementedError("Sub-classes should implement format_data")
+
+    def _cancel_timer(self, timer):
+        if timer is not None and timer.active():
+            timer.cancel()
+
+    def fetched(self, json_data, job, timer):
+        self._cancel_timer(timer)
+        if job.finished:
+            return
+        self.store_stale(job.request, json_data)
+        self.finish_json(job, json_data)
+
+    def fetch_failed(self, failure, job, timer):
+        self._cancel_timer(timer)
+        if job.finished:
+            return
+        log.err(failure, "Failed to fetch metrics for %r"
+                % (job.request.uri,))
+        job.finished = True
+        self.abandoned += job.abandon()
+        self.finish_error(job.request, http.BAD_GATEWAY,
+                          "Metric fetch failed.",
+                          "Failed to fetch metrics: %s"
+                          % (failure.getErrorMessage(),))
+
+    def timed_out(self, job, policy):
+        if job.finished:
+            return
+        job.finished = True
+        results = job.results.copy()
+        self.abandoned += job.abandon()
+        if policy == 'partial':
+            json_data = self.format_data(job.request, results)
+            job.request.setHeader("x-vumidash-partial", "true")
+            self.finish_json(job, json_data)
+        elif policy == 'stale' and job.request.uri in self.stale_data:
+            job.request.setHeader("x-vumidash-stale", "true")
+            self.finish_json(job, self.stale_data[job.request.uri])
+        else:
+            self.finish_error(job.request, http.GATEWAY_TIMEOUT,
+                              "Metric fetch timed out.",
+                              "Timed out fetching metrics.")
+
+    def connection_lost(self, failure, job, timer):
+        self._cancel_timer(timer)
+        if not job.finished:
+            job.finished = True
+            self.abandoned += job.abandon()
+
+    def store_stale(self, request, json_data):
+        if (request.uri not in self.stale_data and
+                len(self.stale_data) >= self.STALE_CACHE_SIZE):
+            self.stale_data.popitem()
+        self.stale_data[request.uri] = json_data
+
+    def finish_json(self, job, json_data):
+        job.finished = True
+        request = job.request
+        request.setResponseCode(http.OK)
+        request.setHeader("content-type", "application/json")
+        request.write(json.dumps(json_data))
+        request.finish()
+
+    def finish_error(self, request, code, message, body):
+        request.setResponseCode(code, message)
+        request.setHeader("content-type", "text/plain")
+        request.write(body)
+        request.finish()
 
 
 class GeckoboardLatestResource(GeckoboardResourceBase):
 
     def aggregate_results(self, results):
+        if not results:
+            return (0, 0)
         latest, prev = zip(*results)
         return (sum(v for v in latest if v is not None),
                 sum(v for v in prev if v is not None))
 
-    @inlineCallbacks
-    def get_data(self, request):
+    def get_aggregate_latest(self, target, from_dt, until_dt, step_dt,
+                             agg):
+        d = self.get_aggregate(target, from_dt, until_dt, step_dt, agg)
+        return d.addCallback(lambda series: self.aggregate_results(
+            [latest_values(points) for _name, points in series]))
+
+    def get_queries(self, request):
         metrics = request.args['metric']
         step_dt = parse_timedelta('step', request.args, '5min')
         from_dt = parse_timedelta('from', request.args, '-1d')
         until_dt = parse_timedelta('until', request.args, '-0s')
-        results = []
-        for metric in metrics:
-            m_results = yield self.metrics_source.get_latest(
-                metric, from_dt, until_dt, step_dt)
-            results.append(m_results)
-        prev, latest = self.aggregate_results(results)
+        agg = get_aggregation('agg', request.args)
+        if agg is not None:
+            return [(i, self.get_aggregate_latest,
+                     (metric, from_dt, until_dt, step_dt, agg))
+                    for i, metric in enumerate(metrics)]
+        return [(i, self.metrics_source.get_latest,
+                 (metric, from_dt, until_dt, step_dt))
+                for i, metric in enumerate(metrics)]
+
+    def format_data(self, request, results):
+        prev, latest = self.aggregate_results(
+            [results[i] for i in sorted(results)])
         data = {"item": [
             {"text": "", "value": latest},
             {"text": "", "value": prev},
             ]}
-        returnValue(data)
+        return data
 
 
 class GeckoboardRagResource(GeckoboardResourceBase):
 
     RAG_NAMES = {"r": "Red", "a": "Amber", "g": "Green"}
+    RAG_PREFIXES = ["r", "a", "g"]
 
-    @inlineCallbacks
-    def get_data(self, request):
+    def get_queries(self, request):
         step_dt = parse_timedelta('step', request.args, '5min')
         from_dt = parse_timedelta('from', request.args, '-1d')
         until_dt = parse_timedelta('until', request.args, '-0s')
 
-        items = []
-        for arg_prefix in ["r", "a", "g"]:
+        queries = []
+        for arg_prefix in self.RAG_PREFIXES:
             metric = get_value("%s_metric" % arg_prefix, request.args, None)
-            prefix = get_value("%s_prefix" % arg_prefix, request.args, None)
-            text = get_value("%s_text" % arg_prefix, request.args,
-                             self.RAG_NAMES[arg_prefix])
             if metric is None:
                 raise ValueError("Missing required parameter %s_metric"
                                  % arg_prefix)
-            _prev, latest = yield self.metrics_source.get_latest(
-                    metric, from_dt, until_dt, step_dt)
+            queries.append((arg_prefix, self.metrics_source.get_latest,
+                            (metric, from_dt, until_dt, step_dt)))
+        return queries
+
+    def format_data(self, request, results):
+        items = []
+        for arg_prefix in self.RAG_PREFIXES:
+            if arg_prefix not in results:
+                continue
+            prefix = get_value("%s_prefix" % arg_prefix, request.args, None)
+            text = get_value("%s_text" % arg_prefix, request.args,
+                             self.RAG_NAMES[arg_prefix])
+            _prev, latest = results[arg_prefix]
             item = {"text": text, "value": latest}
             if prefix is not None:
                 item["prefix"] = prefix
             items.append(item)
 
         data = {"item": items}
-        returnValue(data)
+        return data
 
 
 class GeckoboardHighchartResource(GeckoboardResourceBase):
@@ -154,56 +573,118 @@ class GeckoboardHighchartResource(GeckoboardResourceBase):
         'type': 'line',
         }
 
-    @inlineCallbacks
-    def get_data(self, request):
+    def get_queries(self, request):
         metrics = request.args['metric']
         if 'label' in request.args:
-            labels = request.args['label']
-            assert len(labels) == len(metrics)
-        else:
-            labels = metrics
+            if len(request.args['label']) != len(metrics):
+                raise ValueError("Expected one label per metric")
         from_dt = parse_timedelta('from', request.args, '-1d')
         until_dt = parse_timedelta('until', request.args, '-0s')
         step_dt = parse_timedelta('step', request.args, '5min')
+        skip_nulls = parse_boolean('skip_nulls', request.args, 'true')
+        agg = get_aggregation('agg', request.args)
+        if agg is not None:
+            return [(i, self.get_aggregate,
+                     (metric, from_dt, until_dt, step_dt, agg))
+                    for i, metric in enumerate(metrics)]
+        return [(i, self.metrics_source.get_history,
+                 (metric, from_dt, until_dt, step_dt, skip_nulls))
+                for i, metric in enumerate(metrics)]
+
+    def get_series_data(self, request, label, result):
+        """Return `(name, data)` pairs for the series in result."""
+        if get_value('agg', request.args, None) is None:
+            return [(label, result)]
+        skip_nulls = parse_boolean('skip_nulls', request.args, 'true')
+        series = []
+        for name, points in result:
+            if name is None:
+                name = label
+            series.append((name, filter_nulls(points, skip_nulls)))
+        return series
+
+    def format_data(self, request, results):
+        metrics = request.args['metric']
+        labels = request.args.get('label', metrics)
         y_min = parse_float('ymin', request.args, None)
         show_markers = parse_boolean('markers', request.args, 'false')
-        skip_nulls = parse_boolean('skip_nulls', request.args, 'true')
         ylabel = get_value('ylabel', request.args, None)
         data = copy.deepcopy(self.HIGHCHART_BASE)
         data['yAxis']['min'] = y_min
         data['yAxis']['title'] = {'text': ylabel}
         data['plotOptions']['line']['marker']['enabled'] = show_markers
-        for label, metric in zip(labels, metrics):
-            series = copy.deepcopy(self.SERIES_BASE)
-            series['name'] = label
-            series['data'] = yield self.metrics_source.get_history(
-                                        metric, from_dt, until_dt, step_dt,
-                                        skip_nulls)
-            data['series'].append(series)
-        returnValue(data)
+        for i, label in enumerate(labels):
+            if i not in results:
+                continue
+            for name, points in self.get_series_data(request, label,
+                                                     results[i]):
+                series = copy.deepcopy(self.SERIES_BASE)
+                series['name'] = name
+                series['data'] = points
+                data['series'].append(series)
+        return data
 
 
 class GeckoboardResource(Resource):
 
-    def __init__(self, metrics_source):
+    def __init__(self, metrics_source, timeout=None, timeout_policy='error',
+                 admission=None):
         Resource.__init__(self)
-        self.putChild('latest', GeckoboardLatestResource(metrics_source))
-        self.putChild('rag', GeckoboardRagResource(metrics_source))
-        self.putChild('history', GeckoboardHighchartResource(metrics_source))
+        for name, resource_cls in [
+                ('latest', GeckoboardLatestResource),
+                ('rag', GeckoboardRagResource),
+                ('history', GeckoboardHighchartResource)]:
+            self.putChild(name, resource_cls(metrics_source, timeout,
+                                             timeout_policy, admission))
 
 
 class GeckoServer(Service):
-    def __init__(self, metrics_source, port):
+    """Service that serves metrics as Geckoboard widget JSON.
+
+    :param metrics_source: The :class:`vumidash.base.MetricSource` to read
+        metrics from.
+    :type port: int
+    :param port: Port for the HTTP server to listen on.
+    :type timeout: float
+    :param timeout: Number of seconds each request may take. `None` to
+        disable request deadlines.
+    :type timeout_policy: str
+    :param timeout_policy: What to respond with when a request misses its
+        deadline (`error`, `partial` or `stale`).
+    :type listen_fd: int
+    :param listen_fd: File descriptor of an already listening TCP socket
+        to accept connections on instead of listening on port. Used by
+        :class:`vumidash.gecko_workers.GeckoWorkerPool` workers.
+    :type admission: :class:`AdmissionController`
+    :param admission: Controller used to shed load when too many upstream
+        fetches are in progress. `None` to admit every request.
+    """
+
+    def __init__(self, metrics_source, port, timeout=30.0,
+                 timeout_policy='error', listen_fd=None, admission=None):
         self.webserver = None
+        self.metrics_source = metrics_source
         self.port = port
-        self.site_factory = Site(GeckoboardResource(metrics_source))
+        self.listen_fd = listen_fd
+        self.admission = admission
+        self.site_factory = Site(GeckoboardResource(
+            metrics_source, timeout, timeout_policy, admission))
 
     @inlineCallbacks
     def startService(self):
-        self.webserver = yield reactor.listenTCP(self.port,
-                                                 self.site_factory)
+        if self.admission is not None:
+            self.admission.start()
+        if self.listen_fd is not None:
+            self.webserver = yield reactor.adoptStreamPort(
+                self.listen_fd, socket.AF_INET, self.site_factory)
+        else:
+            self.webserver = yield reactor.listenTCP(self.port,
+                                                     self.site_factory)
 
     @inlineCallbacks
     def stopService(self):
+        if self.admission is not None:
+            self.admission.stop()
         if self.webserver is not None:
             yield self.webserver.loseConnection()
+        self.metrics_source.close()
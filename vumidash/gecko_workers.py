@@ -0,0 +1,173 @@
+# -*- test-case-name: vumidash.tests.test_gecko_workers -*-
+
+"""Serve Geckoboard data from several worker processes.
+
+   The parent process opens the listening HTTP socket and passes it to
+   each worker process, so all the workers accept connections on the same
+   port. Workers read metrics from a :class:`CachingMetricSource` served
+   by the parent over a UNIX socket, so adding workers doesn't multiply
+   the load on the upstream metric source.
+   """
+
+import os
+import sys
+import shutil
+import socket
+import tempfile
+
+from twisted.internet import reactor
+from twisted.python import log, usage
+
+from vumidash.gecko_server import GeckoServer, AdmissionController
+from vumidash.metric_cache import (
+    CachingMetricSource, MetricSourceServerFactory, RemoteMetricSource)
+from vumidash.process_supervisor import ProcessSupervisor
+
+
+class GeckoWorkerPool(ProcessSupervisor):
+    """Service that runs several :class:`GeckoServer` worker processes
+    accepting connections on a shared port.
+
+    :type metrics_source: :class:`vumidash.base.MetricSource`
+    :param metrics_source: Source to read metrics from. Only the parent
+        process reads from it.
+    :type port: int
+    :param port: Port for the HTTP server to listen on.
+    :type workers: int
+    :param workers: Number of worker processes to run.
+    :type timeout: float
+    :param timeout: Request deadline passed on to each worker's
+        :class:`GeckoServer`.
+    :type timeout_policy: str
+    :param timeout_policy: Timeout policy passed on to each worker's
+        :class:`GeckoServer`.
+    :type cache_ttl: float
+    :param cache_ttl: Number of seconds the shared cache holds metric
+        results for.
+    :type max_outstanding: int
+    :param max_outstanding: Maximum number of upstream fetches in progress
+        in each worker before it sheds requests. 0 admits every request.
+    :type max_lag: float
+    :param max_lag: Maximum reactor lag in seconds in each worker before
+        it sheds requests.
+    """
+
+    process_name = "worker"
+
+    def __init__(self, metrics_source, port, workers, timeout=30.0,
+                 timeout_policy='error', cache_ttl=30.0, max_outstanding=0,
+                 max_lag=0.5):
+        ProcessSupervisor.__init__(self, workers)
+        self.port = port
+        self.timeout = timeout
+        self.timeout_policy = timeout_policy
+        self.max_outstanding = max_outstanding
+        self.max_lag = max_lag
+        self.cache = CachingMetricSource(metrics_source, cache_ttl)
+        self.socket = None
+        self.socket_dir = None
+        self.cache_server = None
+
+    @property
+    def workers(self):
+        return self.processes
+
+    def listen(self):
+        """Open the listening socket shared by the workers."""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('', self.port))
+        sock.listen(socket.SOMAXCONN)
+        sock.setblocking(False)
+        return sock
+
+    def get_port(self):
+        """Return the port number the workers are accepting connections
+        on."""
+        return self.socket.getsockname()[1]
+
+    @property
+    def cache_socket_path(self):
+        return os.path.join(self.socket_dir, "metric-cache.sock")
+
+    def worker_args(self):
+        args = [sys.executable, "-m", "vumidash.gecko_workers",
+                "--listen-fd", "3",
+                "--cache-socket", self.cache_socket_path,
+                "--timeout-policy", self.timeout_policy,
+                "--max-outstanding", str(self.max_outstanding),
+                "--max-lag", str(self.max_lag)]
+        if self.timeout is not None:
+            args.extend(["--timeout", str(self.timeout)])
+        return args
+
+    def process_args(self, index):
+        return self.worker_args()
+
+    def child_fds(self):
+        return {0: "w", 1: "r", 2: "r", 3: self.socket.fileno()}
+
+    def startService(self):
+        self.socket_dir = tempfile.mkdtemp(prefix="vumidash-")
+        self.cache_server = self.clock.listenUNIX(
+            self.cache_socket_path, MetricSourceServerFactory(self.cache))
+        self.socket = self.listen()
+        ProcessSupervisor.startService(self)
+
+    def processes_stopped(self):
+        ProcessSupervisor.processes_stopped(self)
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+        d = self.cache_server.stopListening()
+        d.addCallback(lambda _: self._remove_socket_dir())
+        d.addCallback(lambda _: self.cache.close())
+        return d
+
+    def _remove_socket_dir(self):
+        if self.socket_dir is not None:
+            shutil.rmtree(self.socket_dir, ignore_errors=True)
+            self.socket_dir = None
+
+
+class WorkerOptions(usage.Options):
+    optParameters = [
+        ["listen-fd", None, None, "File descriptor of the listening socket"
+                                  " to accept connections on.", int],
+        ["cache-socket", None, None, "Path of the UNIX socket of the shared"
+                                     " metric cache."],
+        ["timeout", None, None, "Number of seconds a request may take.",
+         float],
+        ["timeout-policy", None, "error", "What to return when a request"
+                                          " times out."],
+        ["max-outstanding", None, 0, "Maximum number of upstream fetches in"
+                                     " progress.", int],
+        ["max-lag", None, 0.5, "Maximum reactor lag in seconds.", float],
+    ]
+
+    def postOptions(self):
+        if self["listen-fd"] is None or self["cache-socket"] is None:
+            raise usage.UsageError("--listen-fd and --cache-socket are"
+                                   " required")
+
+
+def main(argv=None):
+    """Run a single worker process."""
+    options = WorkerOptions()
+    options.parseOptions(argv if argv is not None else sys.argv[1:])
+    log.startLogging(sys.stdout, setStdout=False)
+    metrics_source = RemoteMetricSource(options["cache-socket"])
+    admission = None
+    if options["max-outstanding"] > 0:
+        admission = AdmissionController(options["max-outstanding"],
+                                        options["max-lag"])
+    server = GeckoServer(metrics_source, None, timeout=options["timeout"],
+                         timeout_policy=options["timeout-policy"],
+                         listen_fd=options["listen-fd"], admission=admission)
+    reactor.callWhenRunning(server.startService)
+    reactor.addSystemEventTrigger("before", "shutdown", server.stopService)
+    reactor.run()
+
+
+if __name__ == "__main__":
+    main()
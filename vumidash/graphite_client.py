@@ -5,7 +5,7 @@ from StringIO import StringIO
 from urllib import quote
 from twisted.web.client import Agent
 from twisted.internet import reactor
-from twisted.internet.defer import Deferred
+from twisted.internet.defer import Deferred, gatherResults, maybeDeferred
 from twisted.internet.protocol import Protocol
 
 from vumidash.base import MetricSource
@@ -39,6 +39,32 @@ def all_datapoints(response):
     return datapoints
 
 
+def all_series(response):
+    series = []
+    for target in response:
+        datapoints = [(t * 1000, v) for v, t in target['datapoints']]
+        series.append((summarized_name(target['target']), datapoints))
+    return series
+
+
+def summarized_name(name):
+    """Strip the summarize() call added by format_metric from a series
+    name. Names that don't look like one are returned unchanged."""
+    if name.startswith('summarize(') and ', "' in name:
+        try:
+            return name[len('summarize('):name.rindex(', "', 0,
+                                                      name.rindex(', "'))]
+        except ValueError:
+            pass
+    return name
+
+
+def is_pattern(metric):
+    """Check whether metric may return series named differently from it,
+    as wildcards and function calls do."""
+    return any(c in metric for c in '*?[{(')
+
+
 def filter_datapoints(response):
     return [(t, v) for t, v in all_datapoints(response) if v is not None]
 
@@ -60,17 +86,25 @@ class GraphiteClient(MetricSource):
 
     metric_template = 'summarize(%s, "%s", "%s")'
 
+    # maximum number of targets fetched in one request
+    MAX_TARGETS = 50
+
     def __init__(self, url):
         self.url = url
 
     def make_graphite_request(self, target, start, end, summary_size):
+        """Fetch target from Graphite. target may also be a list of
+        targets to fetch in one request."""
+        targets = target if isinstance(target, list) else [target]
         t_from = self.make_graphite_timedelta(start)
         t_until = self.make_graphite_timedelta(end)
         t_summary = self.make_graphite_timedelta(summary_size)
+        target_params = '&'.join(
+            'target=%s' % quote(self.format_metric(t, t_summary))
+            for t in targets)
         agent = Agent(reactor)
-        url = '%s/render?format=json&target=%s&from=%s&until=%s' % (
-            self.url, quote(self.format_metric(target, t_summary)),
-            t_from, t_until)
+        url = '%s/render?format=json&%s&from=%s&until=%s' % (
+            self.url, target_params, t_from, t_until)
         print "URL:", url
         d = agent.request('GET', url)
         return d.addCallback(GraphiteDataReader.get_response)
@@ -82,19 +116,84 @@ class GraphiteClient(MetricSource):
             return '-0s'
         return '%ds' % totalseconds
 
-    def format_metric(self, metric, t_summary):
+    def aggregation_method(self, metric):
+        """Return the method Graphite should use to summarize metric."""
         agg_method = "avg"
         last_bit = metric.rstrip(')').split('.')[-1]
         if last_bit in ('max', 'min', 'sum', 'last'):
             agg_method = last_bit
         if metric.startswith("integral("):
             agg_method = 'max'
+        return agg_method
+
+    def format_metric(self, metric, t_summary):
+        agg_method = self.aggregation_method(metric)
         return self.metric_template % (metric, t_summary, agg_method)
 
     def get_latest(self, metric, start, end, summary_size, skip_nulls=True):
         d = self.get_history(metric, start, end, summary_size, skip_nulls)
         return d.addCallback(filter_latest)
 
+    def get_series(self, target, start, end, summary_size):
+        d = self.make_graphite_request(target, start, end, summary_size)
+        return d.addCallback(all_series)
+
+    def get_latest_many(self, metrics, start, end, summary_size):
+        """Fetch the latest values of several metrics sharing a time range
+        with as few requests as possible.
+
+        Plain metrics are fetched up to `MAX_TARGETS` per request. The
+        metrics of a request that fails, and metrics whose series may be
+        named differently from them (see :func:`is_pattern`), are fetched
+        on their own so that one bad metric doesn't fail the others.
+
+        Returns a Deferred firing with a dict mapping each metric to its
+        `(first, last)` values, or to a Failure if fetching it failed.
+        """
+        plain = [metric for metric in metrics if not is_pattern(metric)]
+        fetches = [self._get_latest_each(
+            [metric for metric in metrics if is_pattern(metric)],
+            start, end, summary_size)]
+        for i in range(0, len(plain), self.MAX_TARGETS):
+            fetches.append(self._get_latest_batch(
+                plain[i:i + self.MAX_TARGETS], start, end, summary_size))
+
+        def merge(results):
+            latest = {}
+            for result in results:
+                latest.update(result)
+            return latest
+        return gatherResults(fetches).addCallback(merge)
+
+    def _get_latest_batch(self, metrics, start, end, summary_size):
+        def latest_by_metric(response):
+            latest = dict((metric, (None, None)) for metric in metrics)
+            for target in response:
+                metric = summarized_name(target['target'])
+                if metric in latest:
+                    latest[metric] = filter_latest(
+                        filter_datapoints([target]))
+            return latest
+
+        def fetch_each(failure):
+            if len(metrics) == 1:
+                return {metrics[0]: failure}
+            return self._get_latest_each(metrics, start, end, summary_size)
+        d = maybeDeferred(self.make_graphite_request, metrics, start, end,
+                          summary_size)
+        d.addCallback(latest_by_metric)
+        return d.addErrback(fetch_each)
+
+    def _get_latest_each(self, metrics, start, end, summary_size):
+        latest = {}
+
+        def store(result, metric):
+            latest[metric] = result
+        fetches = [maybeDeferred(self.get_latest, metric, start, end,
+                                 summary_size).addBoth(store, metric)
+                   for metric in metrics]
+        return gatherResults(fetches).addCallback(lambda _: latest)
+
     def get_history(self, metric, start, end, summary_size, skip_nulls=True):
         d = self.make_graphite_request(metric, start, end, summary_size)
         point_filter = (filter_datapoints if skip_nulls
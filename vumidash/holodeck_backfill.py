@@ -0,0 +1,335 @@
+# -*- test-case-name: vumidash.tests.test_holodeck_backfill -*-
+
+"""Backfill Holodeck pushes missed while the pusher wasn't running.
+
+   :class:`PushState` records the time of the last successful push of
+   each sample set in a JSON file. On startup :class:`Backfill` works out
+   which ticks each set missed since then, fetches the history of each of
+   its metrics over the whole gap with a single `get_history` call and
+   pushes the missed ticks in order at a limited rate.
+
+   Live pushes of a set being backfilled are held back in the state until
+   its backfill finishes, and backfill pushes only advance the state
+   across the contiguous range of acknowledged ticks, so that a pusher
+   stopped part way through a backfill picks up the rest of the gap when
+   it restarts.
+   """
+
+import os
+import json
+import math
+from datetime import datetime, timedelta
+
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    Deferred, DeferredList, gatherResults, maybeDeferred)
+from twisted.internet.task import LoopingCall
+from twisted.python import log
+
+from vumidash.aggregation import split_points
+
+
+class PushState(object):
+    """Times of the last successful push of each sample set.
+
+    :type path: str
+    :param path: JSON file to keep the state in.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.last_push = {}
+        self.held = {}
+        self.dirty = False
+
+    def _key(self, server, api_key):
+        return "%s %s" % (server, api_key)
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "rb") as f:
+                self.last_push = json.load(f)
+        except ValueError:
+            log.err(None, "Ignoring unreadable push state %r." % (self.path,))
+            self.last_push = {}
+
+    def save(self):
+        """Write the state to disk if it changed since the last save."""
+        if not self.dirty:
+            return
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            json.dump(self.last_push, f)
+        os.rename(tmp_path, self.path)
+        self.dirty = False
+
+    def get(self, server, api_key):
+        """Return the time of the last push for server and API key or
+        `None` if there wasn't one."""
+        return self.last_push.get(self._key(server, api_key))
+
+    def record(self, server, api_key, t):
+        """Record a successful push for the tick at t.
+
+        Pushes for a held set are only recorded once it is released.
+        """
+        key = self._key(server, api_key)
+        if key in self.held:
+            self.held[key] = max(t, self.held[key])
+            return
+        self._advance(key, t)
+
+    def record_backfill(self, server, api_key, t):
+        """Record a successful backfill push for the tick at t, whether or
+        not the set is held."""
+        self._advance(self._key(server, api_key), t)
+
+    def hold(self, server, api_key):
+        """Hold back pushes recorded for a set until :meth:`release`."""
+        self.held.setdefault(self._key(server, api_key), None)
+
+    def release(self, server, api_key):
+        """Record the newest push held back for a set and stop holding
+        it."""
+        t = self.held.pop(self._key(server, api_key), None)
+        if t is not None:
+            self._advance(self._key(server, api_key), t)
+
+    def _advance(self, key, t):
+        if t > self.last_push.get(key, t - 1):
+            self.last_push[key] = t
+            self.dirty = True
+
+
+def value_before(points, t_ms):
+    """Return the newest non-null value of a `(timestamp_in_ms, value)`
+    series whose timestamp is before t_ms, or 0.0 if there is none."""
+    value = 0.0
+    for timestamp, point_value in points:
+        if timestamp >= t_ms:
+            break
+        if point_value is not None:
+            value = point_value
+    return value
+
+
+class Backfill(object):
+    """Push the ticks each sample set missed since its last push.
+
+    :type metrics_source: :class:`vumidash.base.MetricSource`
+    :param metrics_source: Source to read metric history from.
+    :type sender: :class:`vumidash.holodeck_pusher.HoloClientPool`
+    :param sender: Pool (or spool) to send pushes with.
+    :type state: :class:`PushState`
+    :param state: Times of the last push of each set.
+    :type rate: float
+    :param rate: Maximum number of backfill pushes per second.
+    :type max_gap: float
+    :param max_gap: Only ticks this many seconds before the start of the
+        backfill or newer are pushed.
+
+    A tick whose backfill push fails is logged and skipped rather than
+    retried, so that every set is released once all of its pushes have
+    been attempted.
+    """
+
+    clock = reactor  # testing hook
+
+    def __init__(self, metrics_source, sender, state, rate=10.0,
+                 max_gap=24 * 60 * 60):
+        self.metrics_source = metrics_source
+        self.sender = sender
+        self.state = state
+        self.rate = rate
+        self.max_gap = max_gap
+        self.pending = []
+        self.pushed = 0
+        self.failed = 0
+        self.progress = {}
+        self._sending = set()
+        self._sender_task = None
+        self._done = None
+        self._finishing = False
+
+    def missed_ticks(self, sample_set, now):
+        """Return the aligned times of the ticks sample_set missed."""
+        last = self.state.get(sample_set.server, sample_set.api_key)
+        if last is None:
+            return []
+        frequency = sample_set.frequency
+        first = max(last, now - self.max_gap)
+        tick = (math.floor(first / frequency) + 1) * frequency
+        # ticks from the next scheduled push on are pushed as usual
+        scheduled = sample_set.aligned(sample_set.next(now))
+        ticks = []
+        while tick < scheduled:
+            ticks.append(tick)
+            tick += frequency
+        return ticks
+
+    def history_query(self, query, first_tick, now):
+        """Return the `get_history` arguments covering every tick of a
+        sample's query from first_tick up to now."""
+        metric, from_dt, until_dt, step_dt = query
+        start = timedelta(seconds=int(math.floor(first_tick - now)))
+        return (metric, start + from_dt, until_dt, step_dt)
+
+    def fetch_history(self, query, now):
+        """Fetch the history for query as `(timestamp_in_ms, value)`
+        pairs."""
+        metric, from_dt, until_dt, step_dt = query
+        step = self.metrics_source.total_seconds(step_dt)
+        # keep nulls so that bare values stay evenly spaced
+        d = maybeDeferred(self.metrics_source.get_history, metric, from_dt,
+                          until_dt, step_dt, False)
+        return d.addCallback(self._with_timestamps, now, step)
+
+    def _with_timestamps(self, history, now, step):
+        times, values = split_points(history)
+        if times is None:
+            # evenly spaced values ending with the newest bucket
+            newest = math.floor(now / step) * step
+            times = [(newest - (len(values) - 1 - i) * step) * 1000
+                     for i in range(len(values))]
+        return zip(times, values)
+
+    def build_pushes(self, sample_set, ticks, histories):
+        """Return `(tick, sample_set, samples)` for each missed tick of
+        sample_set."""
+        pushes = []
+        for tick in ticks:
+            samples = []
+            for sample in sample_set.samples:
+                end = tick + self.metrics_source.total_seconds(
+                    sample.until_dt)
+                history = histories[sample.query()]
+                samples.append([sample.holo,
+                                value_before(history, end * 1000)])
+            pushes.append((tick, sample_set, samples))
+        return pushes
+
+    def start(self, sample_sets):
+        """Work out and push the ticks every set in sample_sets missed.
+
+        The history of each distinct sample query is fetched once, from
+        the earliest tick any set using it missed. Sets with missed ticks
+        are held in the state until all of them have been pushed. Returns
+        a Deferred that fires with the number of ticks pushed once all
+        backfill pushes sent have finished.
+        """
+        now = self.clock.seconds()
+        plans = []
+        first_ticks = {}
+        for sample_set in sample_sets:
+            ticks = self.missed_ticks(sample_set, now)
+            if not ticks:
+                continue
+            plans.append((sample_set, ticks))
+            self.state.hold(sample_set.server, sample_set.api_key)
+            # ticks not yet acknowledged and acknowledged out of order
+            self.progress[(sample_set.server, sample_set.api_key)] = (
+                list(ticks), set())
+            for sample in sample_set.samples:
+                query = sample.query()
+                first_ticks[query] = min(ticks[0],
+                                         first_ticks.get(query, ticks[0]))
+        fetches = {}
+        for query, first_tick in first_ticks.iteritems():
+            fetches[query] = self.fetch_history(
+                self.history_query(query, first_tick, now), now)
+        histories = {}
+        for query, d in fetches.iteritems():
+            d.addCallbacks(self._fetched, self._fetch_failed,
+                           callbackArgs=(query, histories),
+                           errbackArgs=(query,))
+        self._done = Deferred()
+        self._finishing = False
+        d = gatherResults(fetches.values())
+        d.addCallback(lambda _: self._send_all(plans, histories))
+        return self._done
+
+    def _fetched(self, history, query, histories):
+        histories[query] = history
+
+    def _fetch_failed(self, failure, query):
+        log.err(failure, "Fetching history of %s to backfill failed."
+                % (query[0],))
+
+    def _send_all(self, plans, histories):
+        pushes = []
+        for sample_set, ticks in plans:
+            if not all(sample.query() in histories
+                       for sample in sample_set.samples):
+                # skip sets with missing history rather than push zeros
+                self._release(sample_set)
+                continue
+            pushes.extend(self.build_pushes(sample_set, ticks, histories))
+        # pending is popped from the end, oldest tick first
+        self.pending = sorted(pushes, key=lambda push: push[0],
+                              reverse=True)
+        if not self.pending:
+            self._finish()
+            return
+        log.msg("Backfilling %d missed Holodeck pushes." % (
+            len(self.pending),))
+        self._sender_task = LoopingCall(self._send_next)
+        self._sender_task.clock = self.clock
+        self._sender_task.start(1.0 / self.rate)
+
+    def _send_next(self):
+        if not self.pending:
+            self.stop()
+            return
+        tick, sample_set, samples = self.pending.pop()
+        d = self.sender.send(sample_set.server, api_key=sample_set.api_key,
+                             samples=samples,
+                             timestamp=datetime.fromtimestamp(tick))
+        d.addCallbacks(self._sent, self._send_failed,
+                       callbackArgs=(tick, sample_set),
+                       errbackArgs=(tick, sample_set))
+        self._sending.add(d)
+        d.addBoth(lambda _: self._sending.discard(d))
+
+    def _sent(self, _result, tick, sample_set):
+        self.pushed += 1
+        self._acknowledge(tick, sample_set)
+
+    def _send_failed(self, failure, tick, sample_set):
+        self.failed += 1
+        log.err(failure, "Backfill push failed.")
+        # skip the tick so that the set's later ticks can be recorded
+        self._acknowledge(tick, sample_set)
+
+    def _acknowledge(self, tick, sample_set):
+        ticks, acked = self.progress[(sample_set.server, sample_set.api_key)]
+        acked.add(tick)
+        while ticks and ticks[0] in acked:
+            acked.discard(ticks[0])
+            self.state.record_backfill(sample_set.server, sample_set.api_key,
+                                       ticks.pop(0))
+        if not ticks:
+            self._release(sample_set)
+
+    def _release(self, sample_set):
+        self.progress.pop((sample_set.server, sample_set.api_key), None)
+        self.state.release(sample_set.server, sample_set.api_key)
+
+    def _finish(self):
+        if self._done is None or self._finishing:
+            return
+        self._finishing = True
+        d = DeferredList(list(self._sending))
+        d.addCallback(lambda _: self._done.callback(self.pushed))
+
+    def stop(self):
+        """Stop sending backfill pushes. The Deferred returned by
+        :meth:`start` fires once the pushes already sent have finished.
+
+        Sets whose backfill didn't finish stay held, so the state keeps
+        the last tick they were backfilled up to.
+        """
+        if self._sender_task is not None and self._sender_task.running:
+            self._sender_task.stop()
+        self._finish()
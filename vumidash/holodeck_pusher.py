@@ -2,16 +2,39 @@
 
 """Service that pushes metrics to Holodeck."""
 
-import heapq
+import os
 import math
+import signal
+import hashlib
+from functools import partial
 from datetime import datetime, timedelta
 
 from twisted.application.service import Service
 from twisted.internet.defer import (
-    inlineCallbacks, gatherResults, maybeDeferred)
+    inlineCallbacks, gatherResults, maybeDeferred, DeferredSemaphore,
+    Deferred, CancelledError)
 from twisted.python import log
+from twisted.python.failure import Failure
 from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from twisted.internet.threads import deferToThread
 from photon.txclient import TxClient
+import yaml
+
+from vumidash.holodeck_spool import HoloSpool
+from vumidash.holodeck_backfill import PushState, Backfill
+from vumidash.scheduler import HeapScheduler, TimingWheel
+
+
+def key_digest(server, api_key):
+    """Return a stable hex digest identifying a server and API key."""
+    return hashlib.md5("%s\0%s" % (server, api_key)).hexdigest()
+
+
+def shard_of(server, api_key, shard_count):
+    """Return the shard in `range(shard_count)` that pushes the sample set
+    for server and API key."""
+    return int(key_digest(server, api_key), 16) % shard_count
 
 
 class HoloSample(object):
@@ -39,13 +62,244 @@ class HoloSample(object):
         params.update(config)
         return cls(**params)
 
+    def query(self):
+        """Return the `(metric, from_dt, until_dt, step_dt)` query used to
+        fetch this sample."""
+        return (self.metric, self.from_dt, self.until_dt, self.step_dt)
+
+
+class FetchPlan(object):
+    """Fetches each distinct query needed by the sample sets due at the
+    same time once and shares the results between them.
+
+    A plan stands in for the metric source when pushing its sample sets.
+    Queries sharing a time range are fetched with a single
+    `get_latest_many` call if the metric source provides one.
+
+    :type metrics_source: :class:`vumidash.base.MetricSource`
+    :param metrics_source: Source to read metrics from.
+    :type sample_sets: list of :class:`HoloSamples`
+    :param sample_sets: Sample sets due at the same time.
+    """
+
+    def __init__(self, metrics_source, sample_sets):
+        self.metrics_source = metrics_source
+        self.queries = set()
+        for sample_set in sample_sets:
+            for sample in sample_set.samples:
+                self.queries.add(sample.query())
+        self.fetches = 0
+        self._results = {}
+        self._waiters = {}
+
+    def start(self):
+        """Start fetching every query in the plan."""
+        ranges = {}
+        for query in self.queries:
+            self._waiters[query] = []
+            ranges.setdefault(query[1:], []).append(query[0])
+        get_many = getattr(self.metrics_source, 'get_latest_many', None)
+        for time_range, metrics in ranges.iteritems():
+            if get_many is not None and len(metrics) > 1:
+                d = maybeDeferred(get_many, metrics, *time_range)
+                d.addBoth(self._fetched_many, metrics, time_range)
+                self.fetches += 1
+                continue
+            for metric in metrics:
+                d = maybeDeferred(self.metrics_source.get_latest,
+                                  metric, *time_range)
+                d.addBoth(self._fetched, (metric,) + time_range)
+                self.fetches += 1
+
+    def _fetched_many(self, result, metrics, time_range):
+        for metric in metrics:
+            query = (metric,) + time_range
+            if isinstance(result, Failure):
+                self._fetched(result, query)
+            else:
+                self._fetched(result.get(metric, (None, None)), query)
+
+    def _fetched(self, result, query):
+        self._results[query] = result
+        for d in self._waiters.pop(query):
+            self._fire(d, result)
+
+    def _fire(self, d, result):
+        # waiters may have been cancelled by a sample timeout
+        if d.called:
+            return
+        if isinstance(result, Failure):
+            d.errback(result)
+        else:
+            d.callback(result)
+
+    def get_latest(self, metric, from_dt, until_dt, step_dt):
+        query = (metric, from_dt, until_dt, step_dt)
+        d = Deferred()
+        if query in self._results:
+            self._fire(d, self._results[query])
+        elif query in self._waiters:
+            self._waiters[query].append(d)
+        else:
+            return self.metrics_source.get_latest(*query)
+        return d
+
+
+class HoloClientPool(object):
+    """Keeps one long-lived :class:`TxClient` per Holodeck server, shared
+    by every API key pushed to that server.
+
+    :type max_sends: int
+    :param max_sends: Maximum number of sends in progress to each server
+        at once. `None` doesn't limit sends.
+    """
+
+    def __init__(self, max_sends=None):
+        self.max_sends = max_sends
+        self._clients = {}
+        self._limits = {}
+        self.stats = {}
+
+    def get_client(self, server):
+        """Return the client for server, creating it if necessary."""
+        client = self._clients.get(server)
+        if client is None:
+            client = self._clients[server] = TxClient(server)
+            self.stats[server] = {
+                'clients': 1, 'sends': 0, 'client_hits': 0, 'failed': 0,
+                'in_flight': 0,
+                }
+        return client
+
+    def _send(self, server, **kw):
+        client = self.get_client(server)
+        stats = self.stats[server]
+        if stats['sends']:
+            stats['client_hits'] += 1
+        stats['sends'] += 1
+        stats['in_flight'] += 1
+
+        def done(result):
+            stats['in_flight'] -= 1
+            if isinstance(result, Failure):
+                stats['failed'] += 1
+            return result
+        return maybeDeferred(client.send, **kw).addBoth(done)
+
+    def send(self, server, **kw):
+        """Send samples to server using its pooled client. Keyword
+        arguments are passed on to :meth:`TxClient.send`."""
+        if self.max_sends is None:
+            return self._send(server, **kw)
+        limit = self._limits.get(server)
+        if limit is None:
+            limit = self._limits[server] = DeferredSemaphore(self.max_sends)
+        return limit.run(self._send, server, **kw)
+
+    def get_stats(self):
+        """Return a dict mapping each server to a copy of its statistics.
+
+        `clients` is the number of clients created, `sends` the number of
+        sends made, `client_hits` the number of those handed an existing
+        client (whether its connection was reused is up to the client),
+        `failed` the number that failed and `in_flight` the number still
+        in progress.
+        """
+        return dict((server, stats.copy())
+                    for server, stats in self.stats.iteritems())
+
 
 class HoloSamples(object):
-    def __init__(self, server, api_key, frequency, samples):
+    """A set of samples pushed to one Holodeck server and API key.
+
+    :type server: str
+    :param server: URL of the Holodeck server.
+    :type api_key: str
+    :param api_key: Holodeck API key to push samples to.
+    :type frequency: float
+    :param frequency: Number of seconds between pushes.
+    :type samples: list of :class:`HoloSample`
+    :param samples: Samples to push.
+    :type concurrency: int
+    :param concurrency: Maximum number of samples to fetch at once.
+        `None` fetches all samples at once.
+    :type sample_timeout: float
+    :param sample_timeout: Number of seconds to wait for a sample before
+        pushing 0.0 for it instead. `None` waits indefinitely.
+    :type overrun: str
+    :param overrun: What to do when a tick arrives while the previous push
+        is still in progress. `skip` drops the tick, `coalesce` pushes
+        once for the newest missed tick when the previous push finishes
+        and `overlap` pushes anyway.
+    :type push_timeout: float
+    :param push_timeout: Number of seconds to wait for a push to finish
+        before giving up on it, so that a hung fetch or send doesn't hold
+        back later ticks. Defaults to the frequency unless overrun is
+        `overlap`, in which case pushes are waited for indefinitely.
+    :type jitter: float
+    :param jitter: Fraction of the period to spread pushes over. Each set
+        is pushed at a fixed offset into its period, derived from its
+        server and API key. Timestamps sent to Holodeck stay aligned to
+        the start of the period.
+    """
+
+    clock = reactor  # testing hook
+
+    OVERRUN_POLICIES = ('skip', 'coalesce', 'overlap')
+
+    def __init__(self, server, api_key, frequency, samples, concurrency=None,
+                 sample_timeout=None, overrun='skip', jitter=0.0,
+                 push_timeout=None):
+        if overrun not in self.OVERRUN_POLICIES:
+            raise ValueError("Unknown overrun policy %r" % (overrun,))
+        if not 0 <= jitter < 1:
+            raise ValueError("Jitter must be at least 0 and less than 1")
         self.server = server
         self.api_key = api_key
         self.frequency = float(frequency)
         self.samples = samples
+        self.concurrency = concurrency
+        self.sample_timeout = sample_timeout
+        self.overrun = overrun
+        self.jitter = jitter
+        if push_timeout is None and overrun != 'overlap':
+            push_timeout = self.frequency
+        self.push_timeout = push_timeout
+        self.offset = self.phase(server, api_key) * jitter * self.frequency
+        self.fetch_latency = None
+        self.push_latency = None
+        self.in_flight = 0
+        self.pending_tick = None
+        self.retired = False
+        self.successor = None
+        self.stats = {
+            'pushes': 0, 'dropped_ticks': 0, 'coalesced': 0, 'timed_out': 0,
+            'lag': None, 'max_lag': 0.0,
+            }
+
+    def take_over(self, old):
+        """Carry the statistics and pushes in progress of old, the set
+        this one replaces on reload, over to this set."""
+        self.stats = old.stats
+        self.in_flight = old.in_flight
+        self.pending_tick = old.pending_tick
+        self.fetch_latency = old.fetch_latency
+        self.push_latency = old.push_latency
+        old.pending_tick = None
+        old.successor = self
+
+    def current(self):
+        """Return the set that replaced this one on reload, or this set if
+        it hasn't been replaced."""
+        sample = self
+        while sample.successor is not None:
+            sample = sample.successor
+        return sample
+
+    def record_lag(self, lag):
+        """Record how late a tick for this set was processed."""
+        self.stats['lag'] = lag
+        self.stats['max_lag'] = max(self.stats['max_lag'], lag)
 
     def __eq__(self, other):
         if not isinstance(other, self.__class__):
@@ -53,27 +307,73 @@ class HoloSamples(object):
         return (self.server == other.server and
                 self.api_key == other.api_key and
                 self.frequency == other.frequency and
-                self.samples == other.samples)
+                self.samples == other.samples and
+                self.concurrency == other.concurrency and
+                self.sample_timeout == other.sample_timeout and
+                self.overrun == other.overrun and
+                self.jitter == other.jitter and
+                self.push_timeout == other.push_timeout)
+
+    @staticmethod
+    def phase(server, api_key):
+        """Return a number in [0, 1) derived from server and API key."""
+        return int(key_digest(server, api_key)[:13], 16) / float(16 ** 13)
 
     def next(self, now):
-        return (math.floor(now / self.frequency) + 1) * self.frequency
+        """Return the time of the first push after now."""
+        return ((math.floor((now - self.offset) / self.frequency) + 1) *
+                self.frequency + self.offset)
+
+    def aligned(self, t):
+        """Return the start of the period pushed at t."""
+        return t - self.offset
+
+    def fetch_sample(self, sample, metrics_source):
+        d = maybeDeferred(metrics_source.get_latest, sample.metric,
+                          sample.from_dt, sample.until_dt, sample.step_dt)
+        if self.sample_timeout is not None:
+            timer = self.clock.callLater(self.sample_timeout, d.cancel)
+
+            def cancel_timer(result):
+                if timer.active():
+                    timer.cancel()
+                return result
+            d.addBoth(cancel_timer)
+        # replace failures with 0 values
+        d.addErrback(lambda f: [0.0])
+        # 'or 0.0' is to protect against case where None is returned for
+        # the metric value (e.g. when a Graphite metric is missing)
+        d.addCallback(lambda values: [sample.holo, values[-1] or 0.0])
+        return d
+
+    def fetch_samples(self, metrics_source):
+        """Fetch all samples at once, at most `concurrency` at a time."""
+        if self.concurrency is None:
+            fetch = self.fetch_sample
+        else:
+            fetch = partial(DeferredSemaphore(self.concurrency).run,
+                            self.fetch_sample)
+        return gatherResults([fetch(sample, metrics_source)
+                              for sample in self.samples])
 
     @inlineCallbacks
-    def push(self, now, metrics_source):
-        client = TxClient(self.server)
-        holo_samples = []
-        for sample in self.samples:
-            d = maybeDeferred(metrics_source.get_latest, sample.metric,
-                              sample.from_dt, sample.until_dt, sample.step_dt)
-            # replace failures with 0 values
-            d.addErrback(lambda f: [0.0])
-            values = yield d
-            # 'or 0.0' is to protect against case where None is returned for
-            # the metric value (e.g. when a Graphite metric is missing)
-            holo_samples.append([sample.holo, values[-1] or 0.0])
-        yield client.send(samples=holo_samples,
-                          api_key=self.api_key,
-                          timestamp=datetime.fromtimestamp(now))
+    def push(self, now, metrics_source, client_pool=None):
+        """Fetch all samples and push them to Holodeck.
+
+        Samples are sent using client_pool (or a
+        :class:`vumidash.holodeck_spool.HoloSpool`) if given, otherwise
+        with a new client.
+        """
+        started = self.clock.seconds()
+        holo_samples = yield self.fetch_samples(metrics_source)
+        self.fetch_latency = self.clock.seconds() - started
+        kw = dict(samples=holo_samples, api_key=self.api_key,
+                  timestamp=datetime.fromtimestamp(now))
+        if client_pool is None:
+            yield TxClient(self.server).send(**kw)
+        else:
+            yield client_pool.send(self.server, **kw)
+        self.push_latency = self.clock.seconds() - started
 
 
 class HolodeckPusher(object):
@@ -85,25 +385,82 @@ class HolodeckPusher(object):
 
     :type samples: list of :class:`HoloSamples`
     :param samples: List of sample sets to push to Holodeck(s).
+
+    :type client_pool: :class:`HoloClientPool`
+    :param client_pool: Pool of Holodeck clients to push with. Defaults
+        to a pool that doesn't limit sends.
+
+    :type spool: :class:`vumidash.holodeck_spool.HoloSpool`
+    :param spool: Spool to keep failed pushes in until they can be
+        replayed. Failed pushes are dropped if this is `None`.
+
+    :type max_outstanding: int
+    :param max_outstanding: Maximum number of pushes in progress across
+        all sample sets. Ticks arriving while this many pushes are in
+        progress are dropped. `None` doesn't limit pushes.
+
+    :type scheduler: str
+    :param scheduler: Scheduler to time pushes with, `heap` or `wheel`.
+        The timing wheel makes one reactor call per second however many
+        sample sets there are, at the cost of pushing up to a second
+        late. See :mod:`vumidash.scheduler`.
+
+    :type state: :class:`vumidash.holodeck_backfill.PushState`
+    :param state: Record of the last successful push of each sample set,
+        loaded on start and saved every `STATE_SAVE_INTERVAL` seconds.
+
+    :type backfill: :class:`vumidash.holodeck_backfill.Backfill`
+    :param backfill: Backfill to push the ticks missed since the last
+        successful push of each set with on start. Requires state.
     """
 
     clock = reactor  # testing hook
 
-    def __init__(self, metrics_source, samples):
+    STATE_SAVE_INTERVAL = 10.0
+
+    SCHEDULERS = {
+        'heap': HeapScheduler,
+        'wheel': TimingWheel,
+        }
+
+    def __init__(self, metrics_source, samples, client_pool=None,
+                 spool=None, max_outstanding=None, scheduler='heap',
+                 state=None, backfill=None):
+        if scheduler not in self.SCHEDULERS:
+            raise ValueError("Unknown scheduler %r" % (scheduler,))
         self.metrics_source = metrics_source
         self.samples = samples
-        self._next_call = None
-        self._next_heap = None
+        self.client_pool = (client_pool if client_pool is not None
+                            else HoloClientPool())
+        self.spool = spool
+        self.max_outstanding = max_outstanding
+        self.running = False
+        self.scheduler_name = scheduler
+        self.scheduler = None
+        self.state = state
+        self.backfill = backfill
+        self._save_task = None
         self._waiting = set()
 
     @classmethod
-    def from_config(cls, metrics_source, config):
+    def from_config(cls, metrics_source, config, client_pool=None,
+                    spool=None, max_outstanding=None, jitter=0.0,
+                    scheduler='heap', shard_index=0, shard_count=1):
         """Construct a HolodeckPusher from a metric source and
         a configuration dictionary.
 
         :type metric_source: :class:`vumidash.base.MetricSource`
         :param metric_source: Source to read metrics from.
 
+        :type client_pool: :class:`HoloClientPool`
+        :param client_pool: Pool of Holodeck clients to push with.
+
+        :type spool: :class:`vumidash.holodeck_spool.HoloSpool`
+        :param spool: Spool to keep failed pushes in.
+
+        :type max_outstanding: int
+        :param max_outstanding: Maximum number of pushes in progress.
+
         :param dict config: Cofiguration dictionary. Top-level keys
             are Holodeck server URLs. Second-level keys are API
             keys. Each API key is associated with a frequency and a
@@ -126,66 +483,409 @@ class HolodeckPusher(object):
                    ],
                 },
             }}
+
+            A sample set may also set `concurrency` (the maximum number
+            of metrics to fetch at once), `sample_timeout` (seconds to
+            wait for a metric before pushing 0.0 for it), `overrun`
+            (`skip`, `coalesce` or `overlap`), `push_timeout` (seconds to
+            wait for a push to finish) and `jitter` (fraction of the
+            period to spread pushes over). See :class:`HoloSamples`.
+
+        :type jitter: float
+        :param jitter: Default jitter for sample sets that don't set one.
+
+        :type scheduler: str
+        :param scheduler: Scheduler to time pushes with.
+
+        :type shard_index: int
+        :param shard_index: Index of this pusher's shard. Only sample sets
+            whose server and API key hash to this shard are pushed.
+
+        :type shard_count: int
+        :param shard_count: Number of shards sample sets are split over.
         """
+        return cls(metrics_source,
+                   cls.samples_from_config(config, jitter, shard_index,
+                                           shard_count),
+                   client_pool, spool, max_outstanding, scheduler)
+
+    @staticmethod
+    def samples_from_config(config, jitter=0.0, shard_index=0,
+                            shard_count=1):
+        """Return the list of :class:`HoloSamples` in shard_index described
+        by config. See :meth:`from_config` for the format of config."""
         samples_list = []
         for server, server_defn in config.iteritems():
             for api_key, sample_defn in server_defn.iteritems():
+                if shard_of(server, api_key, shard_count) != shard_index:
+                    continue
                 frequency = sample_defn['frequency']
                 sample_defaults = sample_defn.get('sample_defaults', {})
                 samples = [HoloSample.from_config(s, sample_defaults)
                            for s in sample_defn['samples']]
-                samples_list.append(HoloSamples(server, api_key, frequency,
-                                                samples))
-        return cls(metrics_source, samples_list)
+                samples_list.append(HoloSamples(
+                    server, api_key, frequency, samples,
+                    concurrency=sample_defn.get('concurrency'),
+                    sample_timeout=sample_defn.get('sample_timeout'),
+                    overrun=sample_defn.get('overrun', 'skip'),
+                    jitter=sample_defn.get('jitter', jitter),
+                    push_timeout=sample_defn.get('push_timeout')))
+        return samples_list
+
+    def reload(self, samples):
+        """Replace the running sample sets with samples.
+
+        Sample sets are matched by server and API key. Unchanged sets keep
+        running on their existing schedule, changed sets are rescheduled
+        and keep their statistics and pushes in progress (see
+        :meth:`HoloSamples.take_over`), and removed sets stop being
+        pushed. Pushes in progress are left to finish.
+
+        Returns a tuple of the numbers of sets added, changed and removed.
+        """
+        now = self.clock.seconds()
+        current = dict(((sample.server, sample.api_key), sample)
+                       for sample in self.samples)
+        added = changed = 0
+        new_samples = []
+        for sample in samples:
+            old = current.pop((sample.server, sample.api_key), None)
+            if old is not None and old == sample:
+                new_samples.append(old)
+                continue
+            if old is not None:
+                old.retired = True
+                sample.take_over(old)
+                changed += 1
+            else:
+                added += 1
+            new_samples.append(sample)
+            if self.scheduler is not None:
+                self.scheduler.schedule(sample.next(now), sample)
+        for sample in current.itervalues():
+            sample.retired = True
+        self.samples = new_samples
+        log.msg("Reloaded Holodeck sample sets: %d added, %d changed,"
+                " %d removed." % (added, changed, len(current)))
+        return added, changed, len(current)
+
+    def reload_config(self, config, jitter=0.0, shard_index=0,
+                      shard_count=1):
+        """Replace the running sample sets with those in shard_index
+        described by config. See :meth:`reload`."""
+        return self.reload(self.samples_from_config(
+            config, jitter, shard_index, shard_count))
 
     def _add_waiting(self, d):
         self._waiting.add(d)
         d.addErrback(lambda f: log.err(f))
         d.addBoth(lambda r: self._waiting.discard(d))
 
-    def _create_next_heap(self):
+    def _process_due(self, due):
         now = self.clock.seconds()
-        self._next_heap = [(sample.next(now), sample) for sample in
-                           self.samples]
-        heapq.heapify(self._next_heap)
+        admitted = []
+        for t, sample in due:
+            if sample.retired:
+                continue
+            self.scheduler.schedule(sample.next(t), sample)
+            sample.record_lag(now - t)
+            if self._admit(sample, t, len(admitted)):
+                admitted.append((t, sample))
+        self._push(admitted)
+
+    def _admit(self, sample, now, starting=0):
+        """Return whether to push sample for the tick at now, given that
+        `starting` other pushes are about to start."""
+        if sample.in_flight and sample.overrun != 'overlap':
+            if sample.overrun == 'coalesce':
+                if sample.pending_tick is not None:
+                    sample.stats['dropped_ticks'] += 1
+                sample.pending_tick = now
+            else:
+                sample.stats['dropped_ticks'] += 1
+            return False
+        if self._at_limit(starting):
+            sample.stats['dropped_ticks'] += 1
+            return False
+        return True
 
-    def _call_next_later(self):
-        next_time, sample = heapq.heappop(self._next_heap)
-        now = self.clock.seconds()
-        self._next_call = self.clock.callLater(
-            max(next_time - now, 0), self._process_next, next_time, sample)
+    def _at_limit(self, starting=0):
+        return (self.max_outstanding is not None and
+                len(self._waiting) + starting >= self.max_outstanding)
 
-    def _process_next(self, now, sample):
-        heapq.heappush(self._next_heap, (sample.next(now), sample))
-        try:
-            d = sample.push(now, self.metrics_source)
+    def _push(self, due):
+        """Push each `(time, sample)` pair in due, sharing fetches between
+        them."""
+        if not due:
+            return
+        plan = FetchPlan(self.metrics_source,
+                         [sample for _t, sample in due])
+        plan.start()
+        sender = self.spool if self.spool is not None else self.client_pool
+        for now, sample in due:
+            try:
+                d = sample.push(sample.aligned(now), plan, sender)
+            except Exception:
+                log.err()
+                continue
+            sample.in_flight += 1
+            sample.stats['pushes'] += 1
+            if self.state is not None:
+                d.addCallback(self._record_push, sample, sample.aligned(now))
+            if sample.push_timeout is not None:
+                self._time_out(d, sample)
             self._add_waiting(d)
-        except Exception:
-            log.err()
-        self._call_next_later()
+            d.addCallback(self._push_done, sample)
+
+    def _time_out(self, d, sample):
+        """Give up on the push d of sample after its push timeout."""
+        timer = self.clock.callLater(sample.push_timeout, d.cancel)
+
+        def cancel_timer(result):
+            if timer.active():
+                timer.cancel()
+            return result
+
+        def timed_out(failure):
+            failure.trap(CancelledError)
+            sample.stats['timed_out'] += 1
+            log.msg("Push to %s for API key %s timed out after %ss."
+                    % (sample.server, sample.api_key, sample.push_timeout))
+        d.addBoth(cancel_timer)
+        d.addErrback(timed_out)
+
+    def _record_push(self, result, sample, t):
+        self.state.record(sample.server, sample.api_key, t)
+        return result
+
+    def _push_done(self, _result, sample):
+        # the set may have been replaced while the push was in progress
+        sample = sample.current()
+        sample.in_flight -= 1
+        if (self.running and sample.pending_tick is not None and
+                not sample.in_flight and not sample.retired):
+            now, sample.pending_tick = sample.pending_tick, None
+            if self._at_limit():
+                sample.stats['dropped_ticks'] += 1
+                return
+            sample.stats['coalesced'] += 1
+            self._push([(now, sample)])
+
+    def get_stats(self):
+        """Return a dict mapping each `(server, api_key)` to statistics for
+        its sample set.
+
+        `pushes` is the number of pushes started, `dropped_ticks` the
+        number of ticks dropped because of overruns or the outstanding
+        push limit, `coalesced` the number of pushes made for missed
+        ticks, `timed_out` the number of pushes given up on after the
+        push timeout, `lag` and `max_lag` the latest and largest number
+        of seconds a tick was processed late and `in_flight` the number
+        of pushes in progress.
+        """
+        stats = {}
+        for sample in self.samples:
+            stats[(sample.server, sample.api_key)] = dict(
+                sample.stats, in_flight=sample.in_flight,
+                fetch_latency=sample.fetch_latency,
+                push_latency=sample.push_latency)
+        return stats
 
     def start(self):
-        if not self.samples:
-            return
-        self._create_next_heap()
-        self._call_next_later()
+        self.running = True
+        if self.spool is not None:
+            self.spool.start()
+        self.scheduler = self.SCHEDULERS[self.scheduler_name](
+            self.clock, self._process_due)
+        now = self.clock.seconds()
+        for sample in self.samples:
+            self.scheduler.schedule(sample.next(now), sample)
+        self.scheduler.start()
+        if self.state is not None:
+            self.state.load()
+            self._save_task = LoopingCall(self.state.save)
+            self._save_task.clock = self.clock
+            self._save_task.start(self.STATE_SAVE_INTERVAL, now=False)
+            if self.backfill is not None:
+                self._add_waiting(self.backfill.start(self.samples))
 
     @inlineCallbacks
     def stop(self):
-        if self._next_call is not None and self._next_call.active():
-            self._next_call.cancel()
+        self.running = False
+        if self.scheduler is not None:
+            self.scheduler.stop()
+        if self.backfill is not None:
+            self.backfill.stop()
         yield gatherResults(self._waiting)
+        if self.spool is not None:
+            yield self.spool.stop()
+        if self._save_task is not None and self._save_task.running:
+            self._save_task.stop()
+        if self.state is not None:
+            self.state.save()
+
+
+def load_config(config_file):
+    """Read a Holodeck pusher config from a YAML file."""
+    with open(config_file) as f:
+        return yaml.safe_load(f.read())
 
 
 class HolodeckPusherService(Service):
-    def __init__(self, metrics_source, config):
-        self.holodeck_pusher = HolodeckPusher.from_config(metrics_source,
-                                                          config)
+    """Service that runs a :class:`HolodeckPusher`.
+
+    If config_file is given, the config is reloaded from it when the
+    process receives SIGHUP and, if watch_interval is given, whenever the
+    file is modified. The file is read and parsed in a thread so that
+    large configs don't block the reactor.
+
+    If shard_count is more than 1, only the sample sets in shard
+    shard_index are pushed (see :func:`shard_of`), so that several
+    services given the same config push every sample set exactly once.
+
+    If state_file is given, the time of the last successful push of each
+    sample set is kept in it and ticks missed while the service wasn't
+    running (up to max_backfill seconds ago) are pushed on start, at most
+    backfill_rate per second.
+
+    If stats_interval is given, a summary of the pusher's and spool's
+    statistics is logged every stats_interval seconds (see
+    :meth:`log_stats`).
+    """
+
+    clock = reactor  # testing hook
+
+    def __init__(self, metrics_source, config, max_sends=None,
+                 spool_dir=None, spool_max_bytes=10 * 1024 * 1024,
+                 max_outstanding=None, jitter=0.0, scheduler='heap',
+                 config_file=None, watch_interval=None, shard_index=0,
+                 shard_count=1, state_file=None, backfill_rate=10.0,
+                 max_backfill=24 * 60 * 60, stats_interval=None):
+        self.config_file = config_file
+        self.watch_interval = watch_interval
+        self.stats_interval = stats_interval
+        self._stats_task = None
+        self.jitter = jitter
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        self._config_mtime = None
+        self._watch = None
+        self._reloading = False
+        self._reload_again = False
+        client_pool = HoloClientPool(max_sends)
+        spool = None
+        if spool_dir is not None:
+            spool = HoloSpool(client_pool, spool_dir, spool_max_bytes)
+        self.holodeck_pusher = HolodeckPusher.from_config(
+            metrics_source, config, client_pool, spool, max_outstanding,
+            jitter, scheduler, shard_index, shard_count)
+        if state_file is not None:
+            state = PushState(state_file)
+            sender = spool if spool is not None else client_pool
+            self.holodeck_pusher.state = state
+            self.holodeck_pusher.backfill = Backfill(
+                metrics_source, sender, state, backfill_rate, max_backfill)
 
     @inlineCallbacks
     def startService(self):
+        Service.startService(self)
+        if self.config_file is not None:
+            self._config_mtime = self._get_config_mtime()
+            signal.signal(signal.SIGHUP, self._sighup)
+            if self.watch_interval:
+                self._watch = LoopingCall(self.check_config)
+                self._watch.clock = self.clock
+                self._watch.start(self.watch_interval, now=False)
+        if self.stats_interval:
+            self._stats_task = LoopingCall(self.log_stats)
+            self._stats_task.clock = self.clock
+            self._stats_task.start(self.stats_interval, now=False)
         yield self.holodeck_pusher.start()
 
     @inlineCallbacks
     def stopService(self):
+        Service.stopService(self)
+        if self.config_file is not None:
+            signal.signal(signal.SIGHUP, signal.SIG_DFL)
+        if self._watch is not None and self._watch.running:
+            self._watch.stop()
+        if self._stats_task is not None and self._stats_task.running:
+            self._stats_task.stop()
         yield self.holodeck_pusher.stop()
+
+    def summarise_stats(self):
+        """Return the pusher's statistics (see
+        :meth:`HolodeckPusher.get_stats`) and, if there is a spool, its
+        statistics (see :meth:`HoloSpool.get_stats`) totalled over every
+        sample set. `max_lag` is the largest over all sets."""
+        pusher_counts = ('pushes', 'dropped_ticks', 'coalesced',
+                         'timed_out', 'in_flight')
+        totals = dict.fromkeys(pusher_counts, 0)
+        totals.update(sets=0, max_lag=0.0)
+        for stats in self.holodeck_pusher.get_stats().itervalues():
+            totals['sets'] += 1
+            totals['max_lag'] = max(totals['max_lag'], stats['max_lag'])
+            for name in pusher_counts:
+                totals[name] += stats[name]
+        spool = self.holodeck_pusher.spool
+        if spool is not None:
+            spool_counts = ('spooled', 'replayed', 'dropped', 'pending_bytes')
+            totals.update(dict.fromkeys(spool_counts, 0))
+            for stats in spool.get_stats().itervalues():
+                for name in spool_counts:
+                    totals[name] += stats[name]
+        return totals
+
+    def log_stats(self):
+        """Log a one line summary of :meth:`summarise_stats`."""
+        totals = self.summarise_stats()
+        msg = ("Holodeck pusher stats: %(sets)d sets, %(pushes)d pushes,"
+               " %(in_flight)d in flight, %(dropped_ticks)d dropped ticks,"
+               " %(coalesced)d coalesced, %(timed_out)d timed out,"
+               " max lag %(max_lag).1fs" % totals)
+        if 'spooled' in totals:
+            msg += (", %(spooled)d spooled, %(replayed)d replayed,"
+                    " %(dropped)d dropped from spool, %(pending_bytes)d"
+                    " bytes spooled" % totals)
+        log.msg(msg + ".")
+
+    def _sighup(self, signum, frame):
+        reactor.callFromThread(self.reload_config)
+
+    def _get_config_mtime(self):
+        try:
+            return os.stat(self.config_file).st_mtime
+        except OSError:
+            return None
+
+    def check_config(self):
+        """Reload the config if the config file has been modified."""
+        mtime = self._get_config_mtime()
+        if mtime is not None and mtime != self._config_mtime:
+            self._config_mtime = mtime
+            self.reload_config()
+
+    def reload_config(self):
+        """Reload the config from the config file.
+
+        A reload requested while another is in progress is made once
+        that one finishes.
+        """
+        if self._reloading:
+            self._reload_again = True
+            return
+        self._reloading = True
+        d = deferToThread(load_config, self.config_file)
+        d.addCallback(self.holodeck_pusher.reload_config, self.jitter,
+                      self.shard_index, self.shard_count)
+        d.addErrback(lambda f: log.err(f, "Reloading Holodeck config"
+                                          " failed."))
+        d.addBoth(self._reloaded)
+        return d
+
+    def _reloaded(self, result):
+        self._reloading = False
+        if self._reload_again and self.running:
+            self._reload_again = False
+            self.reload_config()
+        return result
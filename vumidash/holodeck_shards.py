@@ -0,0 +1,58 @@
+# -*- test-case-name: vumidash.tests.test_holodeck_shards -*-
+
+"""Run several sharded Holodeck pushers on one machine.
+
+   Each shard is a `twistd graphite2holodeck` process started with
+   `--shard-index` and `--shard-count`, so every sample set in the config
+   is pushed by exactly one shard. Shards that exit are restarted. Each
+   shard keeps its spool and push state in its own paths (see
+   :func:`shard_path`).
+   """
+
+import os
+import sys
+
+from vumidash.process_supervisor import ProcessSupervisor
+
+
+def shard_path(path, index):
+    """Return the path a shard keeps the file or directory at path in.
+
+    Shards must not share spool directories (each would replay the
+    others' queues) or state files (each would overwrite the others'
+    state).
+    """
+    return "%s.shard-%d" % (path.rstrip(os.sep), index)
+
+
+class HolodeckShardSupervisor(ProcessSupervisor):
+    """Service that runs and restarts Holodeck pusher shard processes.
+
+    :type shards: int
+    :param shards: Number of shard processes to run.
+    :type args: list of str
+    :param args: Arguments for the `graphite2holodeck` plugin passed to
+        every shard, in addition to its shard index and count.
+    """
+
+    process_name = "shard"
+
+    TWISTD = "from twisted.scripts.twistd import run; run()"
+
+    def __init__(self, shards, args):
+        ProcessSupervisor.__init__(self, shards)
+        self.shard_count = shards
+        self.args = args
+
+    @property
+    def shards(self):
+        return self.processes
+
+    def shard_args(self, index):
+        return [sys.executable, "-c", self.TWISTD, "--nodaemon",
+                "--pidfile=", "graphite2holodeck"] + self.args + [
+                "--shard-index", str(index),
+                "--shard-count", str(self.shard_count)]
+
+    def process_args(self, index):
+        return self.shard_args(index)
@@ -0,0 +1,384 @@
+# -*- test-case-name: vumidash.tests.test_holodeck_spool -*-
+
+"""Durable on-disk spool for Holodeck pushes that failed.
+
+   Failed pushes are appended to a bounded queue of segment files per
+   Holodeck server and API key. Queues are replayed with exponential
+   backoff and, once the server is reachable again, caught up in batches.
+   Entries are read back a batch at a time so memory use does not grow
+   with the length of an outage. When a queue reaches its size limit the
+   oldest segment is dropped.
+
+   The position of the first unsent entry of each queue is saved after
+   every replayed batch. Replay is at-least-once: pushes of a batch that
+   was in progress when the process stopped may be sent again when the
+   spool is reloaded.
+
+   A partly written entry left at the end of a queue by a crash is
+   truncated when the queue is loaded, and entries that can't be decoded
+   are logged and skipped, so that one bad entry can't stall a queue.
+   """
+
+import os
+import json
+import time
+import hashlib
+from datetime import datetime
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, succeed, gatherResults
+from twisted.python import log
+
+
+class SpoolQueue(object):
+    """Append-only queue of JSON entries stored in segment files.
+
+    :type directory: str
+    :param directory: Directory to keep segment files in.
+    :type max_bytes: int
+    :param max_bytes: Size of the queue above which the oldest segments are
+        dropped.
+    :type segment_bytes: int
+    :param segment_bytes: Size at which a new segment file is started.
+    """
+
+    SUFFIX = ".spool"
+    OFFSET_FILE = "offset.json"
+
+    def __init__(self, directory, max_bytes, segment_bytes):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.segments = sorted(
+            int(name[:-len(self.SUFFIX)]) for name in os.listdir(directory)
+            if name.endswith(self.SUFFIX))
+        self._repair_tail()
+        self.offset = self._load_offset()
+        self.saved_offset = (self.segments[:1], self.offset)
+        self.dropped = 0
+
+    def _repair_tail(self):
+        """Truncate a partly written entry at the end of the last segment,
+        which would otherwise corrupt the next entry appended."""
+        if not self.segments:
+            return
+        path = self._path(self.segments[-1])
+        with open(path, "r+b") as f:
+            data = f.read()
+            end = data.rfind("\n") + 1
+            if end < len(data):
+                log.msg("Truncating partly written spool entry in %r."
+                        % (path,))
+                f.truncate(end)
+        if not end:
+            os.remove(path)
+            self.segments.pop()
+
+    def _load_offset(self):
+        """Return the saved offset into the first segment, or 0 if the
+        saved offset is for a segment that has since been removed."""
+        path = os.path.join(self.directory, self.OFFSET_FILE)
+        if not self.segments or not os.path.exists(path):
+            return 0
+        try:
+            with open(path, "rb") as f:
+                segment, offset = json.load(f)
+        except ValueError:
+            log.err(None, "Ignoring unreadable spool offset %r." % (path,))
+            return 0
+        return offset if segment == self.segments[0] else 0
+
+    def save_offset(self):
+        """Atomically save the offset of the first unconsumed entry if it
+        changed since it was last saved."""
+        current = (self.segments[:1], self.offset)
+        if current == self.saved_offset:
+            return
+        path = os.path.join(self.directory, self.OFFSET_FILE)
+        if not self.offset:
+            if os.path.exists(path):
+                os.remove(path)
+        else:
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                json.dump([self.segments[0], self.offset], f)
+            os.rename(tmp_path, path)
+        self.saved_offset = current
+
+    def _path(self, segment):
+        return os.path.join(self.directory,
+                            "%012d%s" % (segment, self.SUFFIX))
+
+    def size(self):
+        """Return the number of bytes in the queue not yet consumed."""
+        return sum(os.path.getsize(self._path(segment))
+                   for segment in self.segments) - self.offset
+
+    def empty(self):
+        return not self.segments
+
+    def append(self, entry):
+        """Append entry, dropping the oldest segments if the queue grows
+        too large."""
+        line = json.dumps(entry) + "\n"
+        if (not self.segments or os.path.getsize(
+                self._path(self.segments[-1])) + len(line) >
+                self.segment_bytes):
+            self.segments.append(self.segments[-1] + 1
+                                 if self.segments else 0)
+        with open(self._path(self.segments[-1]), "ab") as f:
+            f.write(line)
+        while len(self.segments) > 1 and self.size() > self.max_bytes:
+            self._drop_oldest()
+
+    def _drop_oldest(self):
+        path = self._path(self.segments.pop(0))
+        with open(path, "rb") as f:
+            f.seek(self.offset)
+            self.dropped += sum(1 for _line in f)
+        os.remove(path)
+        self.offset = 0
+
+    def read(self, count):
+        """Return up to count `(segment, offset, entry)` tuples from the
+        front of the queue. Pass segment and offset to :meth:`consume` once
+        an entry has been handled. Entries that can't be decoded are
+        returned as `None`."""
+        if not self.segments:
+            return []
+        segment = self.segments[0]
+        entries = []
+        with open(self._path(segment), "rb") as f:
+            f.seek(self.offset)
+            while len(entries) < count:
+                line = f.readline()
+                if not line:
+                    break
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    log.msg("Unreadable spool entry at offset %d of %r."
+                            % (f.tell() - len(line), self._path(segment)))
+                    entry = None
+                entries.append((segment, f.tell(), entry))
+        return entries
+
+    def consume(self, segment, offset):
+        """Remove entries up to offset in segment from the queue. Call
+        :meth:`save_offset` to make this survive a restart."""
+        if not self.segments or self.segments[0] != segment:
+            # the segment was dropped while its entries were in use
+            return
+        self.offset = offset
+        path = self._path(segment)
+        if self.offset >= os.path.getsize(path):
+            os.remove(path)
+            self.segments.pop(0)
+            self.offset = 0
+
+
+class HoloSpool(object):
+    """Sends pushes through a :class:`HoloClientPool`, spooling pushes that
+    fail to disk and replaying them later.
+
+    A spool can be used wherever a client pool is expected. While a queue
+    has entries waiting, new pushes to it are appended to it so that they
+    are sent in order.
+
+    :type client_pool: :class:`vumidash.holodeck_pusher.HoloClientPool`
+    :param client_pool: Pool of Holodeck clients to push with.
+    :type directory: str
+    :param directory: Directory to keep queues in.
+    :type max_bytes: int
+    :param max_bytes: Maximum size in bytes of each queue.
+    :type segments: int
+    :param segments: Number of segment files each queue is split into.
+    :type batch_size: int
+    :param batch_size: Number of entries replayed before yielding to other
+        queues.
+    :type initial_delay: float
+    :param initial_delay: Seconds to wait before the first replay.
+    :type max_delay: float
+    :param max_delay: Longest delay in seconds between replays.
+    """
+
+    clock = reactor  # testing hook
+
+    KEY_FILE = "key.json"
+
+    def __init__(self, client_pool, directory, max_bytes=10 * 1024 * 1024,
+                 segments=10, batch_size=50, initial_delay=1.0,
+                 max_delay=300.0):
+        self.client_pool = client_pool
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = max(max_bytes // segments, 1)
+        self.batch_size = batch_size
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.queues = {}
+        self.stats = {}
+        self.running = False
+        self._delays = {}
+        self._calls = {}
+        self._replaying = {}
+
+    def _key_directory(self, key):
+        return os.path.join(self.directory,
+                            hashlib.md5("\0".join(key)).hexdigest())
+
+    def queue(self, server, api_key):
+        """Return the queue for server and API key, creating it if
+        necessary."""
+        key = (server, api_key)
+        if key not in self.queues:
+            directory = self._key_directory(key)
+            self.queues[key] = SpoolQueue(directory, self.max_bytes,
+                                          self.segment_bytes)
+            self.stats[key] = {'spooled': 0, 'replayed': 0, 'skipped': 0}
+            key_file = os.path.join(directory, self.KEY_FILE)
+            if not os.path.exists(key_file):
+                with open(key_file, "wb") as f:
+                    json.dump([server, api_key], f)
+        return self.queues[key]
+
+    def start(self):
+        """Load queues left by a previous run and schedule their replay."""
+        self.running = True
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        for name in os.listdir(self.directory):
+            key_file = os.path.join(self.directory, name, self.KEY_FILE)
+            if not os.path.exists(key_file):
+                continue
+            with open(key_file, "rb") as f:
+                server, api_key = json.load(f)
+            key = (server.encode('utf-8'), api_key.encode('utf-8'))
+            if not self.queue(*key).empty():
+                self._schedule(key, self.initial_delay)
+
+    def stop(self):
+        """Cancel scheduled replays. Returns a Deferred that fires once the
+        batches being replayed have finished."""
+        self.running = False
+        for call in self._calls.values():
+            if call.active():
+                call.cancel()
+        self._calls.clear()
+        return gatherResults(self._replaying.values())
+
+    def send(self, server, api_key, samples, timestamp):
+        """Push samples to Holodeck, spooling them if the push fails."""
+        key = (server, api_key)
+        queue = self.queues.get(key)
+        if queue is not None and not queue.empty():
+            self.spool(server, api_key, samples, timestamp)
+            return succeed(None)
+        d = self.client_pool.send(server, api_key=api_key, samples=samples,
+                                  timestamp=timestamp)
+        d.addErrback(self._send_failed, server, api_key, samples, timestamp)
+        return d
+
+    def _send_failed(self, failure, server, api_key, samples, timestamp):
+        log.msg("Push to %s failed (%s), spooling samples."
+                % (server, failure.getErrorMessage()))
+        self.spool(server, api_key, samples, timestamp)
+
+    def spool(self, server, api_key, samples, timestamp):
+        """Append a push to the queue for server and API key."""
+        self.queue(server, api_key).append({
+            'timestamp': time.mktime(timestamp.timetuple()) +
+            timestamp.microsecond / 1e6,
+            'samples': samples,
+            })
+        key = (server, api_key)
+        self.stats[key]['spooled'] += 1
+        if key not in self._calls and key not in self._replaying:
+            self._schedule(key, self._delays.get(key, self.initial_delay))
+
+    def _schedule(self, key, delay):
+        if not self.running:
+            return
+        self._calls[key] = self.clock.callLater(delay, self._start_replay,
+                                                key)
+
+    def _start_replay(self, key):
+        del self._calls[key]
+        d = self.replay(key)
+        d.addErrback(lambda f: log.err(f))
+        d.addBoth(self._replay_done, key)
+        if not d.called:
+            self._replaying[key] = d
+
+    def _replay_done(self, _result, key):
+        self._replaying.pop(key, None)
+
+    @inlineCallbacks
+    def replay(self, key):
+        """Send up to `batch_size` entries from the queue for key and
+        schedule the next replay. Entries that can't be decoded are
+        skipped."""
+        server, api_key = key
+        queue = self.queues[key]
+        try:
+            entries = queue.read(self.batch_size)
+        except (IOError, OSError), e:
+            self._replay_failed(key, e)
+            return
+        for segment, offset, entry in entries:
+            if not self.running:
+                break
+            push = self._decode(entry)
+            if push is None:
+                log.msg("Skipping unreadable spooled push to %s." % (server,))
+                self.stats[key]['skipped'] += 1
+            else:
+                samples, timestamp = push
+                try:
+                    yield self.client_pool.send(
+                        server, api_key=api_key, samples=samples,
+                        timestamp=timestamp)
+                except Exception, e:
+                    self._replay_failed(key, e)
+                    return
+                self.stats[key]['replayed'] += 1
+            queue.consume(segment, offset)
+        queue.save_offset()
+        self._delays.pop(key, None)
+        if not queue.empty():
+            # catch up without waiting, but let other work run first
+            self._schedule(key, 0)
+
+    def _decode(self, entry):
+        """Return the samples and timestamp of a spooled entry, or None if
+        it is malformed."""
+        try:
+            return (entry['samples'],
+                    datetime.fromtimestamp(entry['timestamp']))
+        except (TypeError, KeyError, ValueError):
+            return None
+
+    def _replay_failed(self, key, error):
+        self.queues[key].save_offset()
+        delay = min(self._delays.get(key, self.initial_delay) * 2,
+                    self.max_delay)
+        self._delays[key] = delay
+        log.msg("Replaying pushes to %s failed (%s), retrying in %gs."
+                % (key[0], error, delay))
+        self._schedule(key, delay)
+
+    def get_stats(self):
+        """Return a dict mapping each `(server, api_key)` to its statistics.
+
+        `spooled` is the number of pushes spooled, `replayed` the number
+        replayed successfully, `skipped` the number skipped because they
+        couldn't be decoded, `dropped` the number dropped because the
+        queue was full and `pending_bytes` the size of the queue.
+        """
+        stats = {}
+        for key, queue in self.queues.iteritems():
+            stats[key] = dict(self.stats[key], dropped=queue.dropped,
+                              pending_bytes=queue.size())
+        return stats
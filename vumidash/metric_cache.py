@@ -0,0 +1,290 @@
+# -*- test-case-name: vumidash.tests.test_metric_cache -*-
+
+"""Metric sources that cache and share results of another metric source.
+
+   :class:`CachingMetricSource` caches results in memory for a short
+   time and shares in-flight fetches between identical requests.
+
+   :class:`MetricSourceServerFactory` and :class:`RemoteMetricSource`
+   expose a metric source over a local UNIX socket so that several
+   processes can share one cache (and one set of upstream fetches).
+   """
+
+import json
+from datetime import timedelta
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, succeed, maybeDeferred
+from twisted.internet.protocol import ClientCreator, ServerFactory
+from twisted.protocols import amp
+from twisted.python import log
+from twisted.python.failure import Failure
+
+from vumidash.base import MetricSource
+
+
+def dt_to_seconds(dt):
+    """Convert a timedelta to a float number of seconds."""
+    return dt.days * 24 * 60 * 60 + dt.seconds + dt.microseconds / 1e6
+
+
+class CachingMetricSource(MetricSource):
+    """Cache results from another metric source.
+
+    Identical requests made within `ttl` seconds of each other are
+    answered from the cache and identical requests made while a fetch is
+    in progress wait for that fetch instead of starting a new one.
+
+    :type metrics_source: :class:`vumidash.base.MetricSource`
+    :param metrics_source: Source to read metrics from.
+    :type ttl: float
+    :param ttl: Number of seconds to cache results for.
+    :type max_entries: int
+    :param max_entries: Expired results are purged once the cache holds
+        more than this many entries.
+    """
+
+    clock = reactor  # testing hook
+
+    def __init__(self, metrics_source, ttl=30.0, max_entries=10000):
+        self.metrics_source = metrics_source
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._cache = {}
+        self._in_flight = {}
+
+    def close(self):
+        self.metrics_source.close()
+
+    def _purge_expired(self, now):
+        for key, (expires, _result) in self._cache.items():
+            if expires <= now:
+                del self._cache[key]
+
+    def _fetch(self, method, *args):
+        key = (method,) + args
+        now = self.clock.seconds()
+        cached = self._cache.get(key)
+        if cached is not None and cached[0] > now:
+            return succeed(cached[1])
+        # callers each get their own Deferred so that one caller
+        # cancelling doesn't cancel the shared fetch
+        d = Deferred()
+        if key in self._in_flight:
+            self._in_flight[key].append(d)
+            return d
+        waiters = [d]
+        self._in_flight[key] = waiters
+        fetch_d = maybeDeferred(getattr(self.metrics_source, method), *args)
+        fetch_d.addBoth(self._fetched, key, waiters)
+        return d
+
+    def _fetched(self, result, key, waiters):
+        del self._in_flight[key]
+        if isinstance(result, Failure):
+            for d in waiters:
+                if not d.called:
+                    d.errback(result)
+            return None
+        now = self.clock.seconds()
+        if len(self._cache) >= self.max_entries:
+            self._purge_expired(now)
+        self._cache[key] = (now + self.ttl, result)
+        for d in waiters:
+            if not d.called:
+                d.callback(result)
+
+    def get_latest(self, metric, start, end, summary_size, *args):
+        return self._fetch('get_latest', metric, start, end, summary_size,
+                           *args)
+
+    def get_history(self, metric, start, end, summary_size, *args):
+        return self._fetch('get_history', metric, start, end, summary_size,
+                           *args)
+
+    def get_series(self, target, start, end, summary_size):
+        return self._fetch('get_series', target, start, end, summary_size)
+
+
+class RemoteMetricError(Exception):
+    """Raised when a metric source in another process fails."""
+
+
+class GetLatest(amp.Command):
+    arguments = [
+        ('metric', amp.Unicode()),
+        ('start', amp.Float()),
+        ('end', amp.Float()),
+        ('summary_size', amp.Float()),
+        ]
+    response = [('result', amp.String())]
+    errors = {RemoteMetricError: 'REMOTE_METRIC_ERROR'}
+
+
+class GetHistory(amp.Command):
+    arguments = [
+        ('metric', amp.Unicode()),
+        ('start', amp.Float()),
+        ('end', amp.Float()),
+        ('summary_size', amp.Float()),
+        ('skip_nulls', amp.Boolean()),
+        ]
+    response = [('result', amp.String())]
+    errors = {RemoteMetricError: 'REMOTE_METRIC_ERROR'}
+
+
+class GetSeries(amp.Command):
+    arguments = [
+        ('target', amp.Unicode()),
+        ('start', amp.Float()),
+        ('end', amp.Float()),
+        ('summary_size', amp.Float()),
+        ]
+    response = [('result', amp.String())]
+    errors = {RemoteMetricError: 'REMOTE_METRIC_ERROR'}
+
+
+class MetricSourceProtocol(amp.AMP):
+    """Answers metric requests using the factory's metric source."""
+
+    def _respond(self, d):
+        d.addCallback(lambda result: {'result': json.dumps(result)})
+
+        def remote_error(failure):
+            if failure.check(RemoteMetricError):
+                return failure
+            log.err(failure)
+            raise RemoteMetricError(failure.getErrorMessage())
+        return d.addErrback(remote_error)
+
+    @GetLatest.responder
+    def get_latest(self, metric, start, end, summary_size):
+        source = self.factory.metrics_source
+        return self._respond(maybeDeferred(
+            source.get_latest, metric.encode('utf-8'),
+            timedelta(seconds=start), timedelta(seconds=end),
+            timedelta(seconds=summary_size)))
+
+    @GetHistory.responder
+    def get_history(self, metric, start, end, summary_size, skip_nulls):
+        source = self.factory.metrics_source
+        return self._respond(maybeDeferred(
+            source.get_history, metric.encode('utf-8'),
+            timedelta(seconds=start), timedelta(seconds=end),
+            timedelta(seconds=summary_size), skip_nulls))
+
+    @GetSeries.responder
+    def get_series(self, target, start, end, summary_size):
+        source = self.factory.metrics_source
+        return self._respond(maybeDeferred(
+            source.get_series, target.encode('utf-8'),
+            timedelta(seconds=start), timedelta(seconds=end),
+            timedelta(seconds=summary_size)))
+
+
+class MetricSourceServerFactory(ServerFactory):
+    """Serves a metric source to :class:`RemoteMetricSource` clients.
+
+    :type metrics_source: :class:`vumidash.base.MetricSource`
+    :param metrics_source: Source to answer requests from.
+    """
+
+    protocol = MetricSourceProtocol
+
+    def __init__(self, metrics_source):
+        self.metrics_source = metrics_source
+
+
+class RemoteMetricProtocol(amp.AMP):
+    """Client side of a connection to a :class:`MetricSourceProtocol`."""
+
+    def __init__(self, source):
+        amp.AMP.__init__(self)
+        self.source = source
+
+    def connectionLost(self, reason):
+        amp.AMP.connectionLost(self, reason)
+        self.source.connection_lost(self)
+
+
+class RemoteMetricSource(MetricSource):
+    """Read metrics from a :class:`MetricSourceServerFactory` listening on a
+    UNIX socket.
+
+    :type socket_path: str
+    :param socket_path: Path of the UNIX socket to connect to.
+    """
+
+    clock = reactor  # testing hook
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self._protocol = None
+        self._waiters = None
+
+    def _connected(self, protocol):
+        self._protocol = protocol
+        self._notify(protocol)
+
+    def _connection_failed(self, failure):
+        self._notify(failure)
+
+    def _notify(self, result):
+        """Fire every Deferred waiting for the connection with result,
+        which may be a Failure."""
+        waiters, self._waiters = self._waiters, None
+        for d in waiters:
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+    def connection_lost(self, protocol):
+        if self._protocol is protocol:
+            self._protocol = None
+
+    def get_protocol(self):
+        """Return a Deferred that fires with a connected AMP protocol."""
+        if self._protocol is not None:
+            return succeed(self._protocol)
+        d = Deferred()
+        if self._waiters is None:
+            self._waiters = [d]
+            creator = ClientCreator(self.clock, RemoteMetricProtocol, self)
+            connecting = creator.connectUNIX(self.socket_path)
+            connecting.addCallbacks(self._connected, self._connection_failed)
+        else:
+            self._waiters.append(d)
+        return d
+
+    def disconnect(self):
+        if self._protocol is not None:
+            self._protocol.transport.loseConnection()
+
+    def close(self):
+        self.disconnect()
+
+    def _call(self, command, **kw):
+        d = self.get_protocol()
+        d.addCallback(lambda p: p.callRemote(command, **kw))
+        return d.addCallback(lambda response: json.loads(response['result']))
+
+    def get_latest(self, metric, start, end, summary_size):
+        d = self._call(GetLatest, metric=metric.decode('utf-8'),
+                       start=dt_to_seconds(start), end=dt_to_seconds(end),
+                       summary_size=dt_to_seconds(summary_size))
+        return d.addCallback(tuple)
+
+    def get_history(self, metric, start, end, summary_size,
+                    skip_nulls=True):
+        return self._call(GetHistory, metric=metric.decode('utf-8'),
+                          start=dt_to_seconds(start), end=dt_to_seconds(end),
+                          summary_size=dt_to_seconds(summary_size),
+                          skip_nulls=skip_nulls)
+
+    def get_series(self, target, start, end, summary_size):
+        d = self._call(GetSeries, target=target.decode('utf-8'),
+                       start=dt_to_seconds(start), end=dt_to_seconds(end),
+                       summary_size=dt_to_seconds(summary_size))
+        return d.addCallback(lambda series: [
+            (name.encode('utf-8'), points) for name, points in series])
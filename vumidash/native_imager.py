@@ -0,0 +1,249 @@
+# -*- test-case-name: vumidash.tests.test_native_imager -*-
+
+"""Render dashboards of graphite2gecko widgets without a browser.
+
+   A native dashboard is a list of widgets, each given by the path and
+   query string of a `graphite2gecko` widget URL (e.g.
+   `/history?metric=foo.bar&from=-7d&step=1d`). The widget data is
+   computed by the same resources that serve it to Geckoboard, read
+   straight from a :class:`vumidash.base.MetricSource`, and drawn with
+   matplotlib (which is optional and only needed for native dashboards).
+   """
+
+import math
+import urlparse
+from cStringIO import StringIO
+from datetime import datetime
+
+try:
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+except ImportError:
+    Figure = FigureCanvasAgg = None
+
+from twisted.internet import reactor, threads
+from twisted.internet.defer import (
+    maybeDeferred, gatherResults, FirstError, CancelledError)
+from twisted.python import log
+
+from vumidash.aggregation import split_points
+from vumidash.gecko_server import (
+    GeckoboardLatestResource, GeckoboardRagResource,
+    GeckoboardHighchartResource)
+
+
+def format_value(value):
+    if value is None:
+        return "-"
+    if value == int(value):
+        return "%d" % (value,)
+    return "%.2f" % (value,)
+
+
+class WidgetRequest(object):
+    """The parts of a request that widget resources read."""
+
+    def __init__(self, args):
+        self.args = args
+
+
+class Widget(object):
+    """A `graphite2gecko` widget read directly from a metrics source.
+
+    :param metrics_source: The :class:`vumidash.base.MetricSource` to read
+        metrics from.
+    :type widget: str
+    :param widget: Path and query string of the widget's URL. The last
+        path segment selects the widget type (`latest`, `rag` or
+        `history`).
+    :type title: str
+    :param title: Title to draw above the widget.
+    """
+
+    RESOURCES = {
+        'latest': GeckoboardLatestResource,
+        'rag': GeckoboardRagResource,
+        'history': GeckoboardHighchartResource,
+        }
+
+    clock = reactor  # testing hook
+
+    def __init__(self, metrics_source, widget, title=None):
+        url = urlparse.urlparse(widget)
+        self.kind = url.path.rstrip("/").split("/")[-1]
+        if self.kind not in self.RESOURCES:
+            raise ValueError("Unknown widget type %r" % (self.kind,))
+        self.title = title
+        self.request = WidgetRequest(urlparse.parse_qs(url.query))
+        self.resource = self.RESOURCES[self.kind](metrics_source)
+        try:
+            self.queries = self.resource.get_queries(self.request)
+        except KeyError, e:
+            raise ValueError("Missing required parameter %s" % (e,))
+
+    def fetch(self, timeout=None):
+        """Return a Deferred that fires with the widget's Geckoboard data,
+        or None if it couldn't be fetched within `timeout` seconds."""
+        results = {}
+        fetches = []
+        for key, func, args in self.queries:
+            d = maybeDeferred(func, *args)
+            d.addCallback(self._store_result, results, key)
+            fetches.append(d)
+        d = gatherResults(fetches, consumeErrors=True)
+        if timeout is not None:
+            timer = self.clock.callLater(timeout, d.cancel)
+
+            def cancel_timer(result):
+                if timer.active():
+                    timer.cancel()
+                return result
+            d.addBoth(cancel_timer)
+        d.addCallback(
+            lambda _: self.resource.format_data(self.request, results))
+        d.addErrback(self._fetch_failed)
+        return d
+
+    def _store_result(self, result, results, key):
+        results[key] = result
+
+    def _fetch_failed(self, failure):
+        if failure.check(FirstError):
+            failure = failure.value.subFailure
+        if failure.check(CancelledError):
+            log.msg("Fetching %s widget %r timed out."
+                    % (self.kind, self.title))
+            return None
+        log.err(failure, "Fetching %s widget %r failed."
+                % (self.kind, self.title))
+        return None
+
+
+class NativeDashboardImager(object):
+    """Renders a dashboard of widgets to PNG in-process.
+
+    Has the same interface as
+    :class:`vumidash.gecko_imager.DashboardImager`, so its
+    :meth:`generate_png` is called from a worker thread.
+
+    :param metrics_source: The :class:`vumidash.base.MetricSource` to read
+        metrics from.
+    :type widgets: list
+    :param widgets: Widget URLs, or dictionaries with `widget` (the URL)
+        and `title` keys.
+    :type title: str
+    :param title: A human readable name for the dashboard.
+    :type columns: int
+    :param columns: Number of widgets per row.
+    :type timeout: float
+    :param timeout: Number of seconds to wait for each widget's data.
+        Widgets that take longer are drawn without data.
+    """
+
+    BACKGROUND = "#222222"
+    FOREGROUND = "#eeeeee"
+    RAG_COLOURS = ["#d0352a", "#e39a27", "#5ab04a"]
+    UP_COLOUR = "#5ab04a"
+    DOWN_COLOUR = "#d0352a"
+
+    CELL_WIDTH = 4.0
+    CELL_HEIGHT = 3.0
+    DPI = 80
+
+    def __init__(self, metrics_source, widgets, title=None, columns=2,
+                 timeout=30):
+        if Figure is None:
+            raise ValueError("Native dashboards require matplotlib")
+        self.url = None
+        self.widget_boxes = None
+        self.title = title
+        self.columns = columns
+        self.timeout = timeout
+        self.widgets = []
+        for widget in widgets:
+            if not isinstance(widget, dict):
+                widget = {"widget": widget}
+            self.widgets.append(Widget(metrics_source, **widget))
+
+    def fetch_data(self):
+        """Return a Deferred that fires with the data of every widget."""
+        return gatherResults([widget.fetch(self.timeout)
+                              for widget in self.widgets])
+
+    def render_png(self, data):
+        """Draw the widgets with the given data and return a PNG."""
+        rows = max(int(math.ceil(len(self.widgets) / float(self.columns))),
+                   1)
+        figure = Figure(figsize=(self.CELL_WIDTH * self.columns,
+                                 self.CELL_HEIGHT * rows),
+                        facecolor=self.BACKGROUND)
+        FigureCanvasAgg(figure)
+        for i, (widget, widget_data) in enumerate(zip(self.widgets, data)):
+            axes = figure.add_subplot(rows, self.columns, i + 1,
+                                      facecolor=self.BACKGROUND)
+            if widget.title is not None:
+                axes.set_title(widget.title, color=self.FOREGROUND)
+            if widget_data is None:
+                self.draw_missing(axes)
+            else:
+                getattr(self, "draw_%s" % (widget.kind,))(axes, widget_data)
+        f = StringIO()
+        figure.savefig(f, format="png", dpi=self.DPI,
+                       facecolor=self.BACKGROUND)
+        return f.getvalue()
+
+    def generate_png(self):
+        """Return a binary string containing a PNG of the dashboard.
+
+        Must be called from a thread other than the reactor's.
+        """
+        data = threads.blockingCallFromThread(reactor, self.fetch_data)
+        return self.render_png(data)
+
+    def _text_axes(self, axes):
+        axes.set_axis_off()
+        axes.set_xlim(0, 1)
+        axes.set_ylim(0, 1)
+
+    def draw_missing(self, axes):
+        self._text_axes(axes)
+        axes.text(0.5, 0.5, "No data", color=self.FOREGROUND,
+                  ha="center", va="center")
+
+    def draw_latest(self, axes, data):
+        self._text_axes(axes)
+        latest, previous = [item["value"] for item in data["item"]]
+        axes.text(0.5, 0.55, format_value(latest), color=self.FOREGROUND,
+                  fontsize=40, ha="center", va="center")
+        if latest is not None and previous:
+            change = 100.0 * (latest - previous) / abs(previous)
+            colour = self.UP_COLOUR if change >= 0 else self.DOWN_COLOUR
+            axes.text(0.5, 0.2, "%+.1f%%" % (change,), color=colour,
+                      fontsize=16, ha="center", va="center")
+
+    def draw_rag(self, axes, data):
+        self._text_axes(axes)
+        for i, (item, colour) in enumerate(zip(data["item"],
+                                               self.RAG_COLOURS)):
+            x = (i + 0.5) / 3
+            axes.text(x, 0.55, format_value(item["value"]), color=colour,
+                      fontsize=28, ha="center", va="center")
+            axes.text(x, 0.2, item.get("prefix", "") + item["text"],
+                      color=self.FOREGROUND, ha="center", va="center")
+
+    def draw_history(self, axes, data):
+        for spine in axes.spines.values():
+            spine.set_color(self.FOREGROUND)
+        axes.tick_params(colors=self.FOREGROUND, labelsize=8)
+        for series in data["series"]:
+            times, values = split_points(series["data"])
+            if times is None:
+                times = range(len(values))
+            else:
+                times = [datetime.fromtimestamp(t / 1000.0) for t in times]
+            values = [v if v is not None else float("nan") for v in values]
+            axes.plot(times, values, label=series["name"])
+        if data["yAxis"]["min"] is not None:
+            axes.set_ylim(bottom=data["yAxis"]["min"])
+        if len(data["series"]) > 1:
+            axes.legend(loc="upper left", fontsize=8)
@@ -0,0 +1,141 @@
+# -*- test-case-name: vumidash.tests.test_holodeck_shards -*-
+
+"""Run and restart a fixed number of child processes.
+
+   Shared by the Gecko worker pool and the Holodeck shard supervisor,
+   which differ only in the arguments and file descriptors their child
+   processes are started with.
+   """
+
+import os
+import sys
+
+from twisted.application.service import Service
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, gatherResults
+from twisted.internet.protocol import ProcessProtocol
+from twisted.python import log
+
+
+class SupervisedProcessProtocol(ProcessProtocol):
+    """Relays a child process's output to the log and tells the
+    supervisor when the process exits."""
+
+    def __init__(self, supervisor, index):
+        self.supervisor = supervisor
+        self.index = index
+        self.ended = Deferred()
+
+    def _log_output(self, data):
+        for line in data.splitlines():
+            log.msg("[%s %d] %s" % (self.supervisor.process_name,
+                                    self.index, line))
+
+    def outReceived(self, data):
+        self._log_output(data)
+
+    def errReceived(self, data):
+        self._log_output(data)
+
+    def processEnded(self, reason):
+        self.supervisor.process_ended(self, reason)
+        self.ended.callback(None)
+
+
+class ProcessSupervisor(Service):
+    """Service that runs `count` child processes and restarts any that
+    exit while the service is running.
+
+    Subclasses implement :meth:`process_args` and may override
+    :meth:`child_fds` and :meth:`processes_stopped`.
+
+    :type count: int
+    :param count: Number of child processes to run.
+    """
+
+    clock = reactor  # testing hook
+
+    RESTART_DELAY = 1.0
+    KILL_TIMEOUT = 10.0
+
+    process_name = "process"
+
+    def __init__(self, count):
+        self.count = count
+        self.processes = {}
+
+    def process_args(self, index):
+        """Return the argv (including the executable) of process `index`.
+        """
+        raise NotImplementedError("Subclasses should implement"
+                                  " process_args")
+
+    def child_fds(self):
+        """Return the childFDs to spawn processes with, or None for the
+        reactor's default."""
+        return None
+
+    def process_env(self):
+        env = os.environ.copy()
+        env["PYTHONPATH"] = os.pathsep.join(
+            os.path.abspath(p) for p in sys.path)
+        return env
+
+    def spawn(self, index):
+        protocol = SupervisedProcessProtocol(self, index)
+        kw = {"env": self.process_env()}
+        child_fds = self.child_fds()
+        if child_fds is not None:
+            kw["childFDs"] = child_fds
+        self.clock.spawnProcess(protocol, sys.executable,
+                                self.process_args(index), **kw)
+        self.processes[index] = protocol
+
+    def process_ended(self, protocol, reason):
+        if self.processes.get(protocol.index) is not protocol:
+            return
+        del self.processes[protocol.index]
+        if self.running:
+            log.msg("%s %d exited (%s), restarting."
+                    % (self.process_name.capitalize(), protocol.index,
+                       reason.getErrorMessage()))
+            self.clock.callLater(self.RESTART_DELAY, self._restart,
+                                 protocol.index)
+
+    def _restart(self, index):
+        if self.running and index not in self.processes:
+            self.spawn(index)
+
+    def startService(self):
+        Service.startService(self)
+        for index in range(self.count):
+            self.spawn(index)
+
+    def stopService(self):
+        Service.stopService(self)
+        ended = []
+        for protocol in self.processes.values():
+            ended.append(protocol.ended)
+            protocol.transport.signalProcess("TERM")
+            # processes that are still starting up may miss the TERM
+            kill = self.clock.callLater(self.KILL_TIMEOUT, self._kill,
+                                        protocol)
+            protocol.ended.addCallback(self._cancel_kill, kill)
+        d = gatherResults(ended)
+        d.addCallback(lambda _: self.processes_stopped())
+        return d
+
+    def processes_stopped(self):
+        """Called once every child process has exited after the service
+        is stopped. May return a Deferred."""
+        self.processes.clear()
+
+    def _kill(self, protocol):
+        log.msg("%s %d did not exit, killing it."
+                % (self.process_name.capitalize(), protocol.index))
+        protocol.transport.signalProcess("KILL")
+
+    def _cancel_kill(self, result, kill):
+        if kill.active():
+            kill.cancel()
+        return result
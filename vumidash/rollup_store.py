@@ -0,0 +1,403 @@
+# -*- test-case-name: vumidash.tests.test_rollup_store -*-
+
+"""Local store of pre-aggregated metric buckets for long-range queries.
+
+   A :class:`RollupStore` keeps hourly and daily buckets for each metric
+   in memory-mapped ring buffer files. :class:`RollupMetricSource` feeds
+   the store incrementally from fine-grained fetches and answers
+   long-range, coarse-step queries from it, fetching only the newest
+   (still incomplete) bucket live.
+   """
+
+import os
+import math
+import mmap
+import struct
+import hashlib
+import itertools
+from datetime import timedelta
+
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    Deferred, maybeDeferred, succeed, gatherResults)
+
+from vumidash.base import MetricSource
+from vumidash.graphite_client import filter_latest
+
+
+class RollupSeries(object):
+    """Ring buffer of aggregated buckets for one metric at one resolution,
+    stored in a memory-mapped file.
+
+    The first record of the file is a header holding the watermark and
+    the low watermark (data in `[low_watermark, watermark)` has all been
+    added, both are 0 while the series is empty). Each following record
+    holds a bucket's start time, aggregated value, number of data points
+    and the time of the newest data point.
+
+    :type path: str
+    :param path: File to store the buckets in.
+    :type resolution: int
+    :param resolution: Bucket size in seconds.
+    :type slots: int
+    :param slots: Number of buckets to keep.
+    :type agg: str
+    :param agg: Aggregation method (`avg`, `sum`, `min`, `max` or `last`),
+        as chosen by :meth:`GraphiteClient.aggregation_method`.
+    """
+
+    RECORD = struct.Struct("<dddd")
+
+    AGGREGATORS = ('avg', 'sum', 'min', 'max', 'last')
+
+    def __init__(self, path, resolution, slots, agg):
+        if agg not in self.AGGREGATORS:
+            raise ValueError("Unknown aggregation method %r" % (agg,))
+        self.path = path
+        self.resolution = resolution
+        self.slots = slots
+        self.agg = agg
+        size = (slots + 1) * self.RECORD.size
+        if not os.path.exists(path) or os.path.getsize(path) != size:
+            with open(path, "wb") as f:
+                f.truncate(size)
+        with open(path, "r+b") as f:
+            self.mmap = mmap.mmap(f.fileno(), size)
+
+    def close(self):
+        self.mmap.flush()
+        self.mmap.close()
+
+    def _get_watermark(self):
+        return self.RECORD.unpack_from(self.mmap, 0)[0]
+
+    def _set_watermark(self, value):
+        self.RECORD.pack_into(self.mmap, 0, value, self.low_watermark, 0, 0)
+
+    watermark = property(_get_watermark, _set_watermark)
+
+    def _get_low_watermark(self):
+        return self.RECORD.unpack_from(self.mmap, 0)[1]
+
+    def _set_low_watermark(self, value):
+        self.RECORD.pack_into(self.mmap, 0, self.watermark, value, 0, 0)
+
+    low_watermark = property(_get_low_watermark, _set_low_watermark)
+
+    def bucket_start(self, t):
+        return math.floor(t / self.resolution) * self.resolution
+
+    def oldest_kept(self, t):
+        """Return the start of the oldest bucket still held once data up
+        to t has been added. Older buckets share their slots with newer
+        ones."""
+        return (math.ceil(t / self.resolution) - self.slots) * self.resolution
+
+    def _offset(self, start):
+        slot = int(start // self.resolution) % self.slots
+        return (slot + 1) * self.RECORD.size
+
+    def read(self, start):
+        """Return `(value, count, newest)` for the bucket starting at start
+        or `None` if there is no data for it."""
+        record = self.RECORD.unpack_from(self.mmap, self._offset(start))
+        if record[0] != start or not record[2]:
+            return None
+        return record[1:]
+
+    def add(self, t, value):
+        """Add the data point (t, value) to its bucket."""
+        start = self.bucket_start(t)
+        bucket = self.read(start)
+        if bucket is None:
+            bucket = (value, 1, t)
+        else:
+            old, count, newest = bucket
+            if self.agg in ('avg', 'sum'):
+                bucket = (old + value, count + 1, max(newest, t))
+            elif self.agg == 'min':
+                bucket = (min(old, value), count + 1, max(newest, t))
+            elif self.agg == 'max':
+                bucket = (max(old, value), count + 1, max(newest, t))
+            elif t >= newest:
+                bucket = (value, count + 1, t)
+            else:
+                bucket = (old, count + 1, newest)
+        self.RECORD.pack_into(self.mmap, self._offset(start), start, *bucket)
+
+    def value(self, start):
+        """Return the aggregated value of the bucket starting at start or
+        `None` if there is no data for it."""
+        bucket = self.read(start)
+        if bucket is None:
+            return None
+        value, count, _newest = bucket
+        if self.agg == 'avg':
+            return value / count
+        return value
+
+    def buckets(self, start, end):
+        """Return `(start, value)` pairs for buckets starting in
+        `[start, end)`."""
+        start = self.bucket_start(start)
+        points = []
+        while start < end:
+            points.append((start, self.value(start)))
+            start += self.resolution
+        return points
+
+
+class RollupStore(object):
+    """Collection of :class:`RollupSeries` kept in a directory.
+
+    :type directory: str
+    :param directory: Directory to keep rollup files in.
+    :type resolutions: dict
+    :param resolutions: Mapping from bucket sizes in seconds to the number
+        of buckets to keep. Defaults to 100 days of hourly buckets and 400
+        days of daily buckets.
+    :type max_open: int
+    :param max_open: Maximum number of series files kept open. The least
+        recently used series are closed beyond that.
+    """
+
+    DEFAULT_RESOLUTIONS = {
+        60 * 60: 24 * 100,
+        24 * 60 * 60: 400,
+        }
+
+    def __init__(self, directory, resolutions=None, max_open=256):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.resolutions = (resolutions if resolutions is not None
+                            else self.DEFAULT_RESOLUTIONS.copy())
+        self.max_open = max_open
+        self._series = {}
+        self._last_used = {}
+        self._uses = itertools.count()
+
+    def series(self, metric, resolution, agg):
+        """Return the :class:`RollupSeries` for metric at resolution.
+
+        The series may be closed by later calls, so it shouldn't be held
+        on to across them.
+        """
+        key = (metric, resolution)
+        if key not in self._series:
+            if len(self._series) >= self.max_open:
+                self._close_least_recently_used()
+            name = "%s.%d.rollup" % (hashlib.md5(metric).hexdigest(),
+                                     resolution)
+            self._series[key] = RollupSeries(
+                os.path.join(self.directory, name), resolution,
+                self.resolutions[resolution], agg)
+        self._last_used[key] = next(self._uses)
+        return self._series[key]
+
+    def _close_least_recently_used(self):
+        key = min(self._last_used, key=self._last_used.get)
+        del self._last_used[key]
+        self._series.pop(key).close()
+
+    def _resolutions(self, resolution):
+        if resolution is None:
+            return self.resolutions
+        return [resolution]
+
+    def watermark(self, metric, agg, resolution=None):
+        """Return the time up to which data for metric has been added at
+        resolution, or at every resolution if it is `None`."""
+        return min(self.series(metric, res, agg).watermark
+                   for res in self._resolutions(resolution))
+
+    def low_watermark(self, metric, agg, resolution=None):
+        """Return the time from which data for metric is held at
+        resolution, or at every resolution if it is `None`."""
+        return max(self.series(metric, res, agg).low_watermark
+                   for res in self._resolutions(resolution))
+
+    def ingest(self, metric, agg, points, since, until):
+        """Add the `(t, value)` points in `[since, until)` to every
+        resolution of metric and extend its watermarks to cover the range,
+        which must be adjacent to or overlap the range already added.
+
+        Points too old for a resolution's ring buffer are left out of it
+        and its low watermark is raised past buckets that newer ones have
+        overwritten.
+        """
+        for resolution in self.resolutions:
+            series = self.series(metric, resolution, agg)
+            oldest = series.oldest_kept(max(series.watermark, until))
+            for t, value in points:
+                if max(since, oldest) <= t < until and value is not None:
+                    series.add(t, value)
+            if series.watermark == 0:
+                series.watermark = until
+                series.low_watermark = max(since, oldest)
+            else:
+                series.watermark = max(series.watermark, until)
+                series.low_watermark = max(
+                    min(series.low_watermark, since), oldest)
+
+    def close(self):
+        for series in self._series.values():
+            series.close()
+        self._series.clear()
+        self._last_used.clear()
+
+
+class RollupMetricSource(MetricSource):
+    """Answer long-range queries from a :class:`RollupStore`.
+
+    Queries whose step matches one of the store's resolutions, that cover
+    at least `min_range` seconds (but no more than the resolution's ring
+    buffer holds) and end now are answered from the store. Before
+    answering, data for the parts of the query range outside of the
+    metric's low watermark and watermark is fetched at `fine_step` and
+    added to the store. The newest fine step is left out, since Graphite
+    may still be receiving data for it. The newest bucket, which is still
+    filling up, is always fetched live. All other queries are passed on
+    to the wrapped metric source.
+
+    :type metrics_source: :class:`vumidash.graphite_client.GraphiteClient`
+    :param metrics_source: Source to read metrics from. Its history must
+        be `(timestamp_in_ms, value)` pairs and it must provide
+        `aggregation_method`.
+    :type store: :class:`RollupStore`
+    :param store: Store to keep rollups in.
+    :type fine_step: int
+    :param fine_step: Step in seconds of the fetches that feed the store.
+    :type min_range: int
+    :param min_range: Shortest query range in seconds answered from the
+        store.
+    """
+
+    clock = reactor  # testing hook
+
+    def __init__(self, metrics_source, store, fine_step=300,
+                 min_range=7 * 24 * 60 * 60):
+        self.metrics_source = metrics_source
+        self.store = store
+        self.fine_step = fine_step
+        self.min_range = min_range
+        self._ingesting = {}
+
+    def use_rollups(self, start, end, summary_size):
+        resolution = self.total_seconds(summary_size)
+        slots = self.store.resolutions.get(resolution)
+        if slots is None or self.total_seconds(end) != 0:
+            return False
+        # the newest bucket is fetched live and shares its slot with the
+        # oldest one the ring buffer would otherwise hold
+        capacity = (slots - 1) * resolution
+        return -capacity <= self.total_seconds(start) <= -self.min_range
+
+    def _relative(self, t, now):
+        return timedelta(seconds=int(t - now))
+
+    def missing_ranges(self, metric, agg, since, until, resolution=None):
+        """Return the `(since, until)` ranges of data for metric between
+        since and until that haven't been added to the store (at
+        resolution, if given) yet."""
+        watermark = self.store.watermark(metric, agg, resolution)
+        if watermark == 0:
+            return [(since, until)] if since < until else []
+        ranges = []
+        low_watermark = self.store.low_watermark(metric, agg, resolution)
+        if since < low_watermark:
+            ranges.append((since, low_watermark))
+        # newer data is fetched from the watermark on, even if that is
+        # before since, to keep the stored range contiguous
+        if watermark < until:
+            ranges.append((watermark, until))
+        return ranges
+
+    def update(self, metric, since, resolution=None):
+        """Feed the store with data for metric from since up to the fine
+        step before the newest complete one, fetching only ranges it
+        doesn't already hold (at resolution, if given)."""
+        if metric in self._ingesting:
+            # the update in progress may not reach back to since
+            d = Deferred()
+            self._ingesting[metric].append(d)
+            return d.addCallback(
+                lambda _: self.update(metric, since, resolution))
+        agg = self.metrics_source.aggregation_method(metric)
+        now = self.clock.seconds()
+        # Graphite may still be receiving data for the newest fine step
+        until = (math.floor(now / self.fine_step) - 1) * self.fine_step
+        ranges = self.missing_ranges(metric, agg, since, until, resolution)
+        if not ranges:
+            return succeed(None)
+        waiters = []
+        self._ingesting[metric] = waiters
+
+        def ingest(points, since, until):
+            points = [(t / 1000.0, v) for t, v in points]
+            self.store.ingest(metric, agg, points, since, until)
+
+        fetches = []
+        for range_since, range_until in ranges:
+            d = maybeDeferred(self.metrics_source.get_history, metric,
+                              self._relative(range_since, now),
+                              self._relative(range_until, now),
+                              timedelta(seconds=self.fine_step), True)
+            fetches.append(d.addCallback(ingest, range_since, range_until))
+
+        def done(result):
+            del self._ingesting[metric]
+            for waiter in waiters:
+                waiter.callback(None)
+            return result
+        d = gatherResults(fetches, consumeErrors=True)
+        d.addErrback(lambda f: f.value.subFailure)
+        return d.addBoth(done)
+
+    def close(self):
+        self.store.close()
+
+    def get_rollup_history(self, metric, start, summary_size, skip_nulls):
+        resolution = self.total_seconds(summary_size)
+        agg = self.metrics_source.aggregation_method(metric)
+        now = self.clock.seconds()
+        first = math.floor((now + self.total_seconds(start)) /
+                           resolution) * resolution
+        newest = math.floor(now / resolution) * resolution
+        d = self.update(metric, first, resolution)
+
+        def fetch_newest(_):
+            return self.metrics_source.get_history(
+                metric, self._relative(newest, now), timedelta(0),
+                summary_size, skip_nulls)
+
+        def combine(live_points):
+            # the series may have been closed while fetching
+            series = self.store.series(metric, resolution, agg)
+            points = [(t * 1000, v) for t, v in series.buckets(first, newest)]
+            if skip_nulls:
+                points = [(t, v) for t, v in points if v is not None]
+            else:
+                points = [(t, v if v is not None else 0.0)
+                          for t, v in points]
+            return points + list(live_points[-1:])
+        d.addCallback(fetch_newest)
+        return d.addCallback(combine)
+
+    def get_history(self, metric, start, end, summary_size, skip_nulls=True):
+        if not self.use_rollups(start, end, summary_size):
+            return self.metrics_source.get_history(metric, start, end,
+                                                   summary_size, skip_nulls)
+        return self.get_rollup_history(metric, start, summary_size,
+                                       skip_nulls)
+
+    def get_series(self, target, start, end, summary_size):
+        return self.metrics_source.get_series(target, start, end,
+                                              summary_size)
+
+    def get_latest(self, metric, start, end, summary_size, skip_nulls=True):
+        if not self.use_rollups(start, end, summary_size):
+            return self.metrics_source.get_latest(metric, start, end,
+                                                  summary_size, skip_nulls)
+        d = self.get_rollup_history(metric, start, summary_size, skip_nulls)
+        return d.addCallback(filter_latest)
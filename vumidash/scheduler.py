@@ -0,0 +1,193 @@
+# -*- test-case-name: vumidash.tests.test_scheduler -*-
+
+"""Schedulers that call a function with batches of items as they fall due.
+
+   Both schedulers share an interface: items are added with
+   :meth:`schedule` and the `process` function passed to the scheduler is
+   called with a list of `(time, item)` pairs for each batch of items
+   that falls due.
+
+   :class:`HeapScheduler` keeps items in a heap and makes one reactor call
+   per distinct due time, so its batches hold items due at exactly the
+   same time.
+
+   :class:`TimingWheel` keeps items in a hierarchical timing wheel and
+   makes one reactor call per `resolution` seconds however many items are
+   scheduled. Its batches hold every item due in the same slot and items
+   are processed up to `resolution` seconds late.
+   """
+
+import math
+import heapq
+from itertools import count
+
+
+class HeapScheduler(object):
+    """Schedule items using a heap.
+
+    :param clock: Reactor (or :class:`twisted.internet.task.Clock`) to
+        schedule calls with.
+    :param process: Function called with each batch of due items.
+    """
+
+    def __init__(self, clock, process):
+        self.clock = clock
+        self.process = process
+        self._heap = []
+        self._counter = count()
+        self._call = None
+        self._call_time = None
+        self.running = False
+
+    def __len__(self):
+        return len(self._heap)
+
+    def start(self):
+        self.running = True
+        self._reschedule()
+
+    def stop(self):
+        self.running = False
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+
+    def schedule(self, t, item):
+        """Process item at time t."""
+        # the counter stops the heap from comparing items
+        heapq.heappush(self._heap, (t, next(self._counter), item))
+        if self._call is None or t < self._call_time:
+            self._reschedule()
+
+    def _reschedule(self):
+        if not self.running or not self._heap:
+            return
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call_time = self._heap[0][0]
+        self._call = self.clock.callLater(
+            max(self._call_time - self.clock.seconds(), 0), self._fire)
+
+    def _fire(self):
+        self._call = None
+        t = self._heap[0][0]
+        due = []
+        while self._heap and self._heap[0][0] == t:
+            due.append((t, heapq.heappop(self._heap)[2]))
+        self.process(due)
+        if self._call is None:
+            self._reschedule()
+
+
+class TimingWheel(object):
+    """Schedule items using a hierarchical timing wheel.
+
+    Level 0 of the wheel has `slots` slots of `resolution` seconds each.
+    Each higher level has `slots` slots covering a whole turn of the level
+    below it. Items are placed on the lowest level whose range covers
+    them and move down a level each time the level below completes a
+    turn. Items beyond the range of the top level wait in an overflow
+    list. Adding an item and moving it down a level both take constant
+    time.
+
+    :param clock: Reactor (or :class:`twisted.internet.task.Clock`) to
+        schedule calls with.
+    :param process: Function called with each batch of due items.
+    :type resolution: float
+    :param resolution: Seconds per slot.
+    :type slots: int
+    :param slots: Number of slots on each level.
+    :type levels: int
+    :param levels: Number of levels.
+    """
+
+    def __init__(self, clock, process, resolution=1.0, slots=64, levels=3):
+        self.clock = clock
+        self.process = process
+        self.resolution = float(resolution)
+        self.slots = slots
+        self.levels = levels
+        self.wheels = [[[] for _ in range(slots)] for _ in range(levels)]
+        self.overflow = []
+        # the last tick processed
+        self.tick = None
+        self._count = 0
+        self._call = None
+        self.running = False
+
+    def __len__(self):
+        return self._count
+
+    def _tick_of(self, t):
+        return int(math.ceil(t / self.resolution))
+
+    def _current_tick(self):
+        # allow for rounding errors in the time of reactor calls
+        return int(math.floor(self.clock.seconds() / self.resolution + 1e-9))
+
+    def start(self):
+        self.running = True
+        if self.tick is None:
+            self.tick = self._current_tick()
+        self._schedule_next()
+
+    def stop(self):
+        self.running = False
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+
+    def schedule(self, t, item):
+        """Process item in the first slot ending at or after time t."""
+        if self.tick is None:
+            self.tick = self._current_tick()
+        self._count += 1
+        # items due now or earlier go in the next slot
+        self._place(max(self._tick_of(t), self.tick + 1), t, item)
+
+    def _place(self, tick, t, item):
+        delta = tick - self.tick
+        span = 1
+        for level in range(self.levels):
+            if delta < span * self.slots:
+                slot = (tick // span) % self.slots
+                self.wheels[level][slot].append((tick, t, item))
+                return
+            span *= self.slots
+        self.overflow.append((tick, t, item))
+
+    def _schedule_next(self):
+        if not self.running:
+            return
+        delay = (self.tick + 1) * self.resolution - self.clock.seconds()
+        self._call = self.clock.callLater(max(delay, 0), self._advance)
+
+    def _cascade(self):
+        span = self.slots ** self.levels
+        if self.tick % span == 0:
+            overflow, self.overflow = self.overflow, []
+            for entry in overflow:
+                self._place(*entry)
+        for level in reversed(range(1, self.levels)):
+            span = self.slots ** level
+            if self.tick % span == 0:
+                slot = (self.tick // span) % self.slots
+                entries = self.wheels[level][slot]
+                self.wheels[level][slot] = []
+                for entry in entries:
+                    self._place(*entry)
+
+    def _advance(self):
+        self._call = None
+        target = self._current_tick()
+        while self.tick < target:
+            self.tick += 1
+            self._cascade()
+            slot = self.tick % self.slots
+            entries = self.wheels[0][slot]
+            if not entries:
+                continue
+            self.wheels[0][slot] = []
+            self._count -= len(entries)
+            self.process([(t, item) for _tick, t, item in entries])
+        self._schedule_next()
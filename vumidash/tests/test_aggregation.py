@@ -0,0 +1,81 @@
+"""Tests for vumidash.aggregation."""
+
+from twisted.trial import unittest
+
+from vumidash.aggregation import (
+    parse_operator, align, aggregate_series, latest_values)
+
+
+class TestParseOperator(unittest.TestCase):
+
+    def test_simple(self):
+        self.assertEqual(parse_operator('sum'), ('sum', None))
+        self.assertEqual(parse_operator('mean'), ('mean', None))
+        self.assertEqual(parse_operator('rate'), ('rate', None))
+
+    def test_percentile(self):
+        self.assertEqual(parse_operator('p95'), ('percentile', 95.0))
+        self.assertEqual(parse_operator('p99.9'), ('percentile', 99.9))
+        self.assertRaises(ValueError, parse_operator, 'p101')
+
+    def test_top(self):
+        self.assertEqual(parse_operator('top5'), ('top', 5))
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, parse_operator, 'median')
+        self.assertRaises(ValueError, parse_operator, 'top')
+
+
+class TestAggregation(unittest.TestCase):
+
+    SERIES = [
+        ('a', [(0, 1.0), (60, 2.0), (120, 3.0)]),
+        ('b', [(0, 10.0), (60, None), (120, 30.0)]),
+        ('c', [(0, 100.0), (60, 200.0), (120, None)]),
+        ]
+
+    def test_align_pads_short_series(self):
+        names, times, rows = align([('a', [1, 2, 3]), ('b', [4])])
+        self.assertEqual(names, ['a', 'b'])
+        self.assertEqual(times, None)
+        self.assertEqual(rows, [[1, 2, 3], [None, None, 4]])
+
+    def test_align_empty(self):
+        self.assertEqual(align([]), ([], None, []))
+
+    def test_sum(self):
+        self.assertEqual(aggregate_series('sum', self.SERIES, 60, 'total'), [
+            ('total', [(0, 111.0), (60, 202.0), (120, 33.0)])])
+
+    def test_mean(self):
+        [(_name, points)] = aggregate_series('mean', self.SERIES, 60)
+        self.assertEqual(points, [(0, 37.0), (60, 101.0), (120, 16.5)])
+
+    def test_percentile(self):
+        [(_name, points)] = aggregate_series('p50', self.SERIES, 60)
+        self.assertEqual(points, [(0, 10.0), (60, 2.0), (120, 3.0)])
+        [(_name, points)] = aggregate_series('p100', self.SERIES, 60)
+        self.assertEqual(points, [(0, 100.0), (60, 200.0), (120, 30.0)])
+
+    def test_top(self):
+        result = aggregate_series('top2', self.SERIES, 60)
+        self.assertEqual([name for name, _points in result], ['c', 'b'])
+        self.assertEqual(result[0][1], self.SERIES[2][1])
+
+    def test_rate(self):
+        [(_name, points)] = aggregate_series('rate', self.SERIES, 60)
+        self.assertEqual(points, [(0, None), (60, 91.0 / 60),
+                                  (120, -169.0 / 60)])
+
+    def test_bare_values(self):
+        result = aggregate_series('sum', [('a', [1, 2]), ('b', [3, None])], 1)
+        self.assertEqual(result, [(None, [4, 2])])
+
+    def test_no_series(self):
+        self.assertEqual(aggregate_series('sum', [], 60), [(None, [])])
+        self.assertEqual(aggregate_series('rate', [], 60), [(None, [])])
+
+    def test_latest_values(self):
+        self.assertEqual(latest_values([(0, None), (1, 2.0), (2, 3.0)]),
+                         (2.0, 3.0))
+        self.assertEqual(latest_values([None, None]), (None, None))
@@ -1,19 +1,32 @@
 """Tests for vumidash.gecko_imager."""
 
 import os
+import math
+import base64
+import hashlib
+import threading
+from cStringIO import StringIO
 from xml.dom import minidom
 
 from twisted.trial import unittest
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import inlineCallbacks, returnValue, gatherResults
 from twisted.internet import reactor, threads
-from twisted.web.client import getPage
+from twisted.internet.task import Clock
+from twisted.web.client import getPage, Agent, readBody
+from twisted.web.http_headers import Headers
 from twisted.web import http
 from twisted.web.server import Site
 from twisted.web.resource import Resource
 
+from selenium.common.exceptions import TimeoutException
+
 from vumidash import gecko_imager
+from vumidash.gecko_imager import (Image, image_difference, image_formats,
+                                   image_variants, crop_widgets,
+                                   widget_variant)
 from vumidash.gecko_imager import (DashboardImager, DashboardCache,
-                                   GeckoImageServer)
+                                   GeckoImageServer, WebDriverPool,
+                                   ImageStore)
 
 
 class MockGeckoboardResource(Resource):
@@ -59,6 +72,208 @@ class TestDashboardImager(unittest.TestCase):
         self.assertEqual(png[:8], "\x89PNG\r\n\x1A\n")
 
 
+class FakeWebDriver(object):
+    """Local stand-in for a Selenium remote WebDriver."""
+
+    drivers = []
+
+    # number of readiness checks before all widgets are loaded
+    ready_after = 1
+    widgets = 3
+
+    def __init__(self, remote, capabilities):
+        self.remote = remote
+        self.urls = []
+        self.scripts = []
+        self.alive = True
+        self.broken = False
+        self.drivers.append(self)
+
+    @property
+    def current_url(self):
+        if not self.alive:
+            raise Exception("Session is gone.")
+        return self.urls[-1] if self.urls else "about:blank"
+
+    def get(self, url):
+        self.urls.append(url)
+
+    def execute_script(self, script):
+        assert script == DashboardImager.READY_SCRIPT
+        self.scripts.append(self.urls[-1])
+        boxes = [[0, 100 * i, 200, 100 * (i + 1)]
+                 for i in range(self.widgets)]
+        if len(self.scripts) < self.ready_after:
+            return [self.widgets - 1, self.widgets, boxes]
+        return [self.widgets, self.widgets, boxes]
+
+    def get_screenshot_as_base64(self):
+        if self.broken:
+            raise Exception("Screenshot failed.")
+        return base64.encodestring("PNG of %s" % (self.urls[-1],))
+
+    def quit(self):
+        self.alive = False
+
+
+class TestWebDriverPool(unittest.TestCase):
+
+    def setUp(self):
+        self.patch(FakeWebDriver, 'drivers', [])
+        self.patch(gecko_imager.webdriver, 'Remote', FakeWebDriver)
+        self.pool = WebDriverPool("http://example.com/selenium", size=2,
+                                  max_renders=3)
+        self.imager = DashboardImager("http://example.com/selenium",
+                                      "http://example.com/dash1",
+                                      driver_pool=self.pool)
+
+    def test_single_round_trip_readiness(self):
+        self.patch(DashboardImager, 'POLL_INTERVAL', 0.01)
+        self.patch(FakeWebDriver, 'ready_after', 3)
+        self.assertEqual(self.imager.generate_png(),
+                         "PNG of http://example.com/dash1")
+        [driver] = FakeWebDriver.drivers
+        self.assertEqual(driver.scripts, ["http://example.com/dash1"] * 3)
+
+    def test_widget_boxes(self):
+        self.assertEqual(self.imager.widget_boxes, None)
+        self.imager.generate_png()
+        self.assertEqual(self.imager.widget_boxes, [
+            (0, 0, 200, 100), (0, 100, 200, 200), (0, 200, 200, 300)])
+
+    def test_page_not_laid_out(self):
+        driver = FakeWebDriver("http://example.com/selenium", None)
+        driver.execute_script = lambda script: None
+        self.assertFalse(self.imager._page_ready(driver))
+
+    def test_timeout(self):
+        self.patch(DashboardImager, 'POLL_INTERVAL', 0.01)
+        self.patch(FakeWebDriver, 'ready_after', 1000)
+        imager = DashboardImager("http://example.com/selenium",
+                                 "http://example.com/dash1",
+                                 driver_pool=self.pool, timeout=0.05)
+        self.assertRaises(TimeoutException, imager.generate_png)
+        [driver] = FakeWebDriver.drivers
+        self.assertFalse(driver.alive)
+
+    def test_generate_png_without_pool(self):
+        imager = DashboardImager("http://example.com/selenium",
+                                 "http://example.com/dash1")
+        self.assertEqual(imager.generate_png(),
+                         "PNG of http://example.com/dash1")
+        self.assertEqual(imager.generate_png(),
+                         "PNG of http://example.com/dash1")
+        self.assertEqual([d.alive for d in FakeWebDriver.drivers],
+                         [False, False])
+
+    def test_reuses_session(self):
+        for _ in range(2):
+            self.assertEqual(self.imager.generate_png(),
+                             "PNG of http://example.com/dash1")
+        [driver] = FakeWebDriver.drivers
+        self.assertEqual(len(driver.urls), 2)
+        self.assertTrue(driver.alive)
+
+    def test_pool_size(self):
+        sessions = [self.pool.acquire(), self.pool.acquire()]
+        self.assertEqual(len(FakeWebDriver.drivers), 2)
+        self.assertTrue(self.pool.slots.empty())
+        for session in sessions:
+            self.pool.release(session)
+        self.pool.acquire()
+        self.assertEqual(len(FakeWebDriver.drivers), 2)
+
+    def test_recycle_after_max_renders(self):
+        for _ in range(4):
+            self.imager.generate_png()
+        first, second = FakeWebDriver.drivers
+        self.assertEqual(len(first.urls), 3)
+        self.assertFalse(first.alive)
+        self.assertEqual(len(second.urls), 1)
+        self.assertEqual(self.pool.stats["recycled"], 1)
+
+    def test_recycle_on_failure(self):
+        self.imager.generate_png()
+        [driver] = FakeWebDriver.drivers
+        driver.broken = True
+        self.assertRaises(Exception, self.imager.generate_png)
+        self.assertFalse(driver.alive)
+        self.imager.generate_png()
+        self.assertEqual(len(FakeWebDriver.drivers), 2)
+
+    def test_unhealthy_session(self):
+        self.imager.generate_png()
+        [driver] = FakeWebDriver.drivers
+        driver.alive = False
+        self.imager.generate_png()
+        self.assertEqual(len(FakeWebDriver.drivers), 2)
+        self.assertEqual(self.pool.stats["unhealthy"], 1)
+
+    def test_failed_start(self):
+        def fail(remote, capabilities):
+            raise Exception("No browsers available.")
+        self.patch(gecko_imager.webdriver, 'Remote', fail)
+        self.assertRaises(Exception, self.pool.acquire)
+        self.assertRaises(Exception, self.pool.acquire)
+        self.patch(gecko_imager.webdriver, 'Remote', FakeWebDriver)
+        self.pool.acquire()
+        self.pool.acquire()
+        self.assertEqual(len(FakeWebDriver.drivers), 2)
+
+    def test_close(self):
+        session = self.pool.acquire()
+        self.imager.generate_png()
+        in_use, idle = FakeWebDriver.drivers
+        self.pool.close()
+        self.assertFalse(idle.alive)
+        self.assertTrue(in_use.alive)
+        self.pool.release(session)
+        self.assertFalse(in_use.alive)
+
+
+class TestImageStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = os.path.join(self.mktemp(), "images")
+        self.store = ImageStore(self.directory)
+
+    def test_creates_directory(self):
+        self.assertTrue(os.path.isdir(self.directory))
+
+    def test_write_and_load(self):
+        path = self.store.write("dash1", "A PNG.")
+        self.assertEqual(path, os.path.join(self.directory, "dash1.png"))
+        self.assertEqual(os.listdir(self.directory), ["dash1.png"])
+        path, etag, last_modified = self.store.load("dash1")
+        self.assertEqual(open(path, "rb").read(), "A PNG.")
+        self.assertEqual(etag, '"%s"' % (hashlib.sha1("A PNG.").hexdigest(),))
+        self.assertEqual(last_modified, os.stat(path).st_mtime)
+
+    def test_load_missing(self):
+        self.assertEqual(self.store.load("dash1"), None)
+
+    def test_write_and_load_variant(self):
+        path = self.store.write("dash1", "A WebP.", ("thumbnail", "webp"))
+        self.assertEqual(path, os.path.join(self.directory,
+                                            "dash1.thumbnail.webp"))
+        self.assertEqual(self.store.load("dash1"), None)
+        path, etag, _ = self.store.load("dash1", ("thumbnail", "webp"))
+        self.assertEqual(open(path, "rb").read(), "A WebP.")
+        self.assertEqual(self.store.load("dash1", ("medium", "webp")), None)
+
+    def test_variants(self):
+        self.store.write("dash1", "A PNG.")
+        self.store.write("dash1", "A WebP.", ("thumbnail", "webp"))
+        self.store.write("dash1", "A PNG.", ("widget-1", "png"))
+        self.store.write("dash1.a", "A PNG.")
+        self.assertEqual(sorted(self.store.variants("dash1")),
+                         [("thumbnail", "webp"), ("widget-1", "png")])
+        self.store.remove("dash1", ("widget-1", "png"))
+        self.store.remove("dash1", ("widget-2", "png"))
+        self.assertEqual(self.store.variants("dash1"),
+                         [("thumbnail", "webp")])
+
+
 class DummyImager(DashboardImager):
     """Dummy imager for testing."""
 
@@ -83,7 +298,7 @@ class TestDashboardCache(unittest.TestCase):
 
     @inlineCallbacks
     def test_refresh_images(self):
-        yield self.cache._refresh_images()
+        yield self.cache.refresh_images()
         self.assertEqual(self.cache.pngs, {
             "dash1": "A dummy PNG.",
             "dash2": "A dummy PNG.",
@@ -91,7 +306,7 @@ class TestDashboardCache(unittest.TestCase):
 
     @inlineCallbacks
     def test_get_png(self):
-        yield self.cache._refresh_images()
+        yield self.cache.refresh_images()
         png = self.cache.get_png("dash1")
         self.assertEqual(png, "A dummy PNG.")
 
@@ -99,6 +314,30 @@ class TestDashboardCache(unittest.TestCase):
         png = self.cache.get_png("dash1")
         self.assertEqual(png, None)
 
+    @inlineCallbacks
+    def test_validators(self):
+        clock = Clock()
+        self.patch(DashboardCache, 'clock', clock)
+        self.assertEqual(self.cache.get_validators("dash1"), None)
+        clock.advance(10)
+        yield self.cache.refresh_images()
+        etag, last_modified = self.cache.get_validators("dash1")
+        self.assertEqual(etag, '"%s"' % (
+            hashlib.sha1("A dummy PNG.").hexdigest(),))
+        self.assertEqual(last_modified, 10)
+        # an unchanged image keeps its Last-Modified time
+        clock.advance(10)
+        yield self.cache.refresh_images()
+        self.assertEqual(self.cache.get_validators("dash1"), (etag, 10))
+        self.cache.dashboards["dash1"].generate_png = lambda: "New PNG."
+        clock.advance(10)
+        yield self.cache.refresh_images()
+        new_etag, last_modified = self.cache.get_validators("dash1")
+        self.assertNotEqual(new_etag, etag)
+        self.assertEqual(last_modified, 30)
+        self.cache.clear()
+        self.assertEqual(self.cache.get_validators("dash1"), None)
+
     @inlineCallbacks
     def test_start_and_stop(self):
         self.cache.start()
@@ -120,7 +359,7 @@ class TestDashboardCache(unittest.TestCase):
             raise FailedPng("No PNG. :(")
 
         self.cache.dashboards["dash1"].generate_png = fail
-        yield self.cache._refresh_images()
+        yield self.cache.refresh_images()
         errors = self.flushLoggedErrors(FailedPng)
         self.assertEqual(len(errors), 1)
         self.assertEqual(self.cache.pngs, {
@@ -128,19 +367,518 @@ class TestDashboardCache(unittest.TestCase):
             "dash2": "A dummy PNG.",
             })
 
+    @inlineCallbacks
+    def test_failed_store(self):
+        class FailedStore(Exception):
+            pass
+
+        def store_png(result, name):
+            raise FailedStore("Disk full.")
+
+        self.cache._store_png = store_png
+        yield self.cache.refresh_images()
+        self.assertEqual(len(self.flushLoggedErrors(FailedStore)), 2)
+        self.assertEqual(self.cache.rendering, set())
+        # later renders and stopping aren't blocked by the failure
+        yield self.cache.queue_render("dash1")
+        self.assertEqual(len(self.flushLoggedErrors(FailedStore)), 1)
+        yield self.cache.stop()
+
     @inlineCallbacks
     def test_clear_cache(self):
-        yield self.cache._refresh_images()
+        yield self.cache.refresh_images()
         self.cache.clear()
         self.assertEqual(self.cache.pngs, {
             "dash1": None,
             "dash2": None,
             })
 
+    @inlineCallbacks
+    def test_image_store(self):
+        image_dir = self.mktemp()
+        cache = DashboardCache("http://example.com/selenium", {
+            "dash1": {"url": "http://example.com/dash1"},
+            }, 5, image_dir=image_dir)
+        self.addCleanup(cache.stop)
+        yield cache.refresh_images()
+        path = os.path.join(image_dir, "dash1.png")
+        self.assertEqual(cache.pngs, {"dash1": path})
+        self.assertEqual(open(path, "rb").read(), "A dummy PNG.")
+        self.assertEqual(cache.open_png("dash1").read(), "A dummy PNG.")
+
+        # a new cache serves the stored image straight away
+        cache = DashboardCache("http://example.com/selenium", {
+            "dash1": {"url": "http://example.com/dash1"},
+            "dash2": {"url": "http://example.com/dash2"},
+            }, 5, image_dir=image_dir)
+        cache.load_images()
+        self.assertEqual(cache.pngs, {"dash1": path, "dash2": None})
+        self.assertEqual(cache.open_png("dash1").read(), "A dummy PNG.")
+        self.assertEqual(cache.open_png("dash2"), None)
+        etag, _ = cache.get_validators("dash1")
+        self.assertEqual(etag, '"%s"' % (
+            hashlib.sha1("A dummy PNG.").hexdigest(),))
+
+    def test_open_png_in_memory(self):
+        self.assertEqual(self.cache.open_png("dash1"), None)
+        self.cache._store_png(("A PNG.", '"etag"', True, {}, None), "dash1")
+        self.assertEqual(self.cache.open_png("dash1").read(), "A PNG.")
+
     def test_title(self):
         self.assertEqual(self.cache.dashboards["dash1"].title, "Dash1")
         self.assertEqual(self.cache.dashboards["dash2"].title, "Foo")
 
+    @inlineCallbacks
+    def test_thread_pool_size(self):
+        cache = DashboardCache("http://example.com/selenium", {
+            "dash1": {"url": "http://example.com/dash1"},
+            }, 5, pool_size=3)
+        self.addCleanup(cache.stop)
+        self.assertEqual(cache.driver_pool.size, 3)
+        yield cache.refresh_images()
+        self.assertEqual(cache.thread_pool.max, 3)
+
+    @inlineCallbacks
+    def test_parallel_refresh(self):
+        cache = DashboardCache("http://example.com/selenium", {
+            "dash1": {"url": "http://example.com/dash1"},
+            "dash2": {"url": "http://example.com/dash2"},
+            }, 5, pool_size=2)
+        self.addCleanup(cache.stop)
+        started = []
+        both_started = threading.Event()
+
+        def render():
+            started.append(None)
+            if len(started) == 2:
+                both_started.set()
+            # renders done one at a time would give up waiting
+            both_started.wait(2)
+            return "parallel" if both_started.isSet() else "serial"
+
+        for imager in cache.dashboards.values():
+            imager.generate_png = render
+        yield cache.refresh_images()
+        self.assertEqual(cache.pngs, {
+            "dash1": "parallel",
+            "dash2": "parallel",
+            })
+
+    @inlineCallbacks
+    def test_stop_thread_pool(self):
+        yield self.cache.refresh_images()
+        thread_pool = self.cache.thread_pool
+        self.assertTrue(thread_pool.started)
+        yield self.cache.stop()
+        self.assertFalse(thread_pool.started)
+        self.assertEqual(self.cache.thread_pool, None)
+        self.cache.clear()
+        yield self.cache.refresh_images()
+        self.assertTrue(self.cache.thread_pool.started)
+
+
+def mk_png(size=(100, 100), box=None):
+    """Return a white PNG, with a black box over box if given."""
+    image = Image.new("RGB", size, "white")
+    if box is not None:
+        image.paste("black", box)
+    f = StringIO()
+    image.save(f, "PNG")
+    return f.getvalue()
+
+
+class TestChangeDetection(unittest.TestCase):
+
+    timeout = 5
+
+    def setUp(self):
+        self.clock = Clock()
+        self.patch(DashboardCache, 'clock', self.clock)
+        self.patch(gecko_imager, 'DashboardImager', DummyImager)
+
+    def mk_cache(self, **kw):
+        cache = DashboardCache("http://example.com/selenium", {
+            "dash1": {"url": "http://example.com/dash1"},
+            }, 10, **kw)
+        self.addCleanup(cache.stop)
+        return cache
+
+    def set_png(self, cache, png):
+        cache.dashboards["dash1"].generate_png = lambda: png
+
+    @inlineCallbacks
+    def test_unchanged_image_not_stored(self):
+        cache = self.mk_cache(image_dir=self.mktemp())
+        writes = []
+        write = cache.store.write
+        cache.store.write = lambda *args: writes.append(args) or write(*args)
+        yield cache.refresh_images()
+        self.clock.advance(10)
+        yield cache.refresh_images()
+        self.assertEqual(writes, [("dash1", "A dummy PNG.")])
+        self.assertEqual(cache.validators["dash1"][1], 0)
+
+    @inlineCallbacks
+    def test_backoff(self):
+        cache = self.mk_cache(max_backoff=4)
+        intervals = []
+        for _ in range(4):
+            yield cache.queue_render("dash1")
+            intervals.append(cache.refresh_interval("dash1", 0))
+        self.assertEqual(intervals, [10, 20, 40, 40])
+        self.set_png(cache, "A new PNG.")
+        yield cache.queue_render("dash1")
+        self.assertEqual(cache.refresh_interval("dash1", 0), 10)
+        self.assertEqual(cache.get_png("dash1"), "A new PNG.")
+
+    def test_diff_threshold_requires_pil(self):
+        if Image is not None:
+            raise unittest.SkipTest("PIL is installed.")
+        self.assertRaises(ValueError, self.mk_cache, diff_threshold=0.01)
+
+    def test_image_variants_require_pil(self):
+        if Image is not None:
+            raise unittest.SkipTest("PIL is installed.")
+        self.assertRaises(ValueError, self.mk_cache, image_variants=True)
+
+    def test_image_difference(self):
+        if Image is None:
+            raise unittest.SkipTest("PIL is required.")
+        png = mk_png()
+        self.assertEqual(image_difference(png, png), 0.0)
+        self.assertEqual(image_difference(png, mk_png(box=(0, 0, 10, 10))),
+                         0.01)
+        self.assertEqual(image_difference(png, mk_png(size=(10, 10))), 1.0)
+
+    @inlineCallbacks
+    def test_diff_threshold(self):
+        if Image is None:
+            raise unittest.SkipTest("PIL is required.")
+        cache = self.mk_cache(diff_threshold=0.01)
+        self.set_png(cache, mk_png())
+        yield cache.queue_render("dash1")
+        etag = cache.validators["dash1"][0]
+        # a small change, such as a clock ticking, is ignored
+        self.set_png(cache, mk_png(box=(0, 0, 5, 5)))
+        yield cache.queue_render("dash1")
+        self.assertEqual(cache.validators["dash1"][0], etag)
+        self.assertEqual(cache.get_png("dash1"), mk_png())
+        self.set_png(cache, mk_png(box=(0, 0, 50, 50)))
+        yield cache.queue_render("dash1")
+        self.assertNotEqual(cache.validators["dash1"][0], etag)
+
+
+class TestImageVariants(unittest.TestCase):
+
+    timeout = 5
+
+    def setUp(self):
+        if Image is None:
+            raise unittest.SkipTest("PIL is required.")
+        self.clock = Clock()
+        self.patch(DashboardCache, 'clock', self.clock)
+        self.patch(gecko_imager, 'DashboardImager', DummyImager)
+        self.png = mk_png(size=(1000, 500), box=(0, 0, 100, 100))
+
+    def mk_cache(self, **kw):
+        cache = DashboardCache("http://example.com/selenium", {
+            "dash1": {"url": "http://example.com/dash1"},
+            }, 10, image_variants=True, **kw)
+        self.addCleanup(cache.stop)
+        cache.dashboards["dash1"].generate_png = lambda: self.png
+        return cache
+
+    def test_image_variants(self):
+        variants = image_variants(self.png, ["png"])
+        self.assertEqual(sorted(variants), [
+            ("full", "png"), ("medium", "png"), ("thumbnail", "png")])
+        sizes = dict((size, Image.open(StringIO(png)).size)
+                     for (size, _), png in variants.items())
+        self.assertEqual(sizes, {"thumbnail": (320, 160),
+                                 "medium": (800, 400),
+                                 "full": (1000, 500)})
+        self.assertEqual(image_difference(variants[("full", "png")],
+                                          self.png), 0.0)
+
+    def test_image_variants_not_enlarged(self):
+        variants = image_variants(mk_png(size=(100, 50)), ["png"])
+        self.assertEqual(Image.open(StringIO(
+            variants[("thumbnail", "png")])).size, (100, 50))
+
+    def test_webp(self):
+        if "webp" not in image_formats():
+            raise unittest.SkipTest("PIL WebP support is required.")
+        variants = image_variants(self.png, ["webp"])
+        image = Image.open(StringIO(variants[("full", "webp")]))
+        self.assertEqual(image.format, "WEBP")
+        self.assertEqual(image.size, (1000, 500))
+
+    @inlineCallbacks
+    def test_render_variants(self):
+        cache = self.mk_cache()
+        self.assertEqual(cache.open_png("dash1", ("thumbnail", "png")), None)
+        self.assertEqual(cache.get_validators("dash1", ("thumbnail", "png")),
+                         None)
+        yield cache.queue_render("dash1")
+        self.assertEqual(sorted(cache.variants["dash1"]),
+                         sorted(cache.variant_keys()))
+        png = cache.open_png("dash1", ("thumbnail", "png")).read()
+        self.assertEqual(Image.open(StringIO(png)).size, (320, 160))
+        etag, last_modified = cache.get_validators("dash1",
+                                                   ("thumbnail", "png"))
+        self.assertEqual(etag, '"%s"' % (hashlib.sha1(png).hexdigest(),))
+        self.assertEqual(last_modified, cache.get_validators("dash1")[1])
+        self.assertEqual(cache.get_png("dash1"), self.png)
+
+    @inlineCallbacks
+    def test_stored_variants(self):
+        image_dir = self.mktemp()
+        cache = self.mk_cache(image_dir=image_dir)
+        yield cache.queue_render("dash1")
+        self.assertEqual(len(os.listdir(image_dir)),
+                         1 + len(cache.variant_keys()))
+        variants = dict(cache.variants["dash1"])
+        cache.clear()
+        cache.load_images()
+        self.assertEqual(cache.variants["dash1"], variants)
+        path, _ = variants[("medium", "png")]
+        self.assertEqual(
+            cache.open_png("dash1", ("medium", "png")).read(),
+            open(path, "rb").read())
+
+    @inlineCallbacks
+    def test_missing_variants_encoded(self):
+        image_dir = self.mktemp()
+        ImageStore(image_dir).write("dash1", self.png)
+        cache = self.mk_cache(image_dir=image_dir)
+        cache.load_images()
+        self.assertEqual(cache.variants["dash1"], {})
+        yield cache.queue_render("dash1")
+        self.assertEqual(sorted(cache.variants["dash1"]),
+                         sorted(cache.variant_keys()))
+
+
+class TestWidgetImages(unittest.TestCase):
+
+    timeout = 5
+
+    def setUp(self):
+        if Image is None:
+            raise unittest.SkipTest("PIL is required.")
+        self.clock = Clock()
+        self.patch(DashboardCache, 'clock', self.clock)
+        self.patch(gecko_imager, 'DashboardImager', DummyImager)
+        self.png = mk_png(size=(400, 300), box=(0, 0, 200, 100))
+        self.boxes = [(0, 0, 200, 100), (200, 0, 400, 100)]
+
+    def mk_cache(self, **kw):
+        cache = DashboardCache("http://example.com/selenium", {
+            "dash1": {"url": "http://example.com/dash1"},
+            }, 10, widget_images=True, **kw)
+        self.addCleanup(cache.stop)
+        imager = cache.dashboards["dash1"]
+
+        def generate_png():
+            imager.widget_boxes = self.boxes
+            return self.png
+        imager.generate_png = generate_png
+        return cache
+
+    def open_image(self, cache, variant):
+        return Image.open(StringIO(cache.open_png("dash1", variant).read()))
+
+    def test_crop_widgets(self):
+        crops = crop_widgets(self.png, [(0, 0, 200, 100), (300, 200, 500, 400),
+                                        (500, 0, 600, 100)])
+        self.assertEqual(image_difference(crops[0], mk_png(
+            size=(200, 100), box=(0, 0, 200, 100))), 0.0)
+        self.assertEqual(Image.open(StringIO(crops[1])).size, (100, 100))
+        self.assertEqual(crops[2], None)
+
+    def test_widget_images_require_pil(self):
+        self.patch(gecko_imager, 'Image', None)
+        self.assertRaises(ValueError, self.mk_cache)
+
+    @inlineCallbacks
+    def test_render_widgets(self):
+        cache = self.mk_cache()
+        yield cache.queue_render("dash1")
+        self.assertEqual(sorted(cache.variants["dash1"]),
+                         [widget_variant(1), widget_variant(2)])
+        self.assertEqual(cache.widget_boxes["dash1"], self.boxes)
+        self.assertEqual(self.open_image(cache, widget_variant(1)).getcolors(),
+                         [(200 * 100, (0, 0, 0))])
+        self.assertEqual(self.open_image(cache, widget_variant(2)).getcolors(),
+                         [(200 * 100, (255, 255, 255))])
+
+    @inlineCallbacks
+    def test_unchanged_render_not_cropped(self):
+        cache = self.mk_cache()
+        yield cache.queue_render("dash1")
+        self.patch(gecko_imager, 'crop_widgets', None)
+        yield cache.queue_render("dash1")
+        self.assertEqual(len(cache.variants["dash1"]), 2)
+
+    @inlineCallbacks
+    def test_stored_widgets(self):
+        image_dir = self.mktemp()
+        cache = self.mk_cache(image_dir=image_dir)
+        yield cache.queue_render("dash1")
+        self.assertEqual(sorted(os.listdir(image_dir)), [
+            "dash1.png", "dash1.widget-1.png", "dash1.widget-2.png"])
+        self.boxes = self.boxes[:1]
+        self.png = mk_png(size=(400, 300))
+        yield cache.queue_render("dash1")
+        self.assertEqual(sorted(os.listdir(image_dir)), [
+            "dash1.png", "dash1.widget-1.png"])
+        cache.clear()
+        cache.load_images()
+        self.assertEqual(sorted(cache.variants["dash1"]), [widget_variant(1)])
+        self.assertEqual(self.open_image(cache, widget_variant(1)).getcolors(),
+                         [(200 * 100, (255, 255, 255))])
+
+
+class TestDashboardScheduling(unittest.TestCase):
+
+    timeout = 5
+
+    def setUp(self):
+        self.clock = Clock()
+        self.patch(DashboardCache, 'clock', self.clock)
+        self.patch(gecko_imager, 'DashboardImager', DummyImager)
+        self.rendered = []
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def mk_cache(self, **kw):
+        cache = DashboardCache("http://example.com/selenium", {
+            "dash1": {"url": "http://example.com/dash1"},
+            "dash2": {"url": "http://example.com/dash2"},
+            "dash3": {"url": "http://example.com/dash3",
+                      "update_interval": 30},
+            }, 10, **kw)
+        self.addCleanup(cache.stop)
+        for name, imager in cache.dashboards.items():
+            imager.generate_png = self.mk_render(name)
+        return cache
+
+    def mk_render(self, name):
+        def render():
+            if name == "dash1":
+                self.gate.wait(2)
+            self.rendered.append(name)
+            return "PNG of %s" % (name,)
+        return render
+
+    def due(self, cache):
+        now = self.clock.seconds()
+        return sorted(name for name in cache.dashboards
+                      if cache.is_due(name, now))
+
+    @inlineCallbacks
+    def test_per_dashboard_interval(self):
+        cache = self.mk_cache()
+        self.assertEqual(cache.intervals,
+                         {"dash1": 10, "dash2": 10, "dash3": 30})
+        self.assertEqual(cache.dashboards["dash3"].url,
+                         "http://example.com/dash3")
+        self.assertEqual(self.due(cache), ["dash1", "dash2", "dash3"])
+        yield cache.refresh_images()
+        self.assertEqual(self.due(cache), [])
+        self.clock.advance(10)
+        self.assertEqual(self.due(cache), ["dash1", "dash2"])
+        yield cache.refresh_images()
+        self.clock.advance(20)
+        self.assertEqual(self.due(cache), ["dash1", "dash2", "dash3"])
+
+    @inlineCallbacks
+    def test_idle_dashboards_pause(self):
+        cache = self.mk_cache(idle_timeout=60)
+        yield cache.refresh_images()
+        self.clock.advance(50)
+        cache.record_view("dash1")
+        self.clock.advance(10)
+        self.assertEqual(self.due(cache), ["dash1"])
+        self.assertEqual(cache.refresh_interval("dash2", 60), None)
+
+    @inlineCallbacks
+    def test_idle_dashboards_slow_down(self):
+        cache = self.mk_cache(idle_timeout=60, idle_interval=120)
+        yield cache.refresh_images()
+        self.clock.advance(60)
+        self.assertEqual(self.due(cache), [])
+        self.clock.advance(60)
+        self.assertEqual(self.due(cache), ["dash1", "dash2", "dash3"])
+
+    @inlineCallbacks
+    def test_view_renders_stale_dashboard(self):
+        cache = self.mk_cache(idle_timeout=60)
+        yield cache.refresh_images()
+        self.clock.advance(100)
+        self.rendered[:] = []
+        cache.record_view("dash2")
+        self.assertEqual(cache.rendering, set(["dash2"]))
+        yield cache.queue_render("dash2")
+        self.assertEqual(self.rendered, ["dash2"])
+        # a fresh image isn't rendered again
+        cache.record_view("dash2")
+        self.assertEqual(cache.rendering, set())
+
+    @inlineCallbacks
+    def test_view_jumps_queue(self):
+        cache = self.mk_cache()
+        self.gate.clear()
+        renders = [cache.queue_render(name)
+                   for name in ("dash1", "dash2", "dash3")]
+        self.assertEqual(cache.rendering, set(["dash1"]))
+        cache.record_view("dash3")
+        # only one render of a dashboard is queued or in progress
+        renders.append(cache.queue_render("dash1"))
+        self.gate.set()
+        yield gatherResults(renders)
+        self.assertEqual(self.rendered, ["dash1", "dash3", "dash2"])
+
+    @inlineCallbacks
+    def test_tick_only_queues_renders(self):
+        cache = self.mk_cache()
+        self.gate.clear()
+        self.assertEqual(cache._refresh_images(), None)
+        self.assertEqual(cache.rendering, set(["dash1"]))
+        self.assertEqual(sorted(cache.queued), ["dash2", "dash3"])
+        self.gate.set()
+        yield cache.queue_render("dash1")
+
+    @inlineCallbacks
+    def test_max_age(self):
+        cache = self.mk_cache(max_backoff=4, idle_timeout=60,
+                              idle_interval=120)
+        self.assertEqual(cache.max_age("dash1"), 10)
+        self.assertEqual(cache.max_age("dash3"), 30)
+        yield cache.queue_render("dash1")
+        yield cache.queue_render("dash1")
+        self.assertEqual(cache.max_age("dash1"), 20)
+        self.clock.advance(60)
+        self.assertEqual(cache.max_age("dash1"), 120)
+
+    def test_max_age_paused(self):
+        cache = self.mk_cache(idle_timeout=60)
+        self.clock.advance(60)
+        self.assertEqual(cache.max_age("dash3"), 30)
+
+    @inlineCallbacks
+    def test_stop_drops_queued_renders(self):
+        cache = self.mk_cache()
+        self.gate.clear()
+        renders = [cache.queue_render(name) for name in ("dash1", "dash2")]
+        d = cache.stop()
+        self.assertTrue(renders[1].called)
+        # stopping waits for renders in progress
+        self.assertFalse(d.called)
+        self.gate.set()
+        yield d
+        self.assertTrue(renders[0].called)
+        self.assertEqual(self.rendered, ["dash1"])
+
 
 class TestGeckoImageServer(unittest.TestCase):
 
@@ -178,10 +916,174 @@ class TestGeckoImageServer(unittest.TestCase):
 
     @inlineCallbacks
     def test_dashboard(self):
-        yield self.service.dashboard_cache._refresh_images()
+        yield self.service.dashboard_cache.refresh_images()
         result = yield self.get_route("/png/dash1")
         self.assertEqual(result, "A dummy PNG.")
 
+    @inlineCallbacks
+    def get_response(self, route, headers=None):
+        agent = Agent(reactor)
+        response = yield agent.request(
+            "GET", self.url + self.web_path + route,
+            Headers(dict((name, [value])
+                         for name, value in (headers or {}).items())))
+        body = yield readBody(response)
+        returnValue((response, body))
+
+    @inlineCallbacks
+    def test_dashboard_validators(self):
+        yield self.service.dashboard_cache.refresh_images()
+        etag, last_modified = (
+            self.service.dashboard_cache.get_validators("dash1"))
+        response, body = yield self.get_response("/png/dash1")
+        self.assertEqual(response.code, http.OK)
+        self.assertEqual(body, "A dummy PNG.")
+        headers = response.headers
+        self.assertEqual(headers.getRawHeaders("ETag"), [etag])
+        self.assertEqual(headers.getRawHeaders("Last-Modified"),
+                         [http.datetimeToString(math.ceil(last_modified))])
+        self.assertEqual(headers.getRawHeaders("Cache-Control"),
+                         ["public, max-age=30"])
+
+    @inlineCallbacks
+    def test_dashboard_if_none_match(self):
+        yield self.service.dashboard_cache.refresh_images()
+        etag, _ = self.service.dashboard_cache.get_validators("dash1")
+        response, body = yield self.get_response(
+            "/png/dash1", {"If-None-Match": etag})
+        self.assertEqual(response.code, http.NOT_MODIFIED)
+        self.assertEqual(body, "")
+        response, body = yield self.get_response(
+            "/png/dash1", {"If-None-Match": '"other"'})
+        self.assertEqual(response.code, http.OK)
+        self.assertEqual(body, "A dummy PNG.")
+
+    @inlineCallbacks
+    def test_dashboard_if_modified_since(self):
+        yield self.service.dashboard_cache.refresh_images()
+        _, last_modified = (
+            self.service.dashboard_cache.get_validators("dash1"))
+        response, body = yield self.get_response(
+            "/png/dash1", {"If-Modified-Since": http.datetimeToString(
+                math.ceil(last_modified))})
+        self.assertEqual(response.code, http.NOT_MODIFIED)
+        response, body = yield self.get_response(
+            "/png/dash1", {"If-Modified-Since": http.datetimeToString(
+                last_modified - 60)})
+        self.assertEqual(response.code, http.OK)
+        self.assertEqual(body, "A dummy PNG.")
+        # a stale ETag wins over a fresh If-Modified-Since
+        response, body = yield self.get_response(
+            "/png/dash1", {"If-None-Match": '"other"',
+                           "If-Modified-Since": http.datetimeToString(
+                               math.ceil(last_modified))})
+        self.assertEqual(response.code, http.OK)
+
+    @inlineCallbacks
+    def test_stored_dashboard(self):
+        cache = self.service.dashboard_cache
+        cache.store = ImageStore(self.mktemp())
+        cache.store.write("dash1", "A stored PNG.")
+        cache.load_images()
+        response, body = yield self.get_response("/png/dash1")
+        self.assertEqual(response.code, http.OK)
+        self.assertEqual(body, "A stored PNG.")
+        self.assertEqual(response.length, len("A stored PNG."))
+
+    @inlineCallbacks
+    def test_dashboard_variant_disabled(self):
+        yield self.service.dashboard_cache.refresh_images()
+        response, body = yield self.get_response("/png/dash1?size=full")
+        self.assertEqual(response.code, http.OK)
+        self.assertEqual(response.headers.getRawHeaders("Vary"), None)
+        response, body = yield self.get_response("/png/dash1?size=medium")
+        self.assertEqual(response.code, http.BAD_REQUEST)
+        self.assertEqual(body, "Image variants are not enabled")
+
+    def enable_variants(self):
+        if Image is None:
+            raise unittest.SkipTest("PIL is required.")
+        cache = self.service.dashboard_cache
+        cache.image_variants = True
+        cache.image_formats = image_formats()
+        png = mk_png(size=(1000, 500))
+        cache.dashboards["dash1"].generate_png = lambda: png
+        return cache
+
+    @inlineCallbacks
+    def test_dashboard_variants(self):
+        cache = self.enable_variants()
+        yield cache.refresh_images()
+        response, body = yield self.get_response("/png/dash1?size=thumbnail")
+        self.assertEqual(response.code, http.OK)
+        self.assertEqual(response.headers.getRawHeaders("Content-Type"),
+                         ["image/png"])
+        self.assertEqual(response.headers.getRawHeaders("Vary"), ["Accept"])
+        self.assertEqual(body, cache.open_png(
+            "dash1", ("thumbnail", "png")).read())
+        etag, _ = cache.get_validators("dash1", ("thumbnail", "png"))
+        self.assertEqual(response.headers.getRawHeaders("ETag"), [etag])
+        response, body = yield self.get_response("/png/dash1?size=huge")
+        self.assertEqual(response.code, http.BAD_REQUEST)
+        self.assertEqual(body, "Unknown image size 'huge'")
+
+    @inlineCallbacks
+    def test_dashboard_webp(self):
+        cache = self.enable_variants()
+        if "webp" not in cache.image_formats:
+            raise unittest.SkipTest("PIL WebP support is required.")
+        yield cache.refresh_images()
+        response, body = yield self.get_response(
+            "/png/dash1", {"Accept": "image/webp,image/*;q=0.8"})
+        self.assertEqual(response.headers.getRawHeaders("Content-Type"),
+                         ["image/webp"])
+        self.assertEqual(body, cache.open_png(
+            "dash1", ("full", "webp")).read())
+        response, body = yield self.get_response(
+            "/png/dash1?format=png", {"Accept": "image/webp"})
+        self.assertEqual(response.headers.getRawHeaders("Content-Type"),
+                         ["image/png"])
+        response, body = yield self.get_response("/png/dash1?format=webp")
+        self.assertEqual(response.headers.getRawHeaders("Content-Type"),
+                         ["image/webp"])
+
+    @inlineCallbacks
+    def test_dashboard_widget(self):
+        if Image is None:
+            raise unittest.SkipTest("PIL is required.")
+        cache = self.service.dashboard_cache
+        cache.widget_images = True
+        imager = cache.dashboards["dash1"]
+
+        def generate_png():
+            imager.widget_boxes = [(0, 0, 50, 50)]
+            return mk_png()
+        imager.generate_png = generate_png
+        response, body = yield self.get_response("/png/dash1/1")
+        self.assertEqual(response.code, http.SERVICE_UNAVAILABLE)
+        yield cache.refresh_images()
+        response, body = yield self.get_response("/png/dash1/1")
+        self.assertEqual(response.code, http.OK)
+        self.assertEqual(response.headers.getRawHeaders("Content-Type"),
+                         ["image/png"])
+        self.assertEqual(body, cache.open_png(
+            "dash1", widget_variant(1)).read())
+        etag, _ = cache.get_validators("dash1", widget_variant(1))
+        self.assertEqual(response.headers.getRawHeaders("ETag"), [etag])
+        response, body = yield self.get_response("/png/dash1/2")
+        self.assertEqual(response.code, http.NOT_FOUND)
+        self.assertEqual(body, "Widget '2' of dashboard 'dash1' not found")
+        response, body = yield self.get_response("/png/unknown/1")
+        self.assertEqual(response.code, http.NOT_FOUND)
+        self.assertEqual(body, "Dashboard 'unknown' not found")
+
+    @inlineCallbacks
+    def test_dashboard_widget_disabled(self):
+        yield self.service.dashboard_cache.refresh_images()
+        response, body = yield self.get_response("/png/dash1/1")
+        self.assertEqual(response.code, http.NOT_FOUND)
+        self.assertEqual(body, "Widget '1' of dashboard 'dash1' not found")
+
     @inlineCallbacks
     def test_uncached_dashboard(self):
         errors = []
@@ -198,7 +1100,7 @@ class TestGeckoImageServer(unittest.TestCase):
 
     @inlineCallbacks
     def test_dashboard_html(self):
-        yield self.service.dashboard_cache._refresh_images()
+        yield self.service.dashboard_cache.refresh_images()
         result = yield self.get_route("/dash/dash1")
         doc = minidom.parseString(result)
         [img] = doc.getElementsByTagName('img')
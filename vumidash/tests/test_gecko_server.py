@@ -2,18 +2,32 @@
 
 import json
 import copy
+import fnmatch
 from twisted.trial import unittest
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
+from twisted.internet import reactor
+from twisted.internet.task import Clock, deferLater
 from twisted.web.client import getPage
-from vumidash.gecko_server import GeckoServer
+from vumidash.gecko_server import (
+    GeckoServer, AdmissionController, OverloadedError)
 from vumidash.base import MetricSource
 
 
 class DummySource(MetricSource):
     def __init__(self, testdata):
         self.testdata = testdata
+        self.slow = set()
+        self.pending = []
+        self.closed = False
+
+    def close(self):
+        self.closed = True
 
     def get_latest(self, metric_name, start, end, summary_size):
+        if metric_name in self.slow:
+            d = Deferred()
+            self.pending.append(d)
+            return d
         values = self.get_history(metric_name, start, end, summary_size)
         if not values:
             values = [None, None]
@@ -32,6 +46,12 @@ class DummySource(MetricSource):
         else:
             return [v if v is not None else 0.0 for v in values]
 
+    def get_series(self, target, start, end, summary_size):
+        return [(name, self.get_history(name, start, end, summary_size,
+                                        False))
+                for name in sorted(self.testdata)
+                if fnmatch.fnmatch(name, target)]
+
 
 class TestGeckoServer(unittest.TestCase):
 
@@ -40,13 +60,16 @@ class TestGeckoServer(unittest.TestCase):
         'bar': [6, 7, 8, 9, 10],
         'zeroes': [1, 2, None, 3, 4, None, 5],
         'empty': [],
+        'transport.a': [1, 2, 3],
+        'transport.b': [10, None, 30],
+        'transport.c': [100, 200, None],
         }
 
     @inlineCallbacks
     def setUp(self):
         self.testdata = copy.deepcopy(self.TESTDATA)
         self.metrics_source = DummySource(self.testdata)
-        self.service = GeckoServer(self.metrics_source, 0)
+        self.service = GeckoServer(self.metrics_source, 0, timeout=0.1)
         yield self.service.startService()
         addr = self.service.webserver.getHost()
         self.url = "http://%s:%s/" % (addr.host, addr.port)
@@ -60,6 +83,13 @@ class TestGeckoServer(unittest.TestCase):
         data = yield getPage(self.url + route, timeout=1)
         returnValue(json.loads(data))
 
+    @inlineCallbacks
+    def get_route_error(self, route):
+        errors = []
+        yield getPage(self.url + route, timeout=1).addErrback(errors.append)
+        [error] = errors
+        returnValue(error.getErrorMessage())
+
     def check_series(self, json, series_dict):
         series_map = dict((series['name'], series)
                           for series in json['series'])
@@ -69,6 +99,12 @@ class TestGeckoServer(unittest.TestCase):
             self.assertEqual(series['type'], 'line')
         self.assertEqual(len(series_map), len(series_dict))
 
+    @inlineCallbacks
+    def test_stop_closes_source(self):
+        self.assertFalse(self.metrics_source.closed)
+        yield self.service.stopService()
+        self.assertTrue(self.metrics_source.closed)
+
     @inlineCallbacks
     def test_simple_latest(self):
         data = yield self.get_route_json('latest?metric=foo')
@@ -186,3 +222,248 @@ class TestGeckoServer(unittest.TestCase):
                 (5, "Green", "&pound;")]):
             self.assertEqual(item, {
                 "value": value, "text": text, "prefix": prefix})
+
+    @inlineCallbacks
+    def test_missing_metric(self):
+        error = yield self.get_route_error('latest')
+        self.assertEqual(error, "400 Bad request.")
+        error = yield self.get_route_error('rag?r_metric=foo&a_metric=bar')
+        self.assertEqual(error, "400 Bad request.")
+
+    @inlineCallbacks
+    def test_unknown_metric(self):
+        error = yield self.get_route_error('latest?metric=foo&metric=unknown')
+        self.assertEqual(error, "502 Metric fetch failed.")
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+
+    @inlineCallbacks
+    def test_unknown_timeout_policy(self):
+        error = yield self.get_route_error('latest?metric=foo&on_timeout=x')
+        self.assertEqual(error, "400 Bad request.")
+
+    @inlineCallbacks
+    def test_timeout_error(self):
+        self.metrics_source.slow.add('bar')
+        error = yield self.get_route_error('latest?metric=foo&metric=bar')
+        self.assertEqual(error, "504 Metric fetch timed out.")
+        [pending] = self.metrics_source.pending
+        self.assertTrue(pending.called)
+
+    @inlineCallbacks
+    def test_timeout_partial(self):
+        self.metrics_source.slow.add('bar')
+        data = yield self.get_route_json('latest?metric=foo&metric=bar'
+                                         '&on_timeout=partial')
+        self.assertEqual({'item': [{'text': '', 'value': 5},
+                                   {'text': '', 'value': 1}]}, data)
+
+    @inlineCallbacks
+    def test_timeout_stale(self):
+        route = 'latest?metric=foo&metric=bar&on_timeout=stale'
+        fresh = yield self.get_route_json(route)
+        self.metrics_source.slow.add('bar')
+        stale = yield self.get_route_json(route)
+        self.assertEqual(fresh, stale)
+
+    @inlineCallbacks
+    def test_timeout_stale_without_data(self):
+        self.metrics_source.slow.add('bar')
+        error = yield self.get_route_error('latest?metric=foo&metric=bar'
+                                           '&on_timeout=stale')
+        self.assertEqual(error, "504 Metric fetch timed out.")
+
+    @inlineCallbacks
+    def test_abandoned_count(self):
+        resource = self.service.site_factory.resource.children['latest']
+        self.metrics_source.slow.update(['foo', 'bar'])
+        yield self.get_route_error('latest?metric=foo&metric=bar')
+        self.assertEqual(resource.abandoned, 2)
+
+    @inlineCallbacks
+    def test_latest_aggregate(self):
+        data = yield self.get_route_json('latest?metric=transport.*&agg=sum')
+        self.assertEqual({'item': [{'text': '', 'value': 33},
+                                   {'text': '', 'value': 111}]}, data)
+
+    @inlineCallbacks
+    def test_latest_aggregate_top(self):
+        data = yield self.get_route_json('latest?metric=transport.*'
+                                         '&agg=top1')
+        self.assertEqual({'item': [{'text': '', 'value': 30},
+                                   {'text': '', 'value': 10}]}, data)
+
+    @inlineCallbacks
+    def test_history_aggregate(self):
+        data = yield self.get_route_json('history?metric=transport.*'
+                                         '&agg=sum&label=total')
+        self.check_series(data, {'total': [111, 202, 33]})
+
+    @inlineCallbacks
+    def test_history_aggregate_top(self):
+        data = yield self.get_route_json('history?metric=transport.*'
+                                         '&agg=top2&skip_nulls=false')
+        self.check_series(data, {
+            'transport.b': [10, 0.0, 30],
+            'transport.a': [1, 2, 3],
+            })
+
+    @inlineCallbacks
+    def test_unknown_aggregate(self):
+        error = yield self.get_route_error('history?metric=transport.*'
+                                           '&agg=median')
+        self.assertEqual(error, "400 Bad request.")
+
+
+class TestAdmissionController(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.patch(AdmissionController, 'clock', self.clock)
+        self.admission = AdmissionController(max_outstanding=4, max_lag=0.5,
+                                             queue_timeout=5)
+
+    def tearDown(self):
+        self.admission.stop()
+
+    def test_admit(self):
+        self.assertEqual(self.admission.check('a', 'normal'), 'admit')
+        self.admission.acquire('a', 2)
+        self.assertEqual(self.admission.outstanding, 2)
+        self.admission.release('a', 2)
+        self.assertEqual(self.admission.outstanding, 0)
+        self.assertEqual(self.admission.client_outstanding, {})
+
+    def test_shed_when_overloaded(self):
+        self.admission.acquire('a', 2)
+        self.admission.acquire('b', 2)
+        self.assertEqual(self.admission.check('c', 'normal'), 'shed')
+        self.assertEqual(self.admission.check('c', 'low'), 'queue')
+        self.assertEqual(self.admission.shed, 1)
+
+    def test_client_share(self):
+        self.admission.acquire('a', 2)
+        self.assertEqual(self.admission.check('a', 'normal'), 'shed')
+        self.assertEqual(self.admission.check('b', 'normal'), 'admit')
+
+    def test_lag(self):
+        self.admission.start()
+        self.clock.advance(0.1)
+        self.assertEqual(self.admission.check('a', 'normal'), 'admit')
+        self.clock.advance(1.0)
+        self.assertTrue(self.admission.lag > 0.5)
+        self.assertEqual(self.admission.check('a', 'normal'), 'shed')
+        self.clock.advance(0.1)
+        self.assertEqual(self.admission.check('a', 'normal'), 'admit')
+
+    def test_queue_admitted_when_lag_recovers(self):
+        self.admission.start()
+        self.clock.advance(1.1)
+        self.assertEqual(self.admission.check('a', 'low'), 'queue')
+        d = self.admission.enqueue('a', 1)
+        self.assertNoResult(d)
+        self.clock.advance(0.1)
+        self.assertFalse(self.admission.overloaded())
+        self.successResultOf(d)
+        self.assertEqual(self.admission.queue, [])
+        self.assertEqual(self.admission.outstanding, 1)
+
+    def test_queue_admitted_fairly(self):
+        self.admission.acquire('a', 2)
+        self.admission.acquire('b', 2)
+        admitted = []
+        d1 = self.admission.enqueue('a', 1)
+        d1.addCallback(lambda _: admitted.append('a'))
+        d2 = self.admission.enqueue('c', 1)
+        d2.addCallback(lambda _: admitted.append('c'))
+        self.admission.release('b', 1)
+        # a is still at its share so c is admitted first
+        self.assertEqual(admitted, ['c'])
+        self.admission.release('a', 1)
+        self.assertEqual(admitted, ['c', 'a'])
+        self.assertEqual(self.admission.queue, [])
+
+    def test_queue_timeout(self):
+        self.admission.acquire('a', 2)
+        self.admission.acquire('b', 2)
+        d = self.admission.enqueue('c', 1)
+        self.clock.advance(5)
+        self.failureResultOf(d, OverloadedError)
+        self.assertEqual(self.admission.queue, [])
+
+    def test_queue_cancel(self):
+        self.admission.acquire('a', 2)
+        self.admission.acquire('b', 2)
+        d = self.admission.enqueue('c', 1)
+        d.cancel()
+        self.failureResultOf(d)
+        self.assertEqual(self.admission.queue, [])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+class TestGeckoServerAdmission(unittest.TestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.metrics_source = DummySource({'foo': [1, 2], 'bar': [3, 4]})
+        self.admission = AdmissionController(max_outstanding=1, max_lag=None,
+                                             max_client_share=1.0,
+                                             queue_timeout=0.5)
+        self.service = GeckoServer(self.metrics_source, 0, timeout=5,
+                                   timeout_policy='partial',
+                                   admission=self.admission)
+        yield self.service.startService()
+        addr = self.service.webserver.getHost()
+        self.url = "http://%s:%s/" % (addr.host, addr.port)
+
+    @inlineCallbacks
+    def tearDown(self):
+        for d in self.metrics_source.pending:
+            if not d.called:
+                d.callback((0, 0))
+        yield self.service.stopService()
+
+    def get_route(self, route):
+        return getPage(self.url + route, timeout=1)
+
+    @inlineCallbacks
+    def test_shed(self):
+        self.metrics_source.slow.add('bar')
+        self.get_route('latest?metric=bar')
+        yield self.wait_for_pending()
+        errors = []
+        yield self.get_route('latest?metric=foo').addErrback(errors.append)
+        [error] = errors
+        self.assertEqual(error.getErrorMessage(), "503 Server overloaded.")
+        self.assertEqual(error.value.response,
+                         "Server overloaded. Please retry later.")
+
+    @inlineCallbacks
+    def test_shed_serves_stale(self):
+        fresh = yield self.get_route('latest?metric=foo&on_timeout=stale')
+        self.metrics_source.slow.add('bar')
+        self.get_route('latest?metric=bar')
+        yield self.wait_for_pending()
+        stale = yield self.get_route('latest?metric=foo&on_timeout=stale')
+        self.assertEqual(fresh, stale)
+
+    @inlineCallbacks
+    def test_low_priority_queued(self):
+        self.metrics_source.slow.add('bar')
+        slow_d = self.get_route('latest?metric=bar')
+        yield self.wait_for_pending()
+        queued_d = self.get_route('latest?metric=foo&priority=low')
+        yield self.wait_for(lambda: self.admission.queue)
+        self.metrics_source.pending[0].callback((5, 6))
+        yield slow_d
+        data = yield queued_d
+        self.assertEqual(json.loads(data)['item'][0]['value'], 2)
+        self.assertEqual(self.admission.outstanding, 0)
+
+    @inlineCallbacks
+    def wait_for_pending(self):
+        yield self.wait_for(lambda: self.metrics_source.pending)
+
+    @inlineCallbacks
+    def wait_for(self, condition):
+        while not condition():
+            yield deferLater(reactor, 0.01, lambda: None)
@@ -0,0 +1,72 @@
+"""Tests for vumidash.gecko_workers."""
+
+import json
+
+from twisted.trial import unittest
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.error import ConnectionRefusedError
+from twisted.internet.task import deferLater
+from twisted.web.client import getPage
+
+from vumidash.gecko_workers import GeckoWorkerPool, WorkerOptions
+from vumidash.dummy_client import DummyClient
+
+
+class TestWorkerOptions(unittest.TestCase):
+
+    def test_required(self):
+        options = WorkerOptions()
+        self.assertRaises(Exception, options.parseOptions, [])
+
+    def test_parse(self):
+        options = WorkerOptions()
+        options.parseOptions(["--listen-fd", "3", "--cache-socket", "sock",
+                              "--timeout", "2.5"])
+        self.assertEqual(options["listen-fd"], 3)
+        self.assertEqual(options["timeout"], 2.5)
+
+
+class TestGeckoWorkerPool(unittest.TestCase):
+
+    timeout = 20
+
+    @inlineCallbacks
+    def setUp(self):
+        self.pool = GeckoWorkerPool(DummyClient(), 0, 2, timeout=5.0)
+        self.pool.KILL_TIMEOUT = 1.0
+        yield self.pool.startService()
+        self.url = "http://127.0.0.1:%d/" % (self.pool.get_port(),)
+
+    def tearDown(self):
+        return self.pool.stopService()
+
+    @inlineCallbacks
+    def get_route_json(self, route):
+        for _ in range(100):
+            try:
+                data = yield getPage(self.url + route, timeout=5)
+            except ConnectionRefusedError:
+                yield deferLater(reactor, 0.1, lambda: None)
+            else:
+                returnValue(json.loads(data))
+        self.fail("Workers never started.")
+
+    def test_worker_args(self):
+        args = self.pool.worker_args()
+        self.assertEqual(args[1:3], ["-m", "vumidash.gecko_workers"])
+        self.assertTrue("--listen-fd" in args)
+        self.assertEqual(args[-2:], ["--timeout", "5.0"])
+
+    @inlineCallbacks
+    def test_serves_requests(self):
+        self.assertEqual(len(self.pool.workers), 2)
+        data = yield self.get_route_json('latest?metric=test.foo')
+        self.assertEqual(len(data['item']), 2)
+
+    @inlineCallbacks
+    def test_shares_cache(self):
+        first = yield self.get_route_json('latest?metric=test.foo')
+        for _ in range(5):
+            data = yield self.get_route_json('latest?metric=test.foo')
+            self.assertEqual(data, first)
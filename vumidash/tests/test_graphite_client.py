@@ -1,9 +1,11 @@
 """Test the server of Geckoboard data."""
 
 import json
+from datetime import timedelta
 from twisted.trial import unittest
-from twisted.internet.defer import inlineCallbacks, succeed
-from vumidash.graphite_client import GraphiteClient
+from twisted.internet.defer import inlineCallbacks, succeed, fail
+from twisted.python.failure import Failure
+from vumidash.graphite_client import GraphiteClient, summarized_name
 
 
 TESTDATA_FULL = """[{"target": "foo.count.sum", "datapoints": [
@@ -13,6 +15,12 @@ TESTDATA_FULL = """[{"target": "foo.count.sum", "datapoints": [
 
 TESTDATA_EMPTY = "[]"
 
+TESTDATA_WILDCARD = """[
+    {"target": "summarize(foo.a.sum, \\"900s\\", \\"sum\\")",
+     "datapoints": [[1.0, 1362204000], [null, 1362204900]]},
+    {"target": "summarize(foo.b.sum, \\"900s\\", \\"sum\\")",
+     "datapoints": [[3.0, 1362204000], [4.0, 1362204900]]}]"""
+
 
 class TestGraphiteClient(unittest.TestCase):
 
@@ -48,3 +56,107 @@ class TestGraphiteClient(unittest.TestCase):
         client = self.set_up_client(self.testdata_empty)
         data = yield client.get_history("foo.count.sum", -7200, 0, 900)
         self.assertEqual(len(data), 0)
+
+    @inlineCallbacks
+    def test_series(self):
+        client = self.set_up_client(json.loads(TESTDATA_WILDCARD))
+        data = yield client.get_series("foo.*.sum", -7200, 0, 900)
+        self.assertEqual(data, [
+            ("foo.a.sum", [(1362204000000, 1.0), (1362204900000, None)]),
+            ("foo.b.sum", [(1362204000000, 3.0), (1362204900000, 4.0)]),
+            ])
+
+    def test_aggregation_method(self):
+        client = GraphiteClient(None)
+        self.assertEqual(client.aggregation_method("foo.max"), "max")
+        self.assertEqual(client.aggregation_method("foo.count"), "avg")
+        self.assertEqual(client.aggregation_method("integral(foo.sum)"),
+                         "max")
+
+    @inlineCallbacks
+    def test_latest_many(self):
+        requests = []
+
+        def request(targets, *args):
+            requests.append(targets)
+            return succeed(json.loads(TESTDATA_WILDCARD.replace(
+                "900s", "15s")))
+        client = GraphiteClient(None)
+        client.make_graphite_request = request
+        data = yield client.get_latest_many(
+            ["foo.a.sum", "foo.b.sum", "foo.c.sum"], timedelta(hours=-2),
+            timedelta(0), timedelta(seconds=15))
+        self.assertEqual(requests, [["foo.a.sum", "foo.b.sum", "foo.c.sum"]])
+        self.assertEqual(data, {
+            "foo.a.sum": (1.0, 1.0),
+            "foo.b.sum": (3.0, 4.0),
+            "foo.c.sum": (None, None),
+            })
+
+    @inlineCallbacks
+    def test_latest_many_batches(self):
+        requests = []
+
+        def request(targets, *args):
+            requests.append(targets)
+            return succeed([])
+        client = GraphiteClient(None)
+        client.MAX_TARGETS = 2
+        client.make_graphite_request = request
+        data = yield client.get_latest_many(
+            ["a", "b", "c"], timedelta(hours=-2), timedelta(0),
+            timedelta(seconds=15))
+        self.assertEqual(requests, [["a", "b"], ["c"]])
+        self.assertEqual(len(data), 3)
+
+    @inlineCallbacks
+    def test_latest_many_failed_batch(self):
+        requests = []
+
+        def request(targets, *args):
+            requests.append(targets)
+            if "bad" in targets:
+                return fail(ValueError("Bad target"))
+            return succeed(json.loads(TESTDATA_WILDCARD.replace(
+                "900s", "15s")))
+        client = GraphiteClient(None)
+        client.make_graphite_request = request
+        data = yield client.get_latest_many(
+            ["foo.a.sum", "bad", "foo.b.sum"], timedelta(hours=-2),
+            timedelta(0), timedelta(seconds=15))
+        self.assertEqual(requests, [["foo.a.sum", "bad", "foo.b.sum"],
+                                    "foo.a.sum", "bad", "foo.b.sum"])
+        self.assertEqual(data["foo.a.sum"], (1.0, 1.0))
+        self.assertEqual(data["foo.b.sum"], (1.0, 1.0))
+        self.assertTrue(isinstance(data["bad"], Failure))
+        self.assertTrue(data["bad"].check(ValueError))
+
+    @inlineCallbacks
+    def test_latest_many_patterns_fetched_alone(self):
+        requests = []
+
+        def request(targets, *args):
+            requests.append(targets)
+            return succeed(json.loads(TESTDATA_WILDCARD.replace(
+                "900s", "15s")))
+        client = GraphiteClient(None)
+        client.make_graphite_request = request
+        data = yield client.get_latest_many(
+            ["foo.*.sum", "sumSeries(foo.*.sum)", "foo.a.sum", "foo.b.sum"],
+            timedelta(hours=-2), timedelta(0), timedelta(seconds=15))
+        self.assertEqual(sorted(requests), sorted([
+            "foo.*.sum", "sumSeries(foo.*.sum)",
+            ["foo.a.sum", "foo.b.sum"]]))
+        self.assertEqual(data, {
+            "foo.*.sum": (1.0, 1.0),
+            "sumSeries(foo.*.sum)": (1.0, 1.0),
+            "foo.a.sum": (1.0, 1.0),
+            "foo.b.sum": (3.0, 4.0),
+            })
+
+    def test_summarized_name(self):
+        self.assertEqual(summarized_name('summarize(foo.a, "15s", "sum")'),
+                         "foo.a")
+        self.assertEqual(summarized_name("foo.a"), "foo.a")
+        self.assertEqual(summarized_name('summarize(foo, "15s")'),
+                         'summarize(foo, "15s")')
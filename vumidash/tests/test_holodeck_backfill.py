@@ -0,0 +1,312 @@
+"""Tests for vumidash.holodeck_backfill."""
+
+import os
+from datetime import datetime
+
+from twisted.trial import unittest
+from twisted.internet.defer import Deferred, succeed, fail
+from twisted.internet.task import Clock
+
+from vumidash.base import MetricSource
+from vumidash.holodeck_pusher import HoloSample, HoloSamples
+from vumidash.holodeck_backfill import PushState, Backfill, value_before
+
+
+class TestPushState(unittest.TestCase):
+    def setUp(self):
+        self.path = self.mktemp()
+        self.state = PushState(self.path)
+
+    def test_record(self):
+        self.assertEqual(self.state.get("server", "key"), None)
+        self.state.record("server", "key", 60)
+        self.assertEqual(self.state.get("server", "key"), 60)
+        self.state.record("server", "key", 30)
+        self.assertEqual(self.state.get("server", "key"), 60)
+
+    def test_hold(self):
+        self.state.record("server", "key", 60)
+        self.state.hold("server", "key")
+        self.state.record("server", "key", 120)
+        self.state.record("server", "key", 90)
+        self.assertEqual(self.state.get("server", "key"), 60)
+        self.state.record_backfill("server", "key", 70)
+        self.assertEqual(self.state.get("server", "key"), 70)
+        self.state.release("server", "key")
+        self.assertEqual(self.state.get("server", "key"), 120)
+        self.state.record("server", "key", 130)
+        self.assertEqual(self.state.get("server", "key"), 130)
+
+    def test_release_nothing_held(self):
+        self.state.hold("server", "key")
+        self.state.release("server", "key")
+        self.assertEqual(self.state.get("server", "key"), None)
+
+    def test_save_and_load(self):
+        self.state.record("server", "key", 60)
+        self.state.save()
+        self.assertFalse(os.path.exists(self.path + ".tmp"))
+        state = PushState(self.path)
+        state.load()
+        self.assertEqual(state.get("server", "key"), 60)
+
+    def test_save_unchanged(self):
+        self.state.save()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_load_missing(self):
+        self.state.load()
+        self.assertEqual(self.state.last_push, {})
+
+    def test_load_unreadable(self):
+        with open(self.path, "wb") as f:
+            f.write("{not json")
+        self.state.load()
+        self.assertEqual(self.state.last_push, {})
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+
+
+class TestValueBefore(unittest.TestCase):
+    def test_value_before(self):
+        points = [(1000, 1.0), (2000, None), (3000, 3.0)]
+        self.assertEqual(value_before(points, 3000), 1.0)
+        self.assertEqual(value_before(points, 3001), 3.0)
+        self.assertEqual(value_before(points, 1000), 0.0)
+
+
+class HistorySource(MetricSource):
+    def __init__(self, points=None):
+        self.points = points or {}
+        self.queries = []
+
+    def get_history(self, metric, from_dt, until_dt, step_dt,
+                    skip_nulls=True):
+        self.queries.append((metric, from_dt, until_dt, step_dt, skip_nulls))
+        if metric not in self.points:
+            return fail(ValueError("Unknown metric %r" % (metric,)))
+        return succeed(self.points[metric])
+
+
+class DummySender(object):
+    def __init__(self, manual=False):
+        self.sends = []
+        self.manual = manual
+        self.pending = []
+
+    def send(self, server, **kw):
+        self.sends.append((server, kw))
+        if self.manual:
+            self.pending.append(Deferred())
+            return self.pending[-1]
+        return succeed(None)
+
+
+class TestBackfill(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.patch(Backfill, 'clock', self.clock)
+        self.state = PushState(self.mktemp())
+        self.sender = DummySender()
+        # one point per 10s with the value of its timestamp in seconds
+        points = [(t * 1000, float(t)) for t in range(0, 200, 10)]
+        self.source = HistorySource({"m1": points, "m2": points})
+
+    def mk_backfill(self, **kw):
+        return Backfill(self.source, self.sender, self.state, **kw)
+
+    def mk_samples(self, api_key="key", metrics=("m1",), **kw):
+        return HoloSamples("server", api_key, 10, [
+            HoloSample(metric, metric.upper()) for metric in metrics], **kw)
+
+    def test_missed_ticks(self):
+        backfill = self.mk_backfill()
+        sample_set = self.mk_samples()
+        self.assertEqual(backfill.missed_ticks(sample_set, 100), [])
+        self.state.record("server", "key", 50)
+        self.assertEqual(backfill.missed_ticks(sample_set, 100),
+                         [60, 70, 80, 90, 100])
+        self.assertEqual(backfill.missed_ticks(sample_set, 105),
+                         [60, 70, 80, 90, 100])
+
+    def test_missed_ticks_max_gap(self):
+        backfill = self.mk_backfill(max_gap=30)
+        self.state.record("server", "key", 10)
+        self.assertEqual(backfill.missed_ticks(self.mk_samples(), 100),
+                         [80, 90, 100])
+
+    def test_missed_ticks_with_jitter(self):
+        backfill = self.mk_backfill()
+        sample_set = self.mk_samples(jitter=0.9)
+        offset = sample_set.offset
+        self.assertTrue(0 < offset < 9)
+        self.state.record("server", "key", 50)
+        # the tick aligned to 100 is pushed live at 100 + offset
+        self.assertEqual(backfill.missed_ticks(sample_set, 100),
+                         [60, 70, 80, 90])
+        self.assertEqual(backfill.missed_ticks(sample_set, 100 + offset),
+                         [60, 70, 80, 90, 100])
+
+    def test_with_timestamps(self):
+        backfill = self.mk_backfill()
+        self.assertEqual(backfill._with_timestamps([1.0, None, 3.0], 105, 10),
+                         [(80000, 1.0), (90000, None), (100000, 3.0)])
+
+    def test_start(self):
+        self.clock.advance(100)
+        self.state.record("server", "key", 70)
+        backfill = self.mk_backfill(rate=2.0)
+        d = backfill.start([self.mk_samples(metrics=("m1", "m2"))])
+        self.assertEqual(sorted(query[0] for query in self.source.queries),
+                         ["m1", "m2"])
+        self.assertEqual([query[4] for query in self.source.queries],
+                         [False, False])
+        self.assertEqual(len(self.sender.sends), 1)
+        self.clock.advance(0.5)
+        self.assertEqual(len(self.sender.sends), 2)
+        self.assertNoResult(d)
+        self.clock.pump([0.5, 0.5])
+        self.assertEqual(self.successResultOf(d), 3)
+        self.assertEqual(self.sender.sends, [
+            ("server", dict(api_key="key", samples=[["M1", 70.0],
+                                                    ["M2", 70.0]],
+                            timestamp=datetime.fromtimestamp(80))),
+            ("server", dict(api_key="key", samples=[["M1", 80.0],
+                                                    ["M2", 80.0]],
+                            timestamp=datetime.fromtimestamp(90))),
+            ("server", dict(api_key="key", samples=[["M1", 90.0],
+                                                    ["M2", 90.0]],
+                            timestamp=datetime.fromtimestamp(100))),
+        ])
+        self.assertEqual(self.state.get("server", "key"), 100)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_start_shares_fetches(self):
+        self.clock.advance(100)
+        self.state.record("server", "key1", 80)
+        self.state.record("server", "key2", 70)
+        backfill = self.mk_backfill()
+        d = backfill.start([self.mk_samples("key1"),
+                            self.mk_samples("key2")])
+        self.assertEqual(len(self.source.queries), 1)
+        self.clock.pump([0.1] * 10)
+        self.assertEqual(self.successResultOf(d), 5)
+        # sends are in tick order across sets
+        self.assertEqual([kw["timestamp"] for _server, kw in
+                          self.sender.sends],
+                         [datetime.fromtimestamp(t)
+                          for t in (80, 90, 90, 100, 100)])
+
+    def test_start_nothing_missed(self):
+        backfill = self.mk_backfill()
+        d = backfill.start([self.mk_samples()])
+        self.assertEqual(self.successResultOf(d), 0)
+        self.assertEqual(self.source.queries, [])
+
+    def test_failed_fetch_skips_set(self):
+        self.clock.advance(100)
+        self.state.record("server", "key1", 80)
+        self.state.record("server", "key2", 80)
+        backfill = self.mk_backfill()
+        d = backfill.start([self.mk_samples("key1", metrics=("m1", "bad")),
+                            self.mk_samples("key2")])
+        self.clock.pump([0.1] * 10)
+        self.assertEqual(self.successResultOf(d), 2)
+        self.assertEqual(set(kw["api_key"] for _server, kw in
+                             self.sender.sends), set(["key2"]))
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+
+    def test_stop(self):
+        self.clock.advance(100)
+        self.state.record("server", "key", 50)
+        backfill = self.mk_backfill()
+        d = backfill.start([self.mk_samples()])
+        self.assertEqual(len(self.sender.sends), 1)
+        backfill.stop()
+        self.assertEqual(self.successResultOf(d), 1)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_out_of_order_acks(self):
+        self.clock.advance(100)
+        self.state.record("server", "key", 70)
+        self.sender.manual = True
+        backfill = self.mk_backfill()
+        d = backfill.start([self.mk_samples()])
+        self.clock.pump([0.1] * 4)
+        self.assertEqual(len(self.sender.pending), 3)
+        self.sender.pending[1].callback(None)
+        self.sender.pending[2].callback(None)
+        self.assertEqual(self.state.get("server", "key"), 70)
+        # the backfill finishes once every push sent has finished
+        self.assertNoResult(d)
+        self.sender.pending[0].callback(None)
+        self.assertEqual(self.state.get("server", "key"), 100)
+        self.assertEqual(self.successResultOf(d), 3)
+
+    def test_failed_send(self):
+        self.clock.advance(100)
+        self.state.record("server", "key", 70)
+        self.sender.manual = True
+        backfill = self.mk_backfill()
+        d = backfill.start([self.mk_samples()])
+        self.clock.pump([0.1] * 4)
+        self.sender.pending[0].errback(ValueError("Holodeck is down."))
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+        self.state.record("server", "key", 110)
+        self.sender.pending[1].callback(None)
+        self.assertEqual(self.state.get("server", "key"), 90)
+        self.sender.pending[2].callback(None)
+        self.assertEqual(self.successResultOf(d), 2)
+        self.assertEqual(backfill.failed, 1)
+        # the set is released and live pushes are recorded again
+        self.assertEqual(self.state.get("server", "key"), 110)
+        self.assertEqual(self.state.held, {})
+
+    def test_stop_waits_for_sends(self):
+        self.clock.advance(100)
+        self.state.record("server", "key", 50)
+        self.sender.manual = True
+        backfill = self.mk_backfill()
+        d = backfill.start([self.mk_samples()])
+        backfill.stop()
+        self.assertNoResult(d)
+        self.sender.pending[0].callback(None)
+        self.assertEqual(self.successResultOf(d), 1)
+
+    def test_live_pushes_held_during_backfill(self):
+        self.clock.advance(100)
+        self.state.record("server", "key", 70)
+        backfill = self.mk_backfill()
+        d = backfill.start([self.mk_samples()])
+        self.state.record("server", "key", 110)
+        self.assertEqual(self.state.get("server", "key"), 80)
+        self.clock.pump([0.1] * 3)
+        self.assertEqual(self.successResultOf(d), 3)
+        self.assertEqual(self.state.get("server", "key"), 110)
+
+    def test_stop_and_restart(self):
+        self.clock.advance(100)
+        self.state.record("server", "key", 50)
+        backfill = self.mk_backfill()
+        d = backfill.start([self.mk_samples()])
+        self.clock.advance(0.1)
+        self.assertEqual(len(self.sender.sends), 2)
+        # a live push of a newer tick while the backfill is running
+        self.state.record("server", "key", 110)
+        backfill.stop()
+        self.assertEqual(self.successResultOf(d), 2)
+        self.state.save()
+
+        state = PushState(self.state.path)
+        state.load()
+        self.assertEqual(state.get("server", "key"), 70)
+        self.sender.sends = []
+        self.clock.advance(20)
+        backfill = Backfill(self.source, self.sender, state)
+        d = backfill.start([self.mk_samples()])
+        self.clock.pump([0.1] * 5)
+        self.assertEqual(self.successResultOf(d), 5)
+        self.assertEqual([kw["timestamp"] for _server, kw in
+                          self.sender.sends],
+                         [datetime.fromtimestamp(t)
+                          for t in (80, 90, 100, 110, 120)])
+        self.assertEqual(state.get("server", "key"), 120)
@@ -1,14 +1,21 @@
 """Test the Holodeck data pusher."""
 
+import os
+import signal
 from datetime import datetime, timedelta
 
 from twisted.trial import unittest
-from twisted.internet.defer import inlineCallbacks, Deferred
+from twisted.internet.defer import inlineCallbacks, Deferred, maybeDeferred
 from twisted.internet.task import Clock
+from twisted.python import log
+from twisted.python.failure import Failure
 
 from vumidash.dummy_client import DummyClient
+import vumidash.holodeck_pusher
 from vumidash.holodeck_pusher import (
-    HoloSample, HoloSamples, HolodeckPusher)
+    HoloSample, HoloSamples, HolodeckPusher, FetchPlan, HoloClientPool,
+    HolodeckPusherService, load_config, shard_of)
+from vumidash.holodeck_backfill import PushState
 
 
 class TestHoloSample(unittest.TestCase):
@@ -96,6 +103,32 @@ class TestHoloSamples(unittest.TestCase):
         self.assertEqual(self.hs.next(59), 60)
         self.assertEqual(self.hs.next(60), 120)
 
+    def test_phase(self):
+        phase = HoloSamples.phase("server", "api_key")
+        self.assertEqual(phase, HoloSamples.phase("server", "api_key"))
+        self.assertNotEqual(phase, HoloSamples.phase("server", "api_key2"))
+        self.assertTrue(0 <= phase < 1)
+
+    def test_next_with_jitter(self):
+        hs = HoloSamples("server", "api_key", 60, [], jitter=0.5)
+        offset = HoloSamples.phase("server", "api_key") * 30
+        self.assertEqual(hs.offset, offset)
+        self.assertEqual(hs.next(0), offset)
+        self.assertEqual(hs.next(offset), 60 + offset)
+        self.assertEqual(hs.next(59 + offset), 60 + offset)
+        self.assertEqual(hs.aligned(60 + offset), 60)
+
+    def test_jitter_spreads_sets(self):
+        offsets = [HoloSamples("server", "key%d" % i, 60, [],
+                               jitter=1.0 - 1e-9).offset
+                   for i in range(100)]
+        self.assertTrue(min(offsets) < 10)
+        self.assertTrue(max(offsets) > 50)
+
+    def test_bad_jitter(self):
+        self.assertRaises(ValueError, HoloSamples, "server", "api_key", 60,
+                          [], jitter=1.0)
+
     @inlineCallbacks
     def test_push(self):
         yield self.hs.push(120.0, self.metrics_source)
@@ -119,22 +152,275 @@ class TestHoloSamples(unittest.TestCase):
         ])
 
 
+class SlowTxClient(DummyTxClient):
+    def __init__(self, server):
+        super(SlowTxClient, self).__init__(server)
+        self.pending = []
+
+    def send(self, api_key, samples, timestamp):
+        super(SlowTxClient, self).send(api_key, samples, timestamp)
+        d = Deferred()
+        self.pending.append(d)
+        return d
+
+
+class TestHoloClientPool(unittest.TestCase):
+    def setUp(self):
+        import vumidash.holodeck_pusher
+        self.clients = []
+        self.patch(vumidash.holodeck_pusher, 'TxClient', self.mk_client)
+        self.client_class = DummyTxClient
+
+    def mk_client(self, server):
+        client = self.client_class(server)
+        self.clients.append(client)
+        return client
+
+    def test_client_per_server(self):
+        pool = HoloClientPool()
+        client = pool.get_client("server1")
+        self.assertTrue(pool.get_client("server1") is client)
+        self.assertFalse(pool.get_client("server2") is client)
+        self.assertEqual(len(self.clients), 2)
+
+    def test_send(self):
+        pool = HoloClientPool()
+        for api_key in ["key1", "key2", "key1"]:
+            self.successResultOf(pool.send(
+                "server", api_key=api_key, samples=[], timestamp=None))
+        [client] = self.clients
+        self.assertEqual([send[1] for send in client.sends],
+                         ["key1", "key2", "key1"])
+        self.assertEqual(pool.get_stats(), {"server": {
+            'clients': 1, 'sends': 3, 'client_hits': 2, 'failed': 0,
+            'in_flight': 0}})
+
+    def test_send_failed(self):
+        self.client_class = SlowTxClient
+        pool = HoloClientPool()
+        d = pool.send("server", api_key="key", samples=[], timestamp=None)
+        self.assertEqual(pool.get_stats()["server"]["in_flight"], 1)
+        self.clients[0].pending[0].errback(ValueError("Push failed"))
+        self.failureResultOf(d, ValueError)
+        stats = pool.get_stats()["server"]
+        self.assertEqual(stats["failed"], 1)
+        self.assertEqual(stats["in_flight"], 0)
+
+    def test_max_sends(self):
+        self.client_class = SlowTxClient
+        pool = HoloClientPool(max_sends=2)
+        ds = [pool.send("server", api_key="key%d" % i, samples=[],
+                        timestamp=None) for i in range(3)]
+        pool.send("other", api_key="key", samples=[], timestamp=None)
+        client, other = self.clients
+        self.assertEqual(len(client.pending), 2)
+        self.assertEqual(len(other.pending), 1)
+        client.pending[0].callback(None)
+        self.assertEqual(len(client.pending), 3)
+        for d in client.pending[1:]:
+            d.callback(None)
+        for d in ds:
+            self.successResultOf(d)
+
+    @inlineCallbacks
+    def test_push_with_pool(self):
+        pool = HoloClientPool()
+        metrics_source = DummyClient()
+        for api_key in ["key1", "key2"]:
+            hs = HoloSamples("server", api_key, 60,
+                             [HoloSample("test.metric1", "holo1")])
+            yield hs.push(120.0, metrics_source, pool)
+            yield hs.push(180.0, metrics_source, pool)
+        [client] = self.clients
+        self.assertEqual(len(client.sends), 4)
+        self.assertEqual(pool.get_stats()["server"]["client_hits"], 3)
+
+
+class SlowSource(object):
+    def __init__(self):
+        self.pending = {}
+
+    def get_latest(self, metric, from_dt, until_dt, step_dt):
+        d = Deferred()
+        self.pending[metric] = d
+        return d
+
+
+class TestHoloSamplesConcurrency(unittest.TestCase):
+    def setUp(self):
+        import vumidash.holodeck_pusher
+        self.clients = []
+        self.patch(vumidash.holodeck_pusher, 'TxClient', self.mk_client)
+        self.clock = Clock()
+        self.patch(HoloSamples, 'clock', self.clock)
+        self.source = SlowSource()
+
+    def mk_client(self, server):
+        client = DummyTxClient(server)
+        self.clients.append(client)
+        return client
+
+    def mk_samples(self, n, **kw):
+        samples = [HoloSample("metric%d" % i, "holo%d" % i)
+                   for i in range(n)]
+        return HoloSamples("server", "api_key", 60, samples, **kw)
+
+    def test_fetches_concurrently(self):
+        hs = self.mk_samples(3)
+        d = hs.push(120.0, self.source)
+        self.assertEqual(sorted(self.source.pending),
+                         ["metric0", "metric1", "metric2"])
+        self.clock.advance(2)
+        for i in [2, 0, 1]:
+            self.source.pending["metric%d" % i].callback((0, i + 1.0))
+        self.successResultOf(d)
+        [client] = self.clients
+        self.assertEqual(client.sends[0][2], [
+            ['holo0', 1.0], ['holo1', 2.0], ['holo2', 3.0]])
+        self.assertEqual(hs.fetch_latency, 2)
+        self.assertEqual(hs.push_latency, 2)
+
+    def test_concurrency_limit(self):
+        hs = self.mk_samples(3, concurrency=2)
+        d = hs.push(120.0, self.source)
+        self.assertEqual(sorted(self.source.pending), ["metric0", "metric1"])
+        self.source.pending["metric0"].callback((0, 1.0))
+        self.assertEqual(len(self.source.pending), 3)
+        self.source.pending["metric1"].callback((0, 2.0))
+        self.source.pending["metric2"].callback((0, 3.0))
+        self.successResultOf(d)
+
+    def test_sample_timeout(self):
+        hs = self.mk_samples(2, sample_timeout=5)
+        d = hs.push(120.0, self.source)
+        self.source.pending["metric0"].callback((0, 1.0))
+        self.clock.advance(5)
+        self.successResultOf(d)
+        [client] = self.clients
+        self.assertEqual(client.sends[0][2], [['holo0', 1.0], ['holo1', 0.0]])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+class CountingSource(object):
+    def __init__(self):
+        self.calls = []
+
+    def get_latest(self, metric, from_dt, until_dt, step_dt):
+        self.calls.append(metric)
+        if metric == "bad":
+            raise ValueError("Bad metric")
+        return (0.0, len(self.calls))
+
+
+class ManySource(CountingSource):
+    def get_latest_many(self, metrics, from_dt, until_dt, step_dt):
+        self.calls.append(sorted(metrics))
+        return dict((m, (0.0, 1.0)) for m in metrics)
+
+
+class TestFetchPlan(unittest.TestCase):
+    def setUp(self):
+        self.set1 = HoloSamples("server1", "key1", 60, [
+            HoloSample("m1", "holo1"), HoloSample("m2", "holo2")])
+        self.set2 = HoloSamples("server2", "key2", 60, [
+            HoloSample("m1", "holo1"), HoloSample("m2", "holo2", step_dt=30),
+            HoloSample("bad", "holo3")])
+
+    def test_queries(self):
+        plan = FetchPlan(CountingSource(), [self.set1, self.set2])
+        self.assertEqual(len(plan.queries), 4)
+
+    def test_fetches_once(self):
+        source = CountingSource()
+        plan = FetchPlan(source, [self.set1, self.set2])
+        plan.start()
+        self.assertEqual(sorted(source.calls), ["bad", "m1", "m2", "m2"])
+        self.assertEqual(plan.fetches, 4)
+        sample = self.set1.samples[0]
+        d1 = plan.get_latest(*sample.query())
+        d2 = plan.get_latest(*sample.query())
+        self.assertEqual(self.successResultOf(d1), self.successResultOf(d2))
+        self.assertEqual(len(source.calls), 4)
+
+    def test_failure_shared(self):
+        plan = FetchPlan(CountingSource(), [self.set2])
+        plan.start()
+        query = self.set2.samples[2].query()
+        self.failureResultOf(plan.get_latest(*query), ValueError)
+        self.failureResultOf(plan.get_latest(*query), ValueError)
+
+    def test_unplanned_query(self):
+        source = CountingSource()
+        plan = FetchPlan(source, [])
+        plan.start()
+        plan.get_latest(*HoloSample("m3", "holo").query())
+        self.assertEqual(source.calls, ["m3"])
+
+    def test_get_latest_many(self):
+        source = ManySource()
+        plan = FetchPlan(source, [self.set1, self.set2])
+        plan.start()
+        self.assertEqual(plan.fetches, 2)
+        self.assertEqual(len(source.calls), 2)
+        self.assertTrue(["bad", "m1", "m2"] in source.calls)
+        self.assertTrue("m2" in source.calls)
+
+    def test_get_latest_many_failed_metric(self):
+        source = ManySource()
+        source.get_latest_many = lambda metrics, *args: dict(
+            (m, Failure(ValueError("Bad metric")) if m == "bad"
+             else (0.0, 1.0)) for m in metrics)
+        plan = FetchPlan(source, [self.set2])
+        plan.start()
+        bad, m1 = self.set2.samples[2], self.set2.samples[0]
+        self.failureResultOf(plan.get_latest(*bad.query()), ValueError)
+        self.assertEqual(self.successResultOf(plan.get_latest(*m1.query())),
+                         (0.0, 1.0))
+
+    def test_waiter_cancelled(self):
+        source = SlowSource()
+        plan = FetchPlan(source, [self.set1])
+        plan.start()
+        query = self.set1.samples[0].query()
+        d1 = plan.get_latest(*query)
+        d2 = plan.get_latest(*query)
+        d1.cancel()
+        self.failureResultOf(d1)
+        source.pending["m1"].callback((1.0, 2.0))
+        self.assertEqual(self.successResultOf(d2), (1.0, 2.0))
+
+
+class DummySpool(object):
+    started = stopped = False
+
+    def start(self):
+        self.started = True
+
+    def stop(self):
+        self.stopped = True
+
+
 class DummySamples(HoloSamples):
-    def __init__(self, frequency, expected_metrics_source):
+    def __init__(self, frequency, expected_metrics_source, **kw):
         super(DummySamples, self).__init__("server", "api_key",
-                                           frequency, [])
+                                           frequency, [], **kw)
         self.expected_metrics_source = expected_metrics_source
         self.pushes = []
+        self.senders = []
         self.deferreds = []
 
     def callback_all(self, result=None):
         for d in self.deferreds:
-            d.callback(result)
+            if not d.called:
+                d.callback(result)
 
-    def push(self, now, metrics_source):
-        assert metrics_source is self.expected_metrics_source
+    def push(self, now, metrics_source, client_pool=None):
+        assert client_pool is not None
+        assert isinstance(metrics_source, FetchPlan)
+        assert metrics_source.metrics_source is self.expected_metrics_source
         d = Deferred()
         self.pushes.append(now)
+        self.senders.append(client_pool)
         self.deferreds.append(d)
         return d
 
@@ -182,7 +468,7 @@ class TestHolodeckPusher(unittest.TestCase):
 
     @inlineCallbacks
     def test_sampling(self):
-        ds = DummySamples(10, self.metrics_source)
+        ds = DummySamples(10, self.metrics_source, overrun='overlap')
         hp = HolodeckPusher(self.metrics_source, [ds])
         yield hp.start()
         self.assertEqual(ds.pushes, [])
@@ -195,8 +481,8 @@ class TestHolodeckPusher(unittest.TestCase):
 
     @inlineCallbacks
     def test_sampling_with_two_sample_sets(self):
-        ds1 = DummySamples(10, self.metrics_source)
-        ds2 = DummySamples(5, self.metrics_source)
+        ds1 = DummySamples(10, self.metrics_source, overrun='overlap')
+        ds2 = DummySamples(5, self.metrics_source, overrun='overlap')
         hp = HolodeckPusher(self.metrics_source, [ds1, ds2])
         yield hp.start()
         self.assertEqual(ds1.pushes, [])
@@ -211,7 +497,7 @@ class TestHolodeckPusher(unittest.TestCase):
 
     @inlineCallbacks
     def test_waiting_list_clears(self):
-        ds = DummySamples(10, self.metrics_source)
+        ds = DummySamples(10, self.metrics_source, overrun='overlap')
         hp = HolodeckPusher(self.metrics_source, [ds])
         yield hp.start()
         self.clock.advance(50)
@@ -219,3 +505,438 @@ class TestHolodeckPusher(unittest.TestCase):
         ds.callback_all()
         self.assertFalse(hp._waiting)
         yield hp.stop()
+
+    def test_from_config_options(self):
+        hp = HolodeckPusher.from_config(object(), {
+            "server": {"api_key": {
+                "frequency": 60,
+                "concurrency": 5,
+                "sample_timeout": 10,
+                "overrun": "coalesce",
+                "push_timeout": 30,
+                "samples": [],
+            }}})
+        [hs] = hp.samples
+        self.assertEqual(hs.concurrency, 5)
+        self.assertEqual(hs.sample_timeout, 10)
+        self.assertEqual(hs.overrun, "coalesce")
+        self.assertEqual(hs.push_timeout, 30)
+
+    def test_default_push_timeout(self):
+        self.assertEqual(DummySamples(10, None).push_timeout, 10)
+        self.assertEqual(DummySamples(10, None, overrun='coalesce')
+                         .push_timeout, 10)
+        self.assertEqual(DummySamples(10, None, overrun='overlap')
+                         .push_timeout, None)
+
+    @inlineCallbacks
+    def test_sets_due_together_share_fetches(self):
+        import vumidash.holodeck_pusher
+        self.patch(vumidash.holodeck_pusher, 'TxClient', DummyTxClient)
+        source = CountingSource()
+        sets = [HoloSamples("server%d" % i, "key", 10,
+                            [HoloSample("m1", "holo1")]) for i in range(3)]
+        hp = HolodeckPusher(source, sets)
+        yield hp.start()
+        self.clock.advance(10)
+        self.assertEqual(source.calls, ["m1"])
+        yield hp.stop()
+
+    def test_from_config_client_pool(self):
+        pool = HoloClientPool(max_sends=3)
+        hp = HolodeckPusher.from_config(object(), {}, pool)
+        self.assertTrue(hp.client_pool is pool)
+        self.assertTrue(isinstance(HolodeckPusher(object(), []).client_pool,
+                                   HoloClientPool))
+
+    @inlineCallbacks
+    def test_pushes_through_spool(self):
+        spool = DummySpool()
+        ds = DummySamples(10, self.metrics_source)
+        hp = HolodeckPusher(self.metrics_source, [ds], spool=spool)
+        yield hp.start()
+        self.assertTrue(spool.started)
+        self.clock.advance(10)
+        self.assertEqual(ds.senders, [spool])
+        ds.callback_all()
+        yield hp.stop()
+        self.assertTrue(spool.stopped)
+
+    def test_unknown_overrun_policy(self):
+        self.assertRaises(ValueError, HoloSamples, "server", "api_key", 10,
+                          [], overrun="queue")
+
+    @inlineCallbacks
+    def test_overrun_skip(self):
+        ds = DummySamples(10, self.metrics_source, push_timeout=60)
+        hp = HolodeckPusher(self.metrics_source, [ds])
+        yield hp.start()
+        self.clock.pump([10, 10, 10])
+        self.assertEqual(ds.pushes, [10.0])
+        ds.callback_all()
+        self.clock.advance(10)
+        self.assertEqual(ds.pushes, [10.0, 40.0])
+        stats = hp.get_stats()[("server", "api_key")]
+        self.assertEqual(stats["dropped_ticks"], 2)
+        self.assertEqual(stats["pushes"], 2)
+        self.assertEqual(stats["in_flight"], 1)
+        ds.callback_all()
+        yield hp.stop()
+
+    @inlineCallbacks
+    def test_hung_push_times_out(self):
+        ds = DummySamples(10, self.metrics_source)
+        hp = HolodeckPusher(self.metrics_source, [ds])
+        yield hp.start()
+        self.clock.pump([10, 10, 10])
+        # the push at 10 hangs, the tick at 20 is skipped and the push is
+        # given up on in time for the tick at 30
+        self.assertEqual(ds.pushes, [10.0, 30.0])
+        self.assertTrue(ds.deferreds[0].called)
+        stats = hp.get_stats()[("server", "api_key")]
+        self.assertEqual(stats["timed_out"], 1)
+        self.assertEqual(stats["dropped_ticks"], 1)
+        self.assertEqual(stats["in_flight"], 1)
+        ds.callback_all()
+        self.assertEqual(ds.in_flight, 0)
+        yield hp.stop()
+
+    @inlineCallbacks
+    def test_overrun_coalesce(self):
+        ds = DummySamples(10, self.metrics_source, overrun='coalesce',
+                          push_timeout=60)
+        hp = HolodeckPusher(self.metrics_source, [ds])
+        yield hp.start()
+        self.clock.pump([10, 10, 10, 5])
+        self.assertEqual(ds.pushes, [10.0])
+        ds.deferreds[0].callback(None)
+        self.assertEqual(ds.pushes, [10.0, 30.0])
+        stats = hp.get_stats()[("server", "api_key")]
+        self.assertEqual(stats["dropped_ticks"], 1)
+        self.assertEqual(stats["coalesced"], 1)
+        ds.callback_all()
+        yield hp.stop()
+
+    @inlineCallbacks
+    def test_max_outstanding(self):
+        sets = [DummySamples(10, self.metrics_source) for _ in range(3)]
+        hp = HolodeckPusher(self.metrics_source, sets, max_outstanding=2)
+        yield hp.start()
+        self.clock.advance(10)
+        self.assertEqual(sorted(len(ds.pushes) for ds in sets), [0, 1, 1])
+        self.assertEqual(len(hp._waiting), 2)
+        for ds in sets:
+            ds.callback_all()
+        yield hp.stop()
+
+    @inlineCallbacks
+    def test_scheduling_lag(self):
+        ds = DummySamples(10, self.metrics_source)
+        hp = HolodeckPusher(self.metrics_source, [ds])
+        yield hp.start()
+        self.clock.advance(13)
+        stats = hp.get_stats()[("server", "api_key")]
+        self.assertEqual(stats["lag"], 3)
+        self.assertEqual(stats["max_lag"], 3)
+        ds.callback_all()
+        yield hp.stop()
+
+    @inlineCallbacks
+    def test_jittered_sampling(self):
+        ds = DummySamples(10, self.metrics_source, jitter=0.5)
+        hp = HolodeckPusher(self.metrics_source, [ds])
+        yield hp.start()
+        self.assertTrue(0 < ds.offset < 5)
+        self.clock.advance(ds.offset / 2)
+        self.assertEqual(ds.pushes, [])
+        self.clock.advance(ds.offset / 2)
+        self.assertEqual(len(ds.pushes), 1)
+        ds.callback_all()
+        self.clock.advance(10)
+        self.assertEqual([round(t, 6) for t in ds.pushes], [0.0, 10.0])
+        ds.callback_all()
+        yield hp.stop()
+
+    def test_from_config_jitter(self):
+        hp = HolodeckPusher.from_config(object(), {"server": {
+            "key1": {"frequency": 60, "samples": []},
+            "key2": {"frequency": 60, "samples": [], "jitter": 0.1},
+            }}, jitter=0.5)
+        jitters = dict((hs.api_key, hs.jitter) for hs in hp.samples)
+        self.assertEqual(jitters, {"key1": 0.5, "key2": 0.1})
+
+    @inlineCallbacks
+    def test_sampling_with_timing_wheel(self):
+        ds1 = DummySamples(10, self.metrics_source, overrun='overlap')
+        ds2 = DummySamples(5, self.metrics_source, overrun='overlap')
+        hp = HolodeckPusher(self.metrics_source, [ds1, ds2],
+                            scheduler='wheel')
+        yield hp.start()
+        self.clock.pump([1] * 30)
+        self.assertEqual(ds1.pushes, [10.0, 20.0, 30.0])
+        self.assertEqual(ds2.pushes, [5.0, 10.0, 15.0, 20.0, 25.0, 30.0])
+        ds1.callback_all()
+        ds2.callback_all()
+        yield hp.stop()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_unknown_scheduler(self):
+        self.assertRaises(ValueError, HolodeckPusher, self.metrics_source,
+                          [], scheduler='calendar')
+
+    def mk_config(self, frequencies):
+        return {"server": dict(
+            (api_key, {"frequency": frequency, "samples": [
+                {"metric": "metric", "holo": "holo"}]})
+            for api_key, frequency in frequencies.iteritems())}
+
+    @inlineCallbacks
+    def test_reload(self):
+        import vumidash.holodeck_pusher
+        self.patch(vumidash.holodeck_pusher, 'TxClient', DummyTxClient)
+        hp = HolodeckPusher.from_config(DummyClient(), self.mk_config(
+            {"keep": 10, "change": 10, "remove": 10}))
+        yield hp.start()
+        keep = [hs for hs in hp.samples if hs.api_key == "keep"][0]
+        changed = [hs for hs in hp.samples if hs.api_key == "change"][0]
+        self.clock.advance(10)
+        result = hp.reload_config(self.mk_config(
+            {"keep": 10, "change": 5, "add": 10}))
+        self.assertEqual(result, (1, 1, 1))
+        self.assertEqual(sorted(hs.api_key for hs in hp.samples),
+                         ["add", "change", "keep"])
+        self.assertTrue([hs for hs in hp.samples if hs is keep])
+        new_changed = [hs for hs in hp.samples if hs.api_key == "change"][0]
+        self.assertEqual(new_changed.frequency, 5)
+        self.assertTrue(new_changed.stats is changed.stats)
+        self.clock.pump([5, 5])
+        stats = hp.get_stats()
+        self.assertEqual(stats[("server", "keep")]["pushes"], 2)
+        self.assertEqual(stats[("server", "change")]["pushes"], 3)
+        self.assertEqual(stats[("server", "add")]["pushes"], 1)
+        self.assertFalse(("server", "remove") in stats)
+        yield hp.stop()
+
+    @inlineCallbacks
+    def test_reload_keeps_pushes_in_progress(self):
+        old = DummySamples(10, self.metrics_source, overrun='coalesce',
+                           push_timeout=60)
+        hp = HolodeckPusher(self.metrics_source, [old])
+        yield hp.start()
+        self.clock.advance(10)
+        self.assertEqual(old.pushes, [10.0])
+        new = DummySamples(5, self.metrics_source, overrun='coalesce',
+                           push_timeout=60)
+        hp.reload([new])
+        self.assertEqual(new.in_flight, 1)
+        self.assertTrue(old.current() is new)
+        # the old push is still running so the new set's ticks coalesce
+        self.clock.pump([5, 5])
+        self.assertEqual(new.pushes, [])
+        self.assertEqual(new.pending_tick, 20.0)
+        old.deferreds[0].callback(None)
+        self.assertEqual(new.pushes, [20.0])
+        stats = hp.get_stats()[("server", "api_key")]
+        self.assertEqual(stats["coalesced"], 1)
+        self.assertEqual(stats["dropped_ticks"], 1)
+        self.assertEqual(stats["in_flight"], 1)
+        new.callback_all()
+        self.assertEqual(new.in_flight, 0)
+        yield hp.stop()
+
+    @inlineCallbacks
+    def test_reload_into_empty_pusher(self):
+        ds = DummySamples(10, self.metrics_source)
+        hp = HolodeckPusher(self.metrics_source, [])
+        yield hp.start()
+        hp.reload([ds])
+        self.clock.advance(10)
+        self.assertEqual(ds.pushes, [10.0])
+        ds.callback_all()
+        yield hp.stop()
+
+    @inlineCallbacks
+    def test_push_state(self):
+        state = PushState(self.mktemp())
+        ds = DummySamples(10, self.metrics_source)
+        hp = HolodeckPusher(self.metrics_source, [ds], state=state)
+        yield hp.start()
+        self.clock.advance(10)
+        self.assertEqual(state.get("server", "api_key"), None)
+        ds.callback_all()
+        self.assertEqual(state.get("server", "api_key"), 10)
+        self.assertFalse(os.path.exists(state.path))
+        self.clock.advance(hp.STATE_SAVE_INTERVAL)
+        self.assertTrue(os.path.exists(state.path))
+        ds.callback_all()
+        yield hp.stop()
+        saved = PushState(state.path)
+        saved.load()
+        self.assertEqual(saved.get("server", "api_key"), 20)
+
+    @inlineCallbacks
+    def test_backfill_on_start(self):
+        started = []
+
+        class DummyBackfill(object):
+            def start(self, sample_sets):
+                started.append(list(sample_sets))
+                self.done = Deferred()
+                return self.done
+
+            def stop(self):
+                self.done.callback(0)
+
+        state = PushState(self.mktemp())
+        backfill = DummyBackfill()
+        ds = DummySamples(10, self.metrics_source)
+        hp = HolodeckPusher(self.metrics_source, [ds], state=state,
+                            backfill=backfill)
+        yield hp.start()
+        self.assertEqual(started, [[ds]])
+        yield hp.stop()
+        self.assertTrue(backfill.done.called)
+
+
+class TestSharding(unittest.TestCase):
+    def mk_config(self, count):
+        return {"server": dict(
+            ("key%d" % i, {"frequency": 60, "samples": []})
+            for i in range(count))}
+
+    def test_shard_of(self):
+        self.assertEqual(shard_of("server", "key", 4),
+                         shard_of("server", "key", 4))
+        shards = [shard_of("server", "key%d" % i, 4) for i in range(1000)]
+        for shard in range(4):
+            self.assertTrue(200 < shards.count(shard) < 300)
+
+    def test_every_set_in_one_shard(self):
+        config = self.mk_config(50)
+        keys = []
+        for index in range(3):
+            hp = HolodeckPusher.from_config(object(), config,
+                                            shard_index=index, shard_count=3)
+            self.assertTrue(hp.samples)
+            keys.extend(hs.api_key for hs in hp.samples)
+        self.assertEqual(sorted(keys), sorted(config["server"]))
+
+    def test_reload_keeps_shard(self):
+        hp = HolodeckPusher.from_config(object(), self.mk_config(10),
+                                        shard_index=1, shard_count=2)
+        hp.reload_config(self.mk_config(20), shard_index=1, shard_count=2)
+        for hs in hp.samples:
+            self.assertEqual(shard_of(hs.server, hs.api_key, 2), 1)
+
+
+class TestHolodeckPusherService(unittest.TestCase):
+    def setUp(self):
+        import vumidash.holodeck_pusher
+        self.patch(vumidash.holodeck_pusher, 'TxClient', DummyTxClient)
+        self.patch(vumidash.holodeck_pusher, 'deferToThread',
+                   maybeDeferred)
+        self.clock = Clock()
+        self.patch(HolodeckPusher, 'clock', self.clock)
+        self.patch(HolodeckPusherService, 'clock', self.clock)
+        self.config_file = self.mktemp()
+        self.write_config(["key1"])
+
+    def write_config(self, api_keys):
+        with open(self.config_file, "w") as f:
+            f.write("server:\n")
+            for api_key in api_keys:
+                f.write("  %s:\n    frequency: 60\n    samples: []\n"
+                        % (api_key,))
+
+    def mk_service(self, **kw):
+        service = HolodeckPusherService(
+            DummyClient(), load_config(self.config_file),
+            config_file=self.config_file, **kw)
+        service.startService()
+        self.addCleanup(service.stopService)
+        return service
+
+    def api_keys(self, service):
+        return sorted(hs.api_key for hs in service.holodeck_pusher.samples)
+
+    def test_state_file(self):
+        state_file = self.mktemp()
+        service = self.mk_service(state_file=state_file, backfill_rate=2.0,
+                                  max_backfill=600)
+        hp = service.holodeck_pusher
+        self.assertEqual(hp.state.path, state_file)
+        self.assertTrue(hp.backfill.state is hp.state)
+        self.assertTrue(hp.backfill.sender is hp.client_pool)
+        self.assertEqual(hp.backfill.rate, 2.0)
+        self.assertEqual(hp.backfill.max_gap, 600)
+
+    def test_log_stats(self):
+        service = self.mk_service(stats_interval=30,
+                                  spool_dir=self.mktemp())
+        self.assertTrue(service._stats_task.running)
+        self.assertEqual(service.summarise_stats(), {
+            'sets': 1, 'pushes': 0, 'dropped_ticks': 0, 'coalesced': 0,
+            'timed_out': 0, 'in_flight': 0, 'max_lag': 0.0, 'spooled': 0,
+            'replayed': 0, 'dropped': 0, 'pending_bytes': 0})
+        logged = []
+        log.addObserver(logged.append)
+        self.addCleanup(log.removeObserver, logged.append)
+        self.clock.advance(30)
+        messages = [" ".join(event["message"]) for event in logged]
+        self.assertTrue("Holodeck pusher stats: 1 sets, 0 pushes, 0 in"
+                        " flight, 0 dropped ticks, 0 coalesced, 0 timed out,"
+                        " max lag"
+                        " 0.0s, 0 spooled, 0 replayed, 0 dropped from"
+                        " spool, 0 bytes spooled." in messages)
+
+    @inlineCallbacks
+    def test_stop_stats(self):
+        service = self.mk_service(stats_interval=30)
+        self.assertFalse('spooled' in service.summarise_stats())
+        yield service.stopService()
+        self.assertFalse(service._stats_task.running)
+
+    def test_reload_config(self):
+        service = self.mk_service()
+        self.assertEqual(self.api_keys(service), ["key1"])
+        self.write_config(["key1", "key2"])
+        service.reload_config()
+        self.assertEqual(self.api_keys(service), ["key1", "key2"])
+
+    def test_reload_bad_config(self):
+        service = self.mk_service()
+        with open(self.config_file, "w") as f:
+            f.write("server: [")
+        service.reload_config()
+        self.assertEqual(len(self.flushLoggedErrors()), 1)
+        self.assertEqual(self.api_keys(service), ["key1"])
+
+    def test_reload_while_reloading(self):
+        pending = []
+        self.patch(vumidash.holodeck_pusher, 'deferToThread',
+                   lambda f, *args: pending.append(Deferred()) or
+                   pending[-1].addCallback(lambda _: f(*args)))
+        service = self.mk_service()
+        service.reload_config()
+        service.reload_config()
+        service.reload_config()
+        self.assertEqual(len(pending), 1)
+        pending[0].callback(None)
+        self.assertEqual(len(pending), 2)
+        pending[1].callback(None)
+        self.assertEqual(len(pending), 2)
+
+    def test_sighup_handler(self):
+        service = self.mk_service()
+        self.assertEqual(signal.getsignal(signal.SIGHUP), service._sighup)
+        service.stopService()
+        self.assertEqual(signal.getsignal(signal.SIGHUP), signal.SIG_DFL)
+
+    def test_watch_config(self):
+        service = self.mk_service(watch_interval=5)
+        self.clock.advance(5)
+        self.assertEqual(self.api_keys(service), ["key1"])
+        self.write_config(["key2"])
+        os.utime(self.config_file, (0, 0))
+        self.clock.advance(5)
+        self.assertEqual(self.api_keys(service), ["key2"])
@@ -0,0 +1,89 @@
+"""Tests for vumidash.holodeck_shards."""
+
+import os
+import sys
+
+from twisted.trial import unittest
+from twisted.internet.error import ProcessTerminated
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+
+from vumidash.holodeck_shards import HolodeckShardSupervisor, shard_path
+
+
+class DummyTransport(object):
+    def __init__(self, protocol):
+        self.protocol = protocol
+        self.signals = []
+
+    def signalProcess(self, signal):
+        self.signals.append(signal)
+        self.protocol.processEnded(Failure(ProcessTerminated(signal=15)))
+
+
+class DummyProcessReactor(Clock):
+    def __init__(self):
+        Clock.__init__(self)
+        self.spawned = []
+        self.envs = []
+
+    def spawnProcess(self, protocol, executable, args, env=None):
+        protocol.transport = DummyTransport(protocol)
+        self.spawned.append((protocol, args))
+        self.envs.append(env)
+
+
+class TestShardPath(unittest.TestCase):
+
+    def test_shard_path(self):
+        self.assertEqual(shard_path("/var/spool/holodeck", 2),
+                         "/var/spool/holodeck.shard-2")
+        self.assertEqual(shard_path("/var/spool/holodeck/", 0),
+                         "/var/spool/holodeck.shard-0")
+        self.assertEqual(shard_path("state.json", 1), "state.json.shard-1")
+
+
+class TestHolodeckShardSupervisor(unittest.TestCase):
+
+    def setUp(self):
+        self.reactor = DummyProcessReactor()
+        self.patch(HolodeckShardSupervisor, 'clock', self.reactor)
+        self.supervisor = HolodeckShardSupervisor(
+            3, ["--config", "holodeck.yaml"])
+
+    def test_shard_args(self):
+        args = self.supervisor.shard_args(1)
+        self.assertTrue("graphite2holodeck" in args)
+        self.assertEqual(args[-6:], ["--config", "holodeck.yaml",
+                                     "--shard-index", "1",
+                                     "--shard-count", "3"])
+
+    def test_start_and_stop(self):
+        self.supervisor.startService()
+        self.assertEqual(sorted(self.supervisor.shards), [0, 1, 2])
+        self.assertEqual(len(self.reactor.spawned), 3)
+        d = self.supervisor.stopService()
+        self.successResultOf(d)
+        self.assertEqual(self.supervisor.shards, {})
+        for protocol, _args in self.reactor.spawned:
+            self.assertEqual(protocol.transport.signals, ["TERM"])
+        self.assertEqual(self.reactor.getDelayedCalls(), [])
+
+    def test_absolute_pythonpath(self):
+        self.patch(sys, 'path', ["", "lib", "/usr/lib/python"])
+        self.supervisor.startService()
+        self.assertEqual(self.reactor.envs[0]["PYTHONPATH"], os.pathsep.join(
+            [os.getcwd(), os.path.join(os.getcwd(), "lib"),
+             "/usr/lib/python"]))
+        self.successResultOf(self.supervisor.stopService())
+
+    def test_restarts_shard(self):
+        self.supervisor.startService()
+        protocol, _args = self.reactor.spawned[1]
+        protocol.processEnded(Failure(ProcessTerminated(exitCode=1)))
+        self.assertFalse(1 in self.supervisor.shards)
+        self.reactor.advance(self.supervisor.RESTART_DELAY)
+        self.assertTrue(1 in self.supervisor.shards)
+        self.assertEqual(len(self.reactor.spawned), 4)
+        self.assertEqual(self.reactor.spawned[-1][1][-3], "1")
+        self.successResultOf(self.supervisor.stopService())
@@ -0,0 +1,312 @@
+"""Tests for vumidash.holodeck_spool."""
+
+import os
+from datetime import datetime
+
+from twisted.trial import unittest
+from twisted.internet.defer import Deferred, succeed, fail
+from twisted.internet.task import Clock
+
+from vumidash.holodeck_spool import SpoolQueue, HoloSpool
+
+
+class TestSpoolQueue(unittest.TestCase):
+
+    def mk_queue(self, max_bytes=1000, segment_bytes=100):
+        return SpoolQueue(self.mktemp(), max_bytes, segment_bytes)
+
+    def entries(self, queue, count=100):
+        return [entry for _segment, _offset, entry in queue.read(count)]
+
+    def test_append_and_read(self):
+        queue = self.mk_queue()
+        self.assertTrue(queue.empty())
+        queue.append({"n": 1})
+        queue.append({"n": 2})
+        self.assertFalse(queue.empty())
+        self.assertEqual(self.entries(queue), [{"n": 1}, {"n": 2}])
+        self.assertEqual(self.entries(queue, 1), [{"n": 1}])
+
+    def test_consume(self):
+        queue = self.mk_queue()
+        for n in range(3):
+            queue.append({"n": n})
+        segment, offset, _entry = queue.read(1)[0]
+        queue.consume(segment, offset)
+        self.assertEqual(self.entries(queue), [{"n": 1}, {"n": 2}])
+        segment, offset, _entry = queue.read(2)[-1]
+        queue.consume(segment, offset)
+        self.assertTrue(queue.empty())
+        self.assertEqual(os.listdir(queue.directory), [])
+
+    def test_rotates_segments(self):
+        queue = self.mk_queue(segment_bytes=30)
+        for n in range(5):
+            queue.append({"n": n})
+        self.assertTrue(len(queue.segments) > 1)
+        entries = []
+        while not queue.empty():
+            batch = queue.read(100)
+            entries.extend(entry for _segment, _offset, entry in batch)
+            queue.consume(*batch[-1][:2])
+        self.assertEqual(entries, [{"n": n} for n in range(5)])
+
+    def test_bounded(self):
+        queue = self.mk_queue(max_bytes=100, segment_bytes=25)
+        for n in range(100):
+            queue.append({"n": n})
+        self.assertTrue(queue.size() <= 100)
+        self.assertTrue(queue.dropped > 0)
+        entries = self.entries(queue, 1000)
+        self.assertEqual(entries[0]["n"], queue.dropped)
+
+    def test_consume_dropped_segment(self):
+        queue = self.mk_queue(max_bytes=40, segment_bytes=20)
+        queue.append({"n": 0})
+        segment, offset, _entry = queue.read(1)[0]
+        for n in range(1, 10):
+            queue.append({"n": n})
+        queue.consume(segment, offset)
+        self.assertNotEqual(self.entries(queue)[0], {"n": 0})
+
+    def test_reload(self):
+        queue = self.mk_queue()
+        queue.append({"n": 1})
+        queue = SpoolQueue(queue.directory, 1000, 100)
+        self.assertEqual(self.entries(queue), [{"n": 1}])
+
+    def test_reload_saved_offset(self):
+        queue = self.mk_queue()
+        for n in range(3):
+            queue.append({"n": n})
+        queue.consume(*queue.read(1)[0][:2])
+        self.assertEqual(self.entries(SpoolQueue(queue.directory, 1000, 100)),
+                         [{"n": 0}, {"n": 1}, {"n": 2}])
+        queue.save_offset()
+        self.assertFalse(os.path.exists(os.path.join(
+            queue.directory, SpoolQueue.OFFSET_FILE + ".tmp")))
+        self.assertEqual(self.entries(SpoolQueue(queue.directory, 1000, 100)),
+                         [{"n": 1}, {"n": 2}])
+
+    def test_saved_offset_removed_with_segment(self):
+        queue = self.mk_queue(segment_bytes=20)
+        for n in range(3):
+            queue.append({"n": n})
+        queue.consume(*queue.read(1)[0][:2])
+        queue.save_offset()
+        self.assertTrue(os.path.exists(os.path.join(
+            queue.directory, SpoolQueue.OFFSET_FILE)))
+        # consuming the rest of the segment leaves nothing to resume from
+        queue.consume(*queue.read(1)[0][:2])
+        queue.save_offset()
+        self.assertFalse(os.path.exists(os.path.join(
+            queue.directory, SpoolQueue.OFFSET_FILE)))
+        self.assertEqual(self.entries(SpoolQueue(queue.directory, 1000, 20)),
+                         [{"n": 2}])
+
+    def test_saved_offset_of_dropped_segment_ignored(self):
+        queue = self.mk_queue(max_bytes=40, segment_bytes=30)
+        queue.append({"n": 0})
+        queue.append({"n": 1})
+        queue.consume(*queue.read(1)[0][:2])
+        queue.save_offset()
+        for n in range(2, 6):
+            queue.append({"n": n})
+        reloaded = SpoolQueue(queue.directory, 40, 30)
+        self.assertEqual(self.entries(reloaded), self.entries(queue))
+
+    def test_torn_tail_truncated(self):
+        queue = self.mk_queue()
+        queue.append({"n": 1})
+        with open(queue._path(queue.segments[-1]), "ab") as f:
+            f.write('{"n": ')
+        reloaded = SpoolQueue(queue.directory, 1000, 100)
+        reloaded.append({"n": 2})
+        self.assertEqual(self.entries(reloaded), [{"n": 1}, {"n": 2}])
+
+    def test_torn_only_entry_removed(self):
+        queue = self.mk_queue()
+        queue.append({"n": 1})
+        with open(queue._path(queue.segments[-1]), "wb") as f:
+            f.write('{"n": ')
+        reloaded = SpoolQueue(queue.directory, 1000, 100)
+        self.assertTrue(reloaded.empty())
+        self.assertEqual(os.listdir(queue.directory), [])
+
+    def test_unreadable_entry(self):
+        queue = self.mk_queue()
+        queue.append({"n": 1})
+        with open(queue._path(queue.segments[-1]), "ab") as f:
+            f.write('{"n": \n')
+        queue.append({"n": 2})
+        self.assertEqual(self.entries(queue), [{"n": 1}, None, {"n": 2}])
+
+
+class DummyClientPool(object):
+    def __init__(self):
+        self.sends = []
+        self.fail = False
+
+    def send(self, server, api_key, samples, timestamp):
+        if self.fail:
+            return fail(ValueError("Holodeck down"))
+        self.sends.append((server, api_key, samples, timestamp))
+        return succeed(None)
+
+
+class TestHoloSpool(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.patch(HoloSpool, 'clock', self.clock)
+        self.pool = DummyClientPool()
+        self.directory = self.mktemp()
+
+    def mk_spool(self, **kw):
+        spool = HoloSpool(self.pool, self.directory, **kw)
+        spool.start()
+        self.addCleanup(spool.stop)
+        return spool
+
+    def send(self, spool, n, api_key="key"):
+        return spool.send("server", api_key, [["holo", n]],
+                          datetime.fromtimestamp(60.0 * n))
+
+    def test_send(self):
+        spool = self.mk_spool()
+        self.successResultOf(self.send(spool, 1))
+        self.assertEqual(self.pool.sends, [
+            ("server", "key", [["holo", 1]], datetime.fromtimestamp(60.0))])
+        self.assertEqual(spool.queues, {})
+
+    def test_failed_push_spooled_and_replayed(self):
+        spool = self.mk_spool(initial_delay=1.0)
+        self.pool.fail = True
+        self.successResultOf(self.send(spool, 1))
+        self.assertFalse(spool.queue("server", "key").empty())
+        self.pool.fail = False
+        self.clock.advance(1.0)
+        self.assertEqual(self.pool.sends, [
+            ("server", "key", [["holo", 1]], datetime.fromtimestamp(60.0))])
+        self.assertTrue(spool.queue("server", "key").empty())
+        stats = spool.get_stats()[("server", "key")]
+        self.assertEqual(stats["spooled"], 1)
+        self.assertEqual(stats["replayed"], 1)
+        self.assertEqual(stats["pending_bytes"], 0)
+
+    def test_pushes_stay_in_order(self):
+        spool = self.mk_spool()
+        self.pool.fail = True
+        self.send(spool, 1)
+        self.pool.fail = False
+        self.send(spool, 2)
+        self.assertEqual(self.pool.sends, [])
+        self.clock.advance(1.0)
+        self.assertEqual([send[2] for send in self.pool.sends],
+                         [[["holo", 1]], [["holo", 2]]])
+
+    def test_backoff(self):
+        spool = self.mk_spool(initial_delay=1.0, max_delay=4.0)
+        self.pool.fail = True
+        self.send(spool, 1)
+        [call] = self.clock.getDelayedCalls()
+        delays = []
+        for _ in range(4):
+            call = self.clock.getDelayedCalls()[0]
+            delays.append(call.getTime() - self.clock.seconds())
+            self.clock.advance(delays[-1])
+        self.assertEqual(delays, [1.0, 2.0, 4.0, 4.0])
+        self.pool.fail = False
+        self.clock.advance(4.0)
+        self.assertEqual(len(self.pool.sends), 1)
+        self.assertEqual(spool._delays, {})
+
+    def test_batched_catch_up(self):
+        spool = self.mk_spool(batch_size=2)
+        self.pool.fail = True
+        for n in range(5):
+            self.send(spool, n)
+        self.pool.fail = False
+        replays = []
+        replay = spool.replay
+        self.patch(spool, 'replay', lambda key: replays.append(key) or
+                   replay(key))
+        self.clock.advance(1.0)
+        self.assertEqual(len(replays), 3)
+        self.assertEqual([send[2][0][1] for send in self.pool.sends],
+                         range(5))
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_replay_waits_for_send(self):
+        spool = self.mk_spool()
+        self.pool.fail = True
+        self.send(spool, 1)
+        self.pool.fail = False
+        pending = Deferred()
+        self.pool.send = lambda *a, **kw: pending
+        self.clock.advance(1.0)
+        self.send(spool, 2)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(spool.stats[("server", "key")]["spooled"], 2)
+        pending.callback(None)
+
+    def test_restart_resends_only_unsent_batch(self):
+        spool = self.mk_spool(batch_size=2)
+        self.pool.fail = True
+        for n in range(5):
+            self.send(spool, n)
+        self.pool.fail = False
+        pending = Deferred()
+        send = self.pool.send
+        self.pool.send = lambda *a, **kw: (
+            pending if len(self.pool.sends) == 3 else send(*a, **kw))
+        # the first batch is sent and the second waits on its second push
+        self.clock.advance(1.0)
+        self.clock.advance(0)
+        self.assertEqual(len(self.pool.sends), 3)
+        d = spool.stop()
+        self.assertNoResult(d)
+        pending.callback(None)
+        self.successResultOf(d)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.pool.send = send
+        self.pool.sends = []
+        spool = self.mk_spool()
+        self.clock.advance(1.0)
+        # the push in progress finished before stopping
+        self.assertEqual([s[2][0][1] for s in self.pool.sends], [4])
+
+    def test_unreadable_entries_skipped(self):
+        spool = self.mk_spool()
+        self.pool.fail = True
+        self.send(spool, 1)
+        queue = spool.queue("server", "key")
+        path = queue._path(queue.segments[-1])
+        with open(path, "ab") as f:
+            f.write('{"samples": []}\n')
+        self.send(spool, 2)
+        with open(path, "ab") as f:
+            f.write('{"timestamp": 60.0, "sam')
+        spool.stop()
+        self.pool.fail = False
+        spool = self.mk_spool()
+        self.clock.advance(1.0)
+        self.assertEqual([send[2] for send in self.pool.sends],
+                         [[["holo", 1]], [["holo", 2]]])
+        stats = spool.get_stats()[("server", "key")]
+        self.assertEqual(stats["replayed"], 2)
+        self.assertEqual(stats["skipped"], 1)
+        self.assertTrue(spool.queue("server", "key").empty())
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_reload(self):
+        spool = self.mk_spool()
+        self.pool.fail = True
+        self.send(spool, 1, api_key="key1")
+        self.send(spool, 2, api_key="key2")
+        spool.stop()
+        self.pool.fail = False
+        spool = self.mk_spool()
+        self.clock.advance(1.0)
+        self.assertEqual(sorted(send[1] for send in self.pool.sends),
+                         ["key1", "key2"])
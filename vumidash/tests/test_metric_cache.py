@@ -0,0 +1,163 @@
+"""Tests for vumidash.metric_cache."""
+
+from datetime import timedelta
+
+from twisted.trial import unittest
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, Deferred
+from twisted.internet.task import Clock
+from twisted.internet.error import ConnectError
+
+from vumidash.base import MetricSource, UnknownMetricError
+from vumidash.metric_cache import (
+    CachingMetricSource, MetricSourceServerFactory, RemoteMetricSource,
+    RemoteMetricError)
+
+
+class RecordingSource(MetricSource):
+    def __init__(self):
+        self.calls = []
+        self.deferreds = []
+        self.deferred_results = False
+
+    def get_latest(self, metric, start, end, summary_size):
+        self.calls.append(('get_latest', metric))
+        if metric == 'unknown':
+            raise UnknownMetricError("Unknown metric %r" % (metric,))
+        if self.deferred_results:
+            d = Deferred()
+            self.deferreds.append(d)
+            return d
+        return (1.0, 2.0)
+
+    def get_history(self, metric, start, end, summary_size,
+                    skip_nulls=True):
+        self.calls.append(('get_history', metric, start, end, summary_size,
+                           skip_nulls))
+        return [[1000, 1.0], [2000, None if not skip_nulls else 2.0]]
+
+
+class TestCachingMetricSource(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.patch(CachingMetricSource, 'clock', self.clock)
+        self.source = RecordingSource()
+        self.cache = CachingMetricSource(self.source, ttl=10)
+        self.args = (timedelta(-1), timedelta(0), timedelta(seconds=300))
+
+    @inlineCallbacks
+    def test_cached(self):
+        first = yield self.cache.get_latest('foo', *self.args)
+        second = yield self.cache.get_latest('foo', *self.args)
+        self.assertEqual(first, (1.0, 2.0))
+        self.assertEqual(second, (1.0, 2.0))
+        self.assertEqual(self.source.calls, [('get_latest', 'foo')])
+
+    @inlineCallbacks
+    def test_expires(self):
+        yield self.cache.get_latest('foo', *self.args)
+        self.clock.advance(10)
+        yield self.cache.get_latest('foo', *self.args)
+        self.assertEqual(len(self.source.calls), 2)
+
+    @inlineCallbacks
+    def test_different_args_not_shared(self):
+        yield self.cache.get_history('foo', *self.args)
+        yield self.cache.get_history('foo', *(self.args + (False,)))
+        self.assertEqual(len(self.source.calls), 2)
+
+    def test_in_flight_shared(self):
+        self.source.deferred_results = True
+        d1 = self.cache.get_latest('foo', *self.args)
+        d2 = self.cache.get_latest('foo', *self.args)
+        self.assertEqual(len(self.source.calls), 1)
+        d1.cancel()
+        self.failureResultOf(d1)
+        [upstream] = self.source.deferreds
+        upstream.callback((3.0, 4.0))
+        self.assertEqual(self.successResultOf(d2), (3.0, 4.0))
+
+    def test_failures_not_cached(self):
+        d = self.cache.get_latest('unknown', *self.args)
+        self.failureResultOf(d, UnknownMetricError)
+        d = self.cache.get_latest('unknown', *self.args)
+        self.failureResultOf(d, UnknownMetricError)
+        self.assertEqual(len(self.source.calls), 2)
+
+    @inlineCallbacks
+    def test_purges_expired(self):
+        self.cache.max_entries = 2
+        yield self.cache.get_latest('foo', *self.args)
+        yield self.cache.get_latest('bar', *self.args)
+        self.clock.advance(10)
+        yield self.cache.get_latest('baz', *self.args)
+        self.assertEqual(len(self.cache._cache), 1)
+
+
+class TestRemoteMetricSource(unittest.TestCase):
+
+    def setUp(self):
+        self.source = RecordingSource()
+        socket_path = self.mktemp()
+        self.server = reactor.listenUNIX(
+            socket_path, MetricSourceServerFactory(self.source))
+        self.remote = RemoteMetricSource(socket_path)
+
+    def tearDown(self):
+        self.remote.disconnect()
+        return self.server.stopListening()
+
+    @inlineCallbacks
+    def test_get_latest(self):
+        result = yield self.remote.get_latest(
+            'foo', timedelta(-1), timedelta(0), timedelta(seconds=300))
+        self.assertEqual(result, (1.0, 2.0))
+
+    @inlineCallbacks
+    def test_get_history(self):
+        result = yield self.remote.get_history(
+            'foo', timedelta(-1), timedelta(0), timedelta(seconds=300),
+            False)
+        self.assertEqual(result, [[1000, 1.0], [2000, None]])
+        self.assertEqual(self.source.calls, [
+            ('get_history', 'foo', timedelta(-1), timedelta(0),
+             timedelta(seconds=300), False)])
+
+    @inlineCallbacks
+    def test_remote_error(self):
+        d = self.remote.get_latest(
+            'unknown', timedelta(-1), timedelta(0), timedelta(seconds=300))
+        yield self.assertFailure(d, RemoteMetricError)
+        self.assertEqual(len(self.flushLoggedErrors(UnknownMetricError)), 1)
+
+    @inlineCallbacks
+    def test_connection_reused(self):
+        yield self.remote.get_latest(
+            'foo', timedelta(-1), timedelta(0), timedelta(seconds=300))
+        protocol = self.remote._protocol
+        yield self.remote.get_latest(
+            'bar', timedelta(-1), timedelta(0), timedelta(seconds=300))
+        self.assertTrue(self.remote._protocol is protocol)
+
+    @inlineCallbacks
+    def test_connection_failure_reaches_every_waiter(self):
+        remote = RemoteMetricSource(self.mktemp())
+        d1 = remote.get_protocol()
+        d2 = remote.get_protocol()
+        yield self.assertFailure(d1, ConnectError)
+        yield self.assertFailure(d2, ConnectError)
+        self.assertEqual(remote._waiters, None)
+
+    @inlineCallbacks
+    def test_close_disconnects(self):
+        yield self.remote.get_latest(
+            'foo', timedelta(-1), timedelta(0), timedelta(seconds=300))
+        protocol = self.remote._protocol
+        lost = Deferred()
+        connection_lost = protocol.connectionLost
+        protocol.connectionLost = lambda reason: (
+            connection_lost(reason), lost.callback(None))
+        self.remote.close()
+        yield lost
+        self.assertEqual(self.remote._protocol, None)
@@ -0,0 +1,184 @@
+"""Tests for vumidash.native_imager."""
+
+from twisted.trial import unittest
+from twisted.internet import threads
+from twisted.internet.defer import Deferred, inlineCallbacks
+from twisted.internet.task import Clock
+
+from vumidash.base import UnknownMetricError
+from vumidash.dummy_client import DummyClient
+from vumidash.gecko_imager import DashboardCache
+from vumidash import native_imager
+from vumidash.native_imager import (
+    Widget, NativeDashboardImager, format_value)
+
+
+PNG_HEADER = "\x89PNG\r\n\x1A\n"
+
+WIDGETS = [
+    {"widget": "/latest?metric=test.latest", "title": "Latest"},
+    "/rag?r_metric=test.r&a_metric=test.a&g_metric=test.g",
+    {"widget": "/history?metric=test.one&metric=test.two&label=One"
+               "&label=Two&from=-60min&step=5min&ymin=0",
+     "title": "History"},
+    ]
+
+
+class SlowClient(DummyClient):
+    """Never answers for metrics starting with `slow.`."""
+
+    def get_latest(self, metric, start, end, summary_size, skip_nulls=True):
+        if metric.startswith("slow."):
+            return Deferred()
+        return DummyClient.get_latest(self, metric, start, end, summary_size,
+                                      skip_nulls)
+
+
+class TestWidget(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics_source = DummyClient()
+
+    def test_parse(self):
+        widget = Widget(self.metrics_source,
+                        "/history?metric=test.one&step=1d", "History")
+        self.assertEqual(widget.kind, "history")
+        self.assertEqual(widget.title, "History")
+        self.assertEqual(widget.request.args, {
+            "metric": ["test.one"], "step": ["1d"]})
+
+    def test_unknown_kind(self):
+        self.assertRaises(ValueError, Widget, self.metrics_source,
+                          "/pie?metric=test.one")
+
+    def test_missing_parameter(self):
+        self.assertRaises(ValueError, Widget, self.metrics_source,
+                          "/latest?step=1d")
+        self.assertRaises(ValueError, Widget, self.metrics_source,
+                          "/rag?r_metric=test.r")
+
+    @inlineCallbacks
+    def test_fetch_latest(self):
+        widget = Widget(self.metrics_source, "/latest?metric=test.one")
+        data = yield widget.fetch()
+        self.assertEqual([item["text"] for item in data["item"]], ["", ""])
+
+    @inlineCallbacks
+    def test_fetch_rag(self):
+        widget = Widget(self.metrics_source, WIDGETS[1])
+        data = yield widget.fetch()
+        self.assertEqual([item["text"] for item in data["item"]],
+                         ["Red", "Amber", "Green"])
+
+    @inlineCallbacks
+    def test_fetch_history(self):
+        widget = Widget(self.metrics_source, WIDGETS[2]["widget"])
+        data = yield widget.fetch()
+        self.assertEqual([series["name"] for series in data["series"]],
+                         ["One", "Two"])
+        self.assertEqual([len(series["data"]) for series in data["series"]],
+                         [12, 12])
+
+    @inlineCallbacks
+    def test_fetch_failed(self):
+        widget = Widget(self.metrics_source, "/latest?metric=unknown")
+        data = yield widget.fetch()
+        self.assertEqual(data, None)
+        self.assertEqual(len(self.flushLoggedErrors(UnknownMetricError)), 1)
+
+    def test_fetch_timed_out(self):
+        clock = Clock()
+        self.patch(Widget, 'clock', clock)
+        widget = Widget(SlowClient(), "/latest?metric=slow.one")
+        d = widget.fetch(5)
+        clock.advance(4)
+        self.assertNoResult(d)
+        clock.advance(1)
+        self.assertEqual(self.successResultOf(d), None)
+
+    def test_fetch_within_timeout(self):
+        clock = Clock()
+        self.patch(Widget, 'clock', clock)
+        widget = Widget(self.metrics_source, "/latest?metric=test.one")
+        d = widget.fetch(5)
+        self.assertNotEqual(self.successResultOf(d), None)
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+
+class TestFormatValue(unittest.TestCase):
+
+    def test_format_value(self):
+        self.assertEqual(format_value(None), "-")
+        self.assertEqual(format_value(12.0), "12")
+        self.assertEqual(format_value(1.234), "1.23")
+
+
+class TestNativeDashboardImager(unittest.TestCase):
+
+    timeout = 10
+
+    def setUp(self):
+        if native_imager.Figure is None:
+            raise unittest.SkipTest("Native dashboards require matplotlib.")
+        self.metrics_source = DummyClient()
+        self.imager = NativeDashboardImager(self.metrics_source, WIDGETS,
+                                            title="Native")
+
+    def test_widgets(self):
+        self.assertEqual([widget.kind for widget in self.imager.widgets],
+                         ["latest", "rag", "history"])
+        self.assertEqual([widget.title for widget in self.imager.widgets],
+                         ["Latest", None, "History"])
+
+    @inlineCallbacks
+    def test_render_png(self):
+        data = yield self.imager.fetch_data()
+        png = self.imager.render_png(data)
+        self.assertEqual(png[:8], PNG_HEADER)
+
+    def test_slow_widget_missing(self):
+        clock = Clock()
+        self.patch(Widget, 'clock', clock)
+        imager = NativeDashboardImager(SlowClient(), [
+            "/latest?metric=test.one", "/latest?metric=slow.one"],
+            timeout=5)
+        d = imager.fetch_data()
+        clock.advance(5)
+        fast, slow = self.successResultOf(d)
+        self.assertNotEqual(fast, None)
+        self.assertEqual(slow, None)
+
+    def test_render_missing_data(self):
+        png = self.imager.render_png([None, None, None])
+        self.assertEqual(png[:8], PNG_HEADER)
+
+    @inlineCallbacks
+    def test_generate_png(self):
+        png = yield threads.deferToThread(self.imager.generate_png)
+        self.assertEqual(png[:8], PNG_HEADER)
+
+    @inlineCallbacks
+    def test_dashboard_cache(self):
+        cache = DashboardCache(None, {
+            "native": {"widgets": WIDGETS, "columns": 3},
+            }, 5, metrics_source=self.metrics_source)
+        self.addCleanup(cache.stop)
+        imager = cache.dashboards["native"]
+        self.assertTrue(isinstance(imager, NativeDashboardImager))
+        self.assertEqual(imager.title, "Native")
+        self.assertEqual(imager.columns, 3)
+        yield cache.refresh_images()
+        self.assertEqual(cache.get_png("native")[:8], PNG_HEADER)
+
+
+class TestNativeDashboardConfig(unittest.TestCase):
+
+    def test_requires_metrics_source(self):
+        self.assertRaises(ValueError, DashboardCache, None, {
+            "native": {"widgets": WIDGETS},
+            }, 5)
+
+    def test_requires_matplotlib(self):
+        self.patch(native_imager, 'Figure', None)
+        self.assertRaises(ValueError, NativeDashboardImager, DummyClient(),
+                          WIDGETS)
@@ -0,0 +1,240 @@
+"""Tests for vumidash.rollup_store."""
+
+import os
+from datetime import timedelta
+
+from twisted.trial import unittest
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import Clock
+
+from vumidash.base import MetricSource
+from vumidash.graphite_client import GraphiteClient
+from vumidash.rollup_store import RollupSeries, RollupStore, RollupMetricSource
+
+
+HOUR = 60 * 60
+DAY = 24 * HOUR
+
+
+class TestRollupSeries(unittest.TestCase):
+
+    def mk_series(self, agg, slots=24):
+        return RollupSeries(self.mktemp(), HOUR, slots, agg)
+
+    def add_points(self, series, points):
+        for t, v in points:
+            series.add(t, v)
+        return series
+
+    def test_avg(self):
+        series = self.add_points(self.mk_series('avg'), [
+            (0, 1.0), (300, 2.0), (600, 6.0), (HOUR, 10.0)])
+        self.assertEqual(series.buckets(0, 2 * HOUR),
+                         [(0, 3.0), (HOUR, 10.0)])
+
+    def test_sum_min_max(self):
+        points = [(0, 1.0), (300, 5.0), (600, 3.0)]
+        for agg, expected in [('sum', 9.0), ('min', 1.0), ('max', 5.0)]:
+            series = self.add_points(self.mk_series(agg), points)
+            self.assertEqual(series.value(0), expected)
+
+    def test_last(self):
+        series = self.add_points(self.mk_series('last'), [
+            (600, 3.0), (0, 1.0), (300, 5.0)])
+        self.assertEqual(series.value(0), 3.0)
+
+    def test_missing_bucket(self):
+        series = self.add_points(self.mk_series('avg'), [(HOUR, 1.0)])
+        self.assertEqual(series.buckets(0, 3 * HOUR),
+                         [(0, None), (HOUR, 1.0), (2 * HOUR, None)])
+
+    def test_ring_buffer_overwrites_old_buckets(self):
+        series = self.add_points(self.mk_series('sum', slots=2), [
+            (0, 1.0), (2 * HOUR, 5.0)])
+        self.assertEqual(series.value(0), None)
+        self.assertEqual(series.value(2 * HOUR), 5.0)
+
+    def test_persistent(self):
+        path = self.mktemp()
+        series = RollupSeries(path, HOUR, 24, 'sum')
+        series.add(0, 2.0)
+        series.watermark = 300
+        series.close()
+        series = RollupSeries(path, HOUR, 24, 'sum')
+        self.assertEqual(series.value(0), 2.0)
+        self.assertEqual(series.watermark, 300)
+
+    def test_unknown_aggregation(self):
+        self.assertRaises(ValueError, self.mk_series, 'median')
+
+
+class TestRollupStore(unittest.TestCase):
+
+    def setUp(self):
+        self.store = RollupStore(self.mktemp())
+        self.addCleanup(self.store.close)
+
+    def test_ingest(self):
+        self.store.ingest('foo.sum', 'sum', [
+            (0, 1.0), (HOUR, 2.0), (DAY, 4.0), (DAY + 300, 8.0)], 0, DAY)
+        self.assertEqual(self.store.watermark('foo.sum', 'sum'), DAY)
+        hourly = self.store.series('foo.sum', HOUR, 'sum')
+        daily = self.store.series('foo.sum', DAY, 'sum')
+        self.assertEqual(hourly.value(HOUR), 2.0)
+        self.assertEqual(daily.buckets(0, 2 * DAY), [(0, 3.0), (DAY, None)])
+
+    def test_files_in_directory(self):
+        self.store.ingest('foo.sum', 'sum', [], 0, 300)
+        self.assertEqual(len(os.listdir(self.store.directory)), 2)
+
+    def test_low_watermark(self):
+        self.store.ingest('foo.sum', 'sum', [], DAY, 2 * DAY)
+        self.assertEqual(self.store.low_watermark('foo.sum', 'sum'), DAY)
+        self.store.ingest('foo.sum', 'sum', [], 0, DAY)
+        self.assertEqual(self.store.low_watermark('foo.sum', 'sum'), 0)
+        self.assertEqual(self.store.watermark('foo.sum', 'sum'), 2 * DAY)
+
+    def test_old_points_kept_out_of_ring(self):
+        store = RollupStore(self.mktemp(), {HOUR: 24})
+        self.addCleanup(store.close)
+        store.ingest('foo.sum', 'sum', [(DAY, 1.0)], DAY, DAY + HOUR)
+        # a point a day older shares its slot with the newer bucket
+        store.ingest('foo.sum', 'sum', [(0, 2.0), (HOUR, 4.0)], 0, DAY)
+        hourly = store.series('foo.sum', HOUR, 'sum')
+        self.assertEqual(hourly.value(DAY), 1.0)
+        self.assertEqual(hourly.value(0), None)
+        self.assertEqual(hourly.value(HOUR), 4.0)
+        self.assertEqual(store.low_watermark('foo.sum', 'sum'), HOUR)
+        store.ingest('foo.sum', 'sum', [], DAY + HOUR, DAY + 2 * HOUR)
+        self.assertEqual(store.low_watermark('foo.sum', 'sum'), 2 * HOUR)
+
+    def test_max_open(self):
+        store = RollupStore(self.mktemp(), max_open=2)
+        self.addCleanup(store.close)
+        store.ingest('foo.sum', 'sum', [(0, 1.0)], 0, 300)
+        hourly = store.series('foo.sum', HOUR, 'sum')
+        store.ingest('bar.sum', 'sum', [], 0, 300)
+        self.assertEqual(len(store._series), 2)
+        self.assertRaises(ValueError, hourly.value, 0)
+        # closed series are reopened from their files
+        self.assertEqual(store.series('foo.sum', HOUR, 'sum').value(0), 1.0)
+
+
+class FineSource(MetricSource):
+    """Serves one data point per step with value equal to the hour."""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.calls = []
+
+    def aggregation_method(self, metric):
+        return GraphiteClient(None).aggregation_method(metric)
+
+    def get_history(self, metric, start, end, summary_size,
+                    skip_nulls=True):
+        now = self.clock.seconds()
+        step = self.total_seconds(summary_size)
+        since = now + self.total_seconds(start)
+        until = now + self.total_seconds(end)
+        self.calls.append((since, until, step))
+        t = since - since % step
+        points = []
+        while t < until:
+            points.append((t * 1000, float(t // HOUR)))
+            t += step
+        return points
+
+    def get_latest(self, metric, start, end, summary_size, skip_nulls=True):
+        return ('direct', metric)
+
+
+class TestRollupMetricSource(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.clock.advance(10 * DAY + 30 * 60)
+        self.patch(RollupMetricSource, 'clock', self.clock)
+        self.store = RollupStore(self.mktemp())
+        self.addCleanup(self.store.close)
+        self.fine = FineSource(self.clock)
+        self.source = RollupMetricSource(self.fine, self.store,
+                                         fine_step=300, min_range=DAY)
+
+    def test_short_range_not_rolled_up(self):
+        result = self.source.get_latest('foo.max', timedelta(hours=-1),
+                                        timedelta(0), timedelta(hours=1))
+        self.assertEqual(result, ('direct', 'foo.max'))
+
+    @inlineCallbacks
+    def test_history_from_rollups(self):
+        points = yield self.source.get_history(
+            'foo.max', timedelta(-2), timedelta(0), timedelta(hours=1))
+        now = self.clock.seconds()
+        self.assertEqual(len(points), 49)
+        self.assertEqual(points[0], ((now - 2 * DAY - 30 * 60) * 1000,
+                                     float(8 * 24)))
+        self.assertEqual(points[-1][1], float(10 * 24))
+        # one fine fetch to fill the store and one live fetch
+        self.assertEqual(len(self.fine.calls), 2)
+        self.assertEqual(self.fine.calls[1][2], HOUR)
+
+    @inlineCallbacks
+    def test_incremental_updates(self):
+        yield self.source.get_history(
+            'foo.max', timedelta(-2), timedelta(0), timedelta(hours=1))
+        self.clock.advance(HOUR)
+        self.fine.calls = []
+        yield self.source.get_history(
+            'foo.max', timedelta(-2), timedelta(0), timedelta(hours=1))
+        now = self.clock.seconds()
+        fine_fetch, live_fetch = self.fine.calls
+        # the newest fine step is left until Graphite has all of it
+        self.assertEqual(fine_fetch, (now - HOUR - 300, now - 300, 300))
+        self.assertEqual(live_fetch, (now - 30 * 60, now, HOUR))
+
+    def test_range_beyond_ring_not_rolled_up(self):
+        hours = self.store.resolutions[HOUR] - 1
+        self.assertTrue(self.source.use_rollups(
+            timedelta(hours=-hours), timedelta(0), timedelta(hours=1)))
+        self.assertFalse(self.source.use_rollups(
+            timedelta(hours=-hours - 1), timedelta(0), timedelta(hours=1)))
+        result = self.source.get_latest(
+            'foo.max', timedelta(hours=-hours - 1), timedelta(0),
+            timedelta(hours=1))
+        self.assertEqual(result, ('direct', 'foo.max'))
+
+    @inlineCallbacks
+    def test_older_ranges_backfilled(self):
+        yield self.source.get_history(
+            'foo.max', timedelta(-2), timedelta(0), timedelta(hours=1))
+        self.fine.calls = []
+        points = yield self.source.get_history(
+            'foo.max', timedelta(-5), timedelta(0), timedelta(hours=1))
+        now = self.clock.seconds()
+        self.assertEqual(len(points), 5 * 24 + 1)
+        self.assertEqual(points[0][1], float(5 * 24))
+        fine_fetch, live_fetch = self.fine.calls
+        self.assertEqual(fine_fetch, (now - 5 * DAY - 30 * 60,
+                                      now - 2 * DAY - 30 * 60, 300))
+
+    @inlineCallbacks
+    def test_coarse_range_beyond_fine_ring(self):
+        store = RollupStore(self.mktemp(), {HOUR: 48, DAY: 30})
+        self.addCleanup(store.close)
+        source = RollupMetricSource(self.fine, store, fine_step=300,
+                                    min_range=DAY)
+        yield source.get_history(
+            'foo.max', timedelta(-8), timedelta(0), timedelta(1))
+        self.fine.calls = []
+        points = yield source.get_history(
+            'foo.max', timedelta(-8), timedelta(0), timedelta(1))
+        self.assertEqual(len(points), 9)
+        # the hourly ring can't hold the range but the daily one does
+        [live_fetch] = self.fine.calls
+        self.assertEqual(live_fetch[2], DAY)
+
+    @inlineCallbacks
+    def test_latest_from_rollups(self):
+        first, last = yield self.source.get_latest(
+            'foo.max', timedelta(-2), timedelta(0), timedelta(1))
+        self.assertEqual((first, last), (9 * 24.0 - 1, 10 * 24.0))
@@ -0,0 +1,108 @@
+"""Tests for vumidash.scheduler."""
+
+from twisted.trial import unittest
+from twisted.internet.task import Clock
+
+from vumidash.scheduler import HeapScheduler, TimingWheel
+
+
+class SchedulerTestMixin(object):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.batches = []
+        self.scheduler = self.mk_scheduler()
+        self.scheduler.start()
+        self.addCleanup(self.scheduler.stop)
+
+    def process(self, due):
+        self.batches.append((self.clock.seconds(), sorted(due)))
+
+    def test_schedule(self):
+        self.scheduler.schedule(5, "a")
+        self.scheduler.schedule(3, "b")
+        self.assertEqual(len(self.scheduler), 2)
+        self.clock.advance(3)
+        self.assertEqual(self.batches, [(3, [(3, "b")])])
+        self.clock.advance(2)
+        self.assertEqual(self.batches[1:], [(5, [(5, "a")])])
+        self.assertEqual(len(self.scheduler), 0)
+
+    def test_batches_items_due_together(self):
+        for item in "abc":
+            self.scheduler.schedule(10, item)
+        self.clock.advance(10)
+        self.assertEqual(self.batches, [
+            (10, [(10, "a"), (10, "b"), (10, "c")])])
+
+    def test_reschedule_from_process(self):
+        def process(due):
+            self.batches.append(self.clock.seconds())
+            for t, item in due:
+                self.scheduler.schedule(t + 10, item)
+        self.scheduler.process = process
+        self.scheduler.schedule(10, "a")
+        for _ in range(5):
+            self.clock.advance(10)
+        self.assertEqual(self.batches, [10, 20, 30, 40, 50])
+
+    def test_stop(self):
+        self.scheduler.schedule(10, "a")
+        self.scheduler.stop()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.clock.advance(10)
+        self.assertEqual(self.batches, [])
+
+    def test_late_reactor(self):
+        self.scheduler.schedule(1, "a")
+        self.scheduler.schedule(2, "b")
+        self.clock.advance(5)
+        self.assertEqual([due for _now, due in self.batches],
+                         [[(1, "a")], [(2, "b")]])
+
+
+class TestHeapScheduler(SchedulerTestMixin, unittest.TestCase):
+
+    def mk_scheduler(self):
+        return HeapScheduler(self.clock, self.process)
+
+    def test_reactor_call_per_time(self):
+        self.scheduler.schedule(1.5, "a")
+        self.scheduler.schedule(1.25, "b")
+        self.clock.advance(1.25)
+        self.assertEqual(self.batches, [(1.25, [(1.25, "b")])])
+
+
+class TestTimingWheel(SchedulerTestMixin, unittest.TestCase):
+
+    def mk_scheduler(self):
+        return TimingWheel(self.clock, self.process, slots=4, levels=2)
+
+    def test_batches_slot(self):
+        self.scheduler.schedule(1.5, "a")
+        self.scheduler.schedule(1.25, "b")
+        self.clock.advance(1.25)
+        self.assertEqual(self.batches, [])
+        self.clock.advance(0.75)
+        self.assertEqual(self.batches, [(2, [(1.25, "b"), (1.5, "a")])])
+
+    def test_one_reactor_call(self):
+        for i in range(100):
+            self.scheduler.schedule(i / 10.0, i)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+    def test_higher_levels(self):
+        # 4 slots and 2 levels cover 16 seconds
+        times = [3, 4, 7, 12, 15, 16, 30, 100]
+        for t in times:
+            self.scheduler.schedule(t, t)
+        self.clock.pump([1] * 100)
+        self.assertEqual([now for now, _due in self.batches], times)
+        self.assertEqual([due for _now, due in self.batches],
+                         [[(t, t)] for t in times])
+
+    def test_schedule_in_past(self):
+        self.clock.advance(10)
+        self.scheduler.schedule(5, "a")
+        self.clock.advance(1)
+        self.assertEqual(self.batches, [(11, [(5, "a")])])